@@ -0,0 +1,111 @@
+"""Throughput of the OpenAI-compatible engine against the stub server with a fixed and an adaptive concurrency.
+
+The stub server (`benchmarks/stub_server.py`) serves `--capacity` requests at once, queues up to `--max-queue` more and
+answers 429 beyond. The fixed run keeps `--max-inflight-samples` x `--max-inflight-questions` requests in flight and
+relies on the client retries; the adaptive run starts at `--initial-concurrency` and lets the AIMD limit find the
+capacity of the server. Usage:
+
+    python -m benchmarks.adaptive_concurrency --num-samples 32 --latency 0.1 --capacity 8 --max-queue 8 --max-inflight-samples 16
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+import contextlib
+import urllib.request
+from src.inference.openai_compatible import OpenAICompatibleInferenceEngine, AsyncOpenAICompatibleInferenceEngine
+from benchmarks.common import make_synthetic_dataset, stub_server
+
+
+def run(args, adaptive: bool) -> dict:
+    stub_args = ["--latency-dist", "uniform", "--latency-mean", str(args.latency), "--latency-std", str(args.latency / 2), "--capacity", str(args.capacity)]
+    if args.max_queue is not None:
+        stub_args += ["--max-queue", str(args.max_queue)]
+    with tempfile.TemporaryDirectory() as tmp_dir, stub_server(stub_args) as url:
+        data_file = make_synthetic_dataset(os.path.join(tmp_dir, "data"), num_samples=args.num_samples, create_images=True)
+        engine_cls = AsyncOpenAICompatibleInferenceEngine if args.use_async else OpenAICompatibleInferenceEngine
+        engine = engine_cls(
+            data_file=data_file,
+            image_root=os.path.join(tmp_dir, "data"),
+            output_dir=os.path.join(tmp_dir, "output"),
+            max_inflight_questions=args.max_inflight_questions,
+            max_inflight_samples=args.max_inflight_samples,
+            model_init_kwargs=dict(
+                base_url=f"{url}/v1",
+                max_retries=args.max_retries,
+                adaptive_concurrency=adaptive,
+                initial_concurrency=args.initial_concurrency,
+                max_concurrency=args.max_concurrency
+            )
+        )
+
+        # limit of the endpoint every 100ms, to report its mean over the run
+        limits = []
+        done = threading.Event()
+
+        def sample_limits():
+            while not done.wait(0.1):
+                for endpoint in engine.endpoints:
+                    if endpoint.concurrency_limit is not None:
+                        limits.append(endpoint.concurrency_limit.current_limit())
+
+        sampler = threading.Thread(target=sample_limits, daemon=True)
+        sampler.start()
+        error = None
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            try:
+                if args.use_async:
+                    asyncio.run(engine.ainference(granularity="coarse", multi_stage=True, simple_answer_and_eval=True))
+                else:
+                    engine.inference(granularity="coarse", multi_stage=True, simple_answer_and_eval=True)
+            except Exception as e:
+                error = type(e).__name__
+        wall_time = time.perf_counter() - start
+        done.set()
+        sampler.join()
+
+        with urllib.request.urlopen(f"{url}/stats") as response:
+            server_stats = json.load(response)
+
+    limit_stats = [endpoint.concurrency_limit.get_stats() for endpoint in engine.endpoints if endpoint.concurrency_limit is not None]
+    num_samples = engine.metrics.snapshot()["counters"].get("samples", 0)
+    return {
+        "mode": "adaptive" if adaptive else "fixed",
+        "error": error,
+        "samples_per_second": num_samples / wall_time,
+        "served": server_stats["requests"] - server_stats["rejected"],
+        "rejected": server_stats["rejected"],
+        "server_peak_inflight": server_stats["max_inflight"],
+        "mean_limit": sum(limits) / len(limits) if len(limits) > 0 else None,
+        "final_limit": limit_stats[0]["limit"] if len(limit_stats) > 0 else None,
+        "latency_backoffs": limit_stats[0]["latency_backoffs"] if len(limit_stats) > 0 else None
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-samples", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.1, help="mean service time of a request on the stub server")
+    parser.add_argument("--capacity", type=int, default=8, help="requests served at once by the stub server")
+    parser.add_argument("--max-queue", type=int, default=8, help="queued requests beyond which the stub server answers 429")
+    parser.add_argument("--max-inflight-samples", type=int, default=16)
+    parser.add_argument("--max-inflight-questions", type=int, default=4)
+    parser.add_argument("--max-retries", type=int, default=8)
+    parser.add_argument("--initial-concurrency", type=int, default=4)
+    parser.add_argument("--max-concurrency", type=int, default=256)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use the asyncio engine")
+    args = parser.parse_args()
+
+    print(f"{'mode':<10}{'samples/s':>10}{'served':>8}{'429s':>7}{'server peak':>13}{'mean limit':>12}{'final limit':>13}{'latency backoffs':>18}")
+    for adaptive in (False, True):
+        result = run(args, adaptive=adaptive)
+        line = (f"{result['mode']:<10}{result['samples_per_second']:>10.2f}{result['served']:>8}{result['rejected']:>7}"
+                f"{result['server_peak_inflight']:>13}{str(round(result['mean_limit'], 1) if result['mean_limit'] is not None else '-'):>12}"
+                f"{str(result['final_limit'] or '-'):>13}{str(result['latency_backoffs'] if result['latency_backoffs'] is not None else '-'):>18}")
+        if result["error"] is not None:
+            line += f"  failed with {result['error']}"
+        print(line)
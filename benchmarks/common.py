@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import copy
+import time
+import socket
+import contextlib
+import subprocess
+import urllib.request
+from PIL import Image
+from src.inference.mock import MOCK_EXTRACT_RESPONSE
+from src.inference.inference_engine import add_line_sep_before_title, EXTRACT_STRUCTURE_TEMPLATE
+from src.utils.md_parser import parse_structured_markdown
+
+
+def make_synthetic_dataset(root: str, num_samples: int, ref_ratio: float = 0.5, create_images: bool = False) -> str:
+    """Dump a dataset of `num_samples` samples whose structure and questions are the ones of the mock extract response.
+
+    Image files are only created with `create_images` (tiny PNGs), the mock engine never opens them. Returns the path
+    of the data file.
+    """
+    os.makedirs(root, exist_ok=True)
+    structured, _ = parse_structured_markdown(
+        markdown=add_line_sep_before_title(MOCK_EXTRACT_RESPONSE),
+        target_structure=EXTRACT_STRUCTURE_TEMPLATE,
+        strict_questions=False
+    )
+    questions = structured["Questions"]
+
+    dataset = []
+    num_ref = int(num_samples * ref_ratio)
+    for i in range(num_samples):
+        dataset.append({
+            "id": i,
+            "image_caption": f"a black cat sitting on a sofa, sample {i}",
+            "gt_image": f"gt-{i}.png",
+            "ref_image": f"ref-{i}.png" if i < num_ref else None,
+            # fields of the fine-grained dataset, where questions and structure come with the sample
+            "appearance_questions": [{**copy.deepcopy(question), "entity": entity} for entity, q_list in questions["Appearance Quality Questions"].items() for question in q_list],
+            "intrinsic_questions": [{**copy.deepcopy(question), "entity": entity} for entity, q_list in questions["Intrinsic Attribute Consistency Questions"].items() for question in q_list],
+            "relationship_questions": copy.deepcopy(questions["Relationship Attribute Consistency Questions"]),
+            "structured_info_str": copy.deepcopy(structured)
+        })
+
+    if create_images:
+        for sample in dataset:
+            for image in (sample["gt_image"], sample["ref_image"]):
+                if image is not None:
+                    Image.new("RGB", (8, 8), color=(sample["id"] % 256, 0, 0)).save(os.path.join(root, image))
+
+    data_file = os.path.join(root, "data.json")
+    with open(data_file, "w", encoding="utf-8") as f:
+        json.dump(dataset, f, ensure_ascii=False)
+    return data_file
+
+
+def get_free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def stub_server(stub_args: list, port: int = None):
+    """Run `benchmarks/stub_server.py` with `stub_args` in a subprocess, yields its base URL once it answers."""
+    port = port or get_free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "benchmarks.stub_server", "--port", str(port)] + stub_args,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(100):
+            try:
+                urllib.request.urlopen(f"{url}/v1/models", timeout=1)
+                break
+            except OSError:
+                time.sleep(0.1)
+        yield url
+    finally:
+        process.terminate()
+        process.wait()
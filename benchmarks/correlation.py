@@ -0,0 +1,98 @@
+"""Micro-benchmark of `calc_correlation_matrix` against the original per-pair scipy loop, on synthetic 1-5 scores of
+`--num-columns` evaluators with a fraction of 'N/A' entries. With `--bootstrap-resamples`, `bootstrap_correlation` is
+also timed against scipy calls on every resample (extrapolated from `--reference-resamples` of them). Usage:
+
+    python -m benchmarks.correlation --num-samples 100000 --num-columns 50
+    python -m benchmarks.correlation --num-samples 2000 --num-columns 6 --bootstrap-resamples 10000 --skip-reference
+"""
+import time
+import argparse
+import warnings
+import numpy as np
+from scipy import stats
+from src.utils.calc_correlation import calc_correlation_matrix, bootstrap_correlation, fill_na_array
+
+
+def reference_correlation_matrix(score_dict: dict, corr_type: str = "spearman"):
+    """The original loop: `fill_na` on Python lists and one scipy call per key pair (lower triangle)."""
+    def fill_na(score_list: list):
+        score_list = [score if isinstance(score, (int, float)) else None for score in score_list]
+        arr = np.array(score_list)
+        value = np.mean(np.delete(arr, np.where(arr == None)))
+        return [value if score is None else score for score in score_list]
+
+    corr_fn = {"spearman": stats.spearmanr, "pearson": stats.pearsonr, "kendall": stats.kendalltau}[corr_type]
+    keys = list(score_dict.keys())
+    correlation_matrix = np.zeros((len(keys), len(keys)))
+    for i, key_1 in enumerate(keys):
+        for j, key_2 in enumerate(keys):
+            if i > j:
+                correlation_matrix[i][j] = corr_fn(fill_na(score_dict[key_1]), fill_na(score_dict[key_2]))[0]
+    return correlation_matrix
+
+
+def reference_bootstrap(score_dict: dict, reference_key: str, corr_type: str, num_resamples: int, seed: int = 0) -> np.ndarray:
+    """One scipy call per resample and key, on the same resamples as `bootstrap_correlation` with a single chunk."""
+    corr_fn = {"spearman": stats.spearmanr, "pearson": stats.pearsonr, "kendall": stats.kendalltau}[corr_type]
+    columns = [fill_na_array(score_dict[key]) for key in score_dict]
+    reference = fill_na_array(score_dict[reference_key])
+    rng = np.random.default_rng(np.random.SeedSequence(seed).spawn(1)[0])
+    indices = rng.integers(0, len(reference), size=(num_resamples, len(reference)))
+    return np.array([[corr_fn(column[index], reference[index])[0] for column in columns] for index in indices])
+
+
+def make_scores(num_samples: int, num_columns: int, na_ratio: float, seed: int = 0) -> dict:
+    rng = np.random.default_rng(seed)
+    latent = rng.normal(size=num_samples)
+    score_dict = {}
+    for i in range(num_columns):
+        scores = np.clip(np.round(3 + latent + rng.normal(scale=1.0, size=num_samples)), 1, 5).astype(int).tolist()
+        for index in np.flatnonzero(rng.random(num_samples) < na_ratio):
+            scores[index] = "N/A"
+        score_dict[f"evaluator_{i}"] = scores
+    return score_dict
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-samples", type=int, default=20000)
+    parser.add_argument("--num-columns", type=int, default=20)
+    parser.add_argument("--na-ratio", type=float, default=0.02)
+    parser.add_argument("--corr-types", type=str, nargs="+", default=["spearman", "pearson", "kendall"])
+    parser.add_argument("--skip-reference", action="store_true", help="only time the columnar implementation")
+    parser.add_argument("--bootstrap-resamples", type=int, default=0)
+    parser.add_argument("--reference-resamples", type=int, default=100, help="resamples of the scipy loop, at most 500")
+    parser.add_argument("--num-workers", type=int, default=None)
+    args = parser.parse_args()
+    warnings.filterwarnings("ignore")
+
+    score_dict = make_scores(args.num_samples, args.num_columns, args.na_ratio)
+    print(f"{args.num_samples} samples x {args.num_columns} evaluators")
+    for corr_type in args.corr_types:
+        start = time.perf_counter()
+        _, correlation_matrix, _ = calc_correlation_matrix(score_dict, corr_type=corr_type)
+        columnar_time = time.perf_counter() - start
+        line = f"{corr_type:<10} columnar: {columnar_time:.3f}s"
+        if not args.skip_reference:
+            start = time.perf_counter()
+            reference_matrix = reference_correlation_matrix(score_dict, corr_type=corr_type)
+            reference_time = time.perf_counter() - start
+            max_diff = np.nanmax(np.abs(np.tril(correlation_matrix, k=-1) - reference_matrix))
+            line += f"  per-pair loop: {reference_time:.3f}s  speedup: {reference_time / columnar_time:.1f}x  max abs diff: {max_diff:.1e}"
+        print(line)
+
+    if args.bootstrap_resamples > 0:
+        reference_key = next(iter(score_dict))
+        for corr_type in args.corr_types:
+            start = time.perf_counter()
+            _, _, resampled = bootstrap_correlation(
+                score_dict, reference_key, corr_type=corr_type, num_resamples=args.bootstrap_resamples, num_workers=args.num_workers
+            )
+            bootstrap_time = time.perf_counter() - start
+            num_reference = min(args.reference_resamples, args.bootstrap_resamples, 500)
+            start = time.perf_counter()
+            reference = reference_bootstrap(score_dict, reference_key, corr_type, num_reference)
+            reference_time = (time.perf_counter() - start) * args.bootstrap_resamples / num_reference
+            max_diff = np.nanmax(np.abs(resampled[:num_reference] - reference))
+            print(f"{corr_type:<10} bootstrap x{args.bootstrap_resamples}: {bootstrap_time:.2f}s  scipy loop (extrapolated): "
+                  f"{reference_time:.1f}s  speedup: {reference_time / bootstrap_time:.1f}x  max abs diff: {max_diff:.1e}")
@@ -0,0 +1,84 @@
+"""Tail latency of the OpenAI-compatible engine against heavy-tailed stub servers, without and with hedged requests.
+
+Every replica draws its latencies from a lognormal distribution (see `benchmarks/stub_server.py`), so that a few
+requests take many times the median. The baseline run waits for every response; the deadline run retries the attempts
+taking more than `--request-timeout` seconds; the hedged run duplicates the requests still unanswered after the
+`--hedge-quantile` latency of their stage to another replica, and keeps the first response. Usage:
+
+    python -m benchmarks.hedging --num-samples 32 --num-replicas 2 --latency 0.05 --latency-std 0.1 --hedge-quantile 0.9
+"""
+import os
+import time
+import argparse
+import tempfile
+import contextlib
+from src.inference.openai_compatible import OpenAICompatibleInferenceEngine, AsyncOpenAICompatibleInferenceEngine
+from benchmarks.common import make_synthetic_dataset, stub_server
+
+
+def run(args, mode: str) -> dict:
+    stub_args = ["--latency-dist", "lognormal", "--latency-mean", str(args.latency), "--latency-std", str(args.latency_std)]
+    with tempfile.TemporaryDirectory() as tmp_dir, contextlib.ExitStack() as stack:
+        urls = [stack.enter_context(stub_server(stub_args + ["--seed", str(index)])) for index in range(args.num_replicas)]
+        data_file = make_synthetic_dataset(os.path.join(tmp_dir, "data"), num_samples=args.num_samples, create_images=True)
+        engine_cls = AsyncOpenAICompatibleInferenceEngine if args.use_async else OpenAICompatibleInferenceEngine
+        engine = engine_cls(
+            data_file=data_file,
+            image_root=os.path.join(tmp_dir, "data"),
+            output_dir=os.path.join(tmp_dir, "output"),
+            max_inflight_questions=args.max_inflight_questions,
+            max_inflight_samples=args.max_inflight_samples,
+            model_init_kwargs=dict(
+                base_url=[f"{url}/v1" for url in urls],
+                model_name="stub",
+                max_retries=args.max_retries,
+                request_timeout=args.request_timeout if mode == "deadline" else None,
+                hedge_quantile=args.hedge_quantile if mode == "hedged" else None,
+                max_hedge_ratio=args.max_hedge_ratio
+            )
+        )
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            engine.inference(granularity="coarse", multi_stage=True, simple_answer_and_eval=True)
+        wall_time = time.perf_counter() - start
+
+    counters = engine.metrics.snapshot()["counters"]
+    requests = sum(stats["requests"] for stats in engine.load_balancer.get_stats()) if engine.load_balancer is not None else None
+    return {
+        "mode": mode,
+        "samples_per_second": counters.get("samples", 0) / wall_time,
+        "p50_sample_latency": engine.metrics.percentile("sample_latency", 50),
+        "p95_sample_latency": engine.metrics.percentile("sample_latency", 95),
+        "p99_sample_latency": engine.metrics.percentile("sample_latency", 99),
+        "p99_request_latency": engine.metrics.percentile("request_latency", 99),
+        "hedged_requests": counters.get("hedged_requests", 0),
+        "hedge_wins": counters.get("hedge_wins", 0),
+        "deadline_exceeded": counters.get("deadline_exceeded", 0),
+        "requests": requests
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-samples", type=int, default=32)
+    parser.add_argument("--num-replicas", type=int, default=2)
+    parser.add_argument("--latency", type=float, default=0.05, help="mean latency of a request on the stub servers")
+    parser.add_argument("--latency-std", type=float, default=0.1, help="standard deviation of the latency, the larger the heavier the tail")
+    parser.add_argument("--request-timeout", type=float, default=0.5, help="deadline of an attempt in the deadline run")
+    parser.add_argument("--hedge-quantile", type=float, default=0.9)
+    parser.add_argument("--max-hedge-ratio", type=float, default=0.1)
+    parser.add_argument("--max-inflight-samples", type=int, default=8)
+    parser.add_argument("--max-inflight-questions", type=int, default=4)
+    parser.add_argument("--max-retries", type=int, default=4)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use the asyncio engine")
+    args = parser.parse_args()
+
+    print(f"{'mode':<10}{'samples/s':>10}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}{'request p99 s':>15}{'extra load':>12}{'hedges':>8}{'wins':>6}{'deadlines':>11}")
+    baseline_requests = None
+    for mode in ("baseline", "deadline", "hedged"):
+        result = run(args, mode=mode)
+        baseline_requests = baseline_requests or result["requests"]
+        extra_load = f"{(result['requests'] / baseline_requests - 1) * 100:+.1f}%" if baseline_requests else "-"
+        print(f"{result['mode']:<10}{result['samples_per_second']:>10.2f}{result['p50_sample_latency']:>8.2f}"
+              f"{result['p95_sample_latency']:>8.2f}{result['p99_sample_latency']:>8.2f}{result['p99_request_latency']:>15.3f}"
+              f"{extra_load:>12}{result['hedged_requests']:>8}{result['hedge_wins']:>6}{result['deadline_exceeded']:>11}")
@@ -0,0 +1,178 @@
+"""Micro-benchmark of `json_to_markdown` against the original recursive renderer, on the structures rendered into the
+prompts of a sample: the structure information, the per-entity question lists and the overall evaluation block. The
+per-sample `RenderCache` is timed on the same renders, with a fresh cache for each of `--samples` simulated samples
+in which every structure is rendered `--renders-per-sample` times (by default the number of questions of the sample,
+about as often as the pipeline renders the structure information).
+
+The outputs of all renderers are checked to be identical. Usage:
+
+    python -m benchmarks.json_to_markdown --repeat 5
+"""
+import time
+import argparse
+from src.utils import md_parser
+from src.inference.mock import MOCK_EXTRACT_RESPONSE
+from src.inference.inference_engine import add_line_sep_before_title, EXTRACT_STRUCTURE_TEMPLATE
+
+
+def reference_json_to_markdown(
+    struct,
+    title_level: int = 0,
+    list_level: int = 0,
+    from_list: bool = False,
+    is_overall_eval: bool = False,
+    ignore_score: bool = False,
+):
+    """The original renderer: recursive string concatenation through intermediate lists."""
+    if isinstance(struct, dict) and not is_overall_eval:
+        text = ""
+        if "question" in struct and "value" in struct:
+            if not ignore_score:
+                new_struct = (
+                    [
+                        f"question: {struct['question']}",
+                        [f"{key}: {value}" for key, value in struct["value"].items()],
+                    ]
+                    if struct["value"] is not None
+                    else [f"question: {struct['question']}"]
+                )
+            else:
+                new_struct = (
+                    [
+                        f"question: {struct['question']}",
+                        [
+                            f"{key}: {value}"
+                            for key, value in struct["value"].items()
+                            if key != "score" and key != "manual_score"
+                        ],
+                    ]
+                    if struct["value"] is not None
+                    else [f"question: {struct['question']}"]
+                )
+            text += reference_json_to_markdown(
+                new_struct,
+                title_level=title_level,
+                list_level=list_level - 1 if from_list else list_level,
+                ignore_score=ignore_score,
+            )
+        else:
+            for key, value in struct.items():
+                if value is not None:
+                    sub_text = reference_json_to_markdown(
+                        value,
+                        title_level=title_level + 1,
+                        list_level=list_level,
+                        ignore_score=ignore_score,
+                    )
+                    text += f"{'#' * (title_level + 1)} {key}\n"
+                    text += sub_text
+        return text
+    elif isinstance(struct, list):
+        text = ""
+        for item in struct:
+            sub_text = reference_json_to_markdown(
+                item,
+                title_level=title_level,
+                list_level=list_level + 1,
+                from_list=True,
+                ignore_score=ignore_score,
+            )
+            if isinstance(item, list) or isinstance(item, dict):
+                text += f"{sub_text}"
+            else:
+                text += f"{'    ' * (list_level)}- {sub_text}\n"
+        return text
+    elif isinstance(struct, dict) and is_overall_eval:
+        new_struct = []
+        for key, value in struct.items():
+            new_struct.append(key)
+            if isinstance(value, dict):
+                if not ignore_score:
+                    new_struct.append(
+                        [f"{_key}: {_value}" for _key, _value in value.items()]
+                    )
+                else:
+                    new_struct.append(
+                        [
+                            f"{_key}: {_value}"
+                            for _key, _value in value.items()
+                            if _key != "score" and key != "manual_score"
+                        ]
+                    )
+            else:
+                new_struct.append([f"explanation: N/A", f"score: N/A"])
+        return reference_json_to_markdown(new_struct, ignore_score=ignore_score)
+    else:
+        return str(struct)
+
+
+def get_structure_info() -> dict:
+    structure_info, _ = md_parser.parse_structured_markdown(
+        markdown=add_line_sep_before_title(MOCK_EXTRACT_RESPONSE),
+        target_structure=EXTRACT_STRUCTURE_TEMPLATE,
+        strict_questions=False
+    )
+    return structure_info
+
+
+def count_questions(structure_info: dict) -> int:
+    questions = structure_info["Questions"]
+    return sum(len(q_list) for q_list in questions["Appearance Quality Questions"].values()) \
+        + sum(len(q_list) for q_list in questions["Intrinsic Attribute Consistency Questions"].values()) \
+        + len(questions["Relationship Attribute Consistency Questions"])
+
+
+def get_render_calls(structure_info: dict) -> list:
+    calls = [(structure_info, {}), (structure_info, dict(ignore_score=True))]
+    for entity, questions in structure_info["Questions"]["Appearance Quality Questions"].items():
+        calls.append(({"Evaluation": {entity: questions}}, dict(ignore_score=True)))
+        calls.append(({"Evaluation": {entity: questions}}, {}))
+    overall = {
+        "Appearance Quality Summary": {"explanation": "good", "score": 4},
+        "Intrinsic Attribute Consistency Summary": {"explanation": "fine", "score": 3},
+        "Relationship Attribute Consistency Summary": None,
+        "Overall Score": {"explanation": "ok", "score": 3.5},
+    }
+    calls += [(overall, dict(is_overall_eval=True)), (overall, dict(is_overall_eval=True, ignore_score=True))]
+    return calls
+
+
+def time_renderer(make_render_fn, calls: list, samples: int, renders_per_sample: int, repeat: int) -> tuple:
+    """Best time over `repeat` runs of `samples` simulated samples, `make_render_fn()` gives the renderer of a sample."""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(samples):
+            render_fn = make_render_fn()
+            for _ in range(renders_per_sample):
+                results = [render_fn(struct, **kwargs) for struct, kwargs in calls]
+        best = min(best, time.perf_counter() - start)
+    return best, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--samples", type=int, default=200, help="simulated samples per run, each with a fresh RenderCache")
+    parser.add_argument("--renders-per-sample", type=int, default=None, help="times every structure is rendered per sample, the number of questions by default")
+    args = parser.parse_args()
+
+    structure_info = get_structure_info()
+    calls = get_render_calls(structure_info)
+    renders_per_sample = args.renders_per_sample or count_questions(structure_info)
+    num_renders = len(calls) * renders_per_sample * args.samples
+    timing_kwargs = dict(calls=calls, samples=args.samples, renders_per_sample=renders_per_sample, repeat=args.repeat)
+    reference_time, reference_results = time_renderer(lambda: reference_json_to_markdown, **timing_kwargs)
+    streaming_time, streaming_results = time_renderer(lambda: md_parser.json_to_markdown, **timing_kwargs)
+    names = {id(struct): f"struct-{i}" for i, (struct, _) in enumerate(calls)}
+
+    def make_cached_render_fn():
+        render_cache = md_parser.RenderCache()
+        return lambda struct, **kwargs: render_cache.render(names[id(struct)], struct, **kwargs)
+
+    cached_time, cached_results = time_renderer(make_cached_render_fn, **timing_kwargs)
+
+    assert reference_results == streaming_results == cached_results, "rendering results differ"
+    print(f"{num_renders} renders ({args.samples} samples, {renders_per_sample} renders of each structure per sample), best of {args.repeat} runs, identical results")
+    for name, total_time in [("reference", reference_time), ("json_to_markdown", streaming_time), ("RenderCache", cached_time)]:
+        print(f"{name + ':':<25}{total_time * 1000:>8.1f} ms ({total_time / num_renders * 1e6:.1f} us/render, {reference_time / total_time:.2f}x)")
@@ -0,0 +1,104 @@
+"""Throughput of the OpenAI-compatible engine over one and over `--num-replicas` stub servers, with replica failures.
+
+Every replica serves `--capacity` requests at once (see `benchmarks/stub_server.py`). With `--failing-replica`, one
+more replica answers 503 to every request and must be ejected; with `--outage-after`, the first replica is stopped
+after that many seconds and restarted `--outage-duration` seconds later on the same port, and must be ejected and then
+re-admitted by the health checks. Usage:
+
+    python -m benchmarks.load_balancing --num-samples 32 --num-replicas 3 --failing-replica --outage-after 2 --outage-duration 3
+"""
+import os
+import time
+import argparse
+import tempfile
+import threading
+import contextlib
+from src.inference.openai_compatible import OpenAICompatibleInferenceEngine, AsyncOpenAICompatibleInferenceEngine
+from benchmarks.common import make_synthetic_dataset, stub_server, get_free_port
+
+
+def run_replica_with_outage(stub_args: list, port: int, outage_after: float, outage_duration: float, ready: threading.Event, stopped: threading.Event):
+    with stub_server(stub_args, port=port):
+        ready.set()
+        if stopped.wait(outage_after):
+            return
+    if stopped.wait(outage_duration):
+        return
+    with stub_server(stub_args, port=port):
+        stopped.wait()
+
+
+def run(args, num_replicas: int, failing_replica: bool, outage_after: float) -> dict:
+    stub_args = ["--latency-dist", "uniform", "--latency-mean", str(args.latency), "--latency-std", str(args.latency / 2), "--capacity", str(args.capacity)]
+    stopped = threading.Event()
+    with tempfile.TemporaryDirectory() as tmp_dir, contextlib.ExitStack() as stack:
+        urls = []
+        if outage_after is not None:
+            port = get_free_port()
+            ready = threading.Event()
+            replica = threading.Thread(target=run_replica_with_outage, args=(stub_args, port, outage_after, args.outage_duration, ready, stopped))
+            replica.start()
+            stack.callback(replica.join)
+            stack.callback(stopped.set)
+            ready.wait()
+            urls.append(f"http://127.0.0.1:{port}")
+        while len(urls) < num_replicas:
+            urls.append(stack.enter_context(stub_server(stub_args)))
+        if failing_replica:
+            urls.append(stack.enter_context(stub_server(stub_args + ["--error-rate", "1.0", "--error-codes", "503"])))
+
+        data_file = make_synthetic_dataset(os.path.join(tmp_dir, "data"), num_samples=args.num_samples, create_images=True)
+        engine_cls = AsyncOpenAICompatibleInferenceEngine if args.use_async else OpenAICompatibleInferenceEngine
+        engine = engine_cls(
+            data_file=data_file,
+            image_root=os.path.join(tmp_dir, "data"),
+            output_dir=os.path.join(tmp_dir, "output"),
+            max_inflight_questions=args.max_inflight_questions,
+            max_inflight_samples=args.max_inflight_samples,
+            model_init_kwargs=dict(
+                base_url=[f"{url}/v1" for url in urls],
+                model_name="stub",
+                max_retries=args.max_retries,
+                health_check_interval=args.health_check_interval
+            )
+        )
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            engine.inference(granularity="coarse", multi_stage=True, simple_answer_and_eval=True)
+        wall_time = time.perf_counter() - start
+
+    num_samples = engine.metrics.snapshot()["counters"].get("samples", 0)
+    balancer = engine.load_balancer
+    return {
+        "replicas": len(urls),
+        "samples_per_second": num_samples / wall_time,
+        "endpoints": balancer.get_stats() if balancer is not None else [],
+        "affinity_hit_rate": balancer.affinity_hits / max(balancer.affinity_hits + balancer.affinity_misses, 1) if balancer is not None else None
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-samples", type=int, default=32)
+    parser.add_argument("--num-replicas", type=int, default=3, help="healthy replicas")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean service time of a request on the stub servers")
+    parser.add_argument("--capacity", type=int, default=4, help="requests served at once by each stub server")
+    parser.add_argument("--failing-replica", action="store_true", help="add a replica answering 503 to every request")
+    parser.add_argument("--outage-after", type=float, default=None, help="seconds after which the first replica is stopped")
+    parser.add_argument("--outage-duration", type=float, default=3.0)
+    parser.add_argument("--health-check-interval", type=float, default=1.0)
+    parser.add_argument("--max-inflight-samples", type=int, default=16)
+    parser.add_argument("--max-inflight-questions", type=int, default=4)
+    parser.add_argument("--max-retries", type=int, default=8)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use the asyncio engine")
+    args = parser.parse_args()
+
+    single = run(args, num_replicas=1, failing_replica=False, outage_after=None)
+    print(f"1 replica: {single['samples_per_second']:.2f} samples/s")
+    result = run(args, num_replicas=args.num_replicas, failing_replica=args.failing_replica, outage_after=args.outage_after)
+    print(f"{result['replicas']} replicas: {result['samples_per_second']:.2f} samples/s "
+          f"({result['samples_per_second'] / single['samples_per_second']:.2f}x), "
+          f"{round(result['affinity_hit_rate'] * 100, 1)}% of the requests on the preferred replica of their sample")
+    for stats in result["endpoints"]:
+        print(f"  {stats['url']}: {stats['requests']} requests, {stats['failures']} failures, {stats['ejections']} ejections"
+              f"{' (ejected at the end)' if stats['ejected'] else ''}")
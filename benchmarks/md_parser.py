@@ -0,0 +1,136 @@
+"""Micro-benchmark of the parsing of extract responses: markdown parsing with `markdown_to_json` and with the native
+`markdown_to_dict`, and `parse_structured_data` with the key matcher before and after the fast path.
+
+Responses are read from the `extract-result.jsonl` of `--result-dir`, or default to the mock extract response. The
+outputs of the two markdown parsers and of the two matchers are checked to be identical. Usage:
+
+    python -m benchmarks.md_parser --result-dir output/minicpm-v-2_6 --repeat 5
+"""
+import os
+import json
+import time
+import argparse
+import numpy as np
+import markdown_to_json
+from difflib import SequenceMatcher
+from src.utils import md_parser
+from src.inference.mock import MOCK_EXTRACT_RESPONSE
+from src.inference.inference_engine import add_line_sep_before_title, EXTRACT_STRUCTURE_TEMPLATE
+
+
+def dense_get_best_match(source, target, path: str = None, mismatch_log: dict = None):
+    """The original matcher: `quick_ratio` for every source/target key pair."""
+    sim_matrix = np.zeros([len(source), len(target)])
+    for i, src_key in enumerate(source):
+        for j, tgt_key in enumerate(target):
+            sim_matrix[i][j] = SequenceMatcher(
+                None, a=src_key.strip().lower(), b=tgt_key.strip().lower()
+            ).quick_ratio()
+
+    src_best_match_indices = np.argmax(sim_matrix, axis=1)
+    tgt_best_match_indices = np.argmax(sim_matrix, axis=0)
+    src_match = [(i, tgt) for i, tgt in enumerate(src_best_match_indices)]
+    tgt_match = [(src, i) for i, src in enumerate(tgt_best_match_indices)]
+    match_pairs = list(set(src_match) & set(tgt_match))
+    match_pairs = sorted(match_pairs, key=lambda s: s[1])
+
+    match_result = []
+    for src_idx, tgt_idx in match_pairs:
+        src_key = source[src_idx]
+        tgt_key = target[tgt_idx]
+        if sim_matrix[src_idx][tgt_idx] < 0.9 and mismatch_log is not None:
+            mismatch_log["imperfect_match"].append(
+                {
+                    "path": path,
+                    "src_key": src_key,
+                    "tgt_key": tgt_key,
+                    "similarity": sim_matrix[src_idx][tgt_idx],
+                }
+            )
+            mismatch_log["error"] = True
+        match_result.append([src_key, tgt_key])
+    return match_result
+
+
+def load_responses(result_dir: str) -> list:
+    if result_dir is None:
+        return [MOCK_EXTRACT_RESPONSE]
+    responses = []
+    with open(os.path.join(result_dir, "extract-result.jsonl"), "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                responses.append(json.loads(line)["response"])
+    return responses
+
+
+def parse_all(structured_responses: list) -> list:
+    results = []
+    for structured_response in structured_responses:
+        try:
+            results.append(md_parser.parse_structured_data(
+                structured_data=structured_response, target_structure=EXTRACT_STRUCTURE_TEMPLATE, strict_questions=False
+            ))
+        except Exception as e:
+            results.append(repr(e))
+    return results
+
+
+def time_markdown_parser(parse_fn, responses: list, repeat: int) -> tuple:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [parse_fn(response) for response in responses]
+        best = min(best, time.perf_counter() - start)
+    return best, results
+
+
+def count_fallbacks(responses: list) -> int:
+    num_fallbacks = 0
+    for response in responses:
+        try:
+            md_parser._MarkdownBlockParser().parse(response)
+        except md_parser._UnsupportedMarkdown:
+            num_fallbacks += 1
+    return num_fallbacks
+
+
+def time_matcher(matcher, structured_responses: list, repeat: int) -> tuple:
+    md_parser._get_best_match = matcher
+    md_parser._get_key_profile.cache_clear()
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = parse_all(structured_responses)
+        best = min(best, time.perf_counter() - start)
+    return best, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--result-dir", type=str, default=None, help="output directory of a previous run")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--copies", type=int, default=200, help="times the default response is repeated without --result-dir")
+    args = parser.parse_args()
+
+    responses = load_responses(args.result_dir)
+    if args.result_dir is None:
+        responses = responses * args.copies
+    responses = [add_line_sep_before_title(response) for response in responses]
+
+    library_time, library_results = time_markdown_parser(lambda response: json.loads(markdown_to_json.jsonify(response)), responses, args.repeat)
+    native_time, structured_responses = time_markdown_parser(md_parser.markdown_to_dict, responses, args.repeat)
+    assert library_results == structured_responses, "markdown parsing results differ"
+    print(f"{len(responses)} extract responses, best of {args.repeat} runs, identical results, {count_fallbacks(responses)} parsed by markdown_to_json")
+    print(f"markdown_to_json:  {library_time * 1000:.1f} ms ({library_time / len(responses) * 1e6:.1f} us/response)")
+    print(f"markdown_to_dict:  {native_time * 1000:.1f} ms ({native_time / len(responses) * 1e6:.1f} us/response)")
+    print(f"speedup: {library_time / native_time:.2f}x\n")
+
+    fast_get_best_match = md_parser._get_best_match
+    dense_time, dense_results = time_matcher(dense_get_best_match, structured_responses, args.repeat)
+    fast_time, fast_results = time_matcher(fast_get_best_match, structured_responses, args.repeat)
+    md_parser._get_best_match = fast_get_best_match
+
+    assert repr(dense_results) == repr(fast_results), "parsing results differ"
+    print(f"dense quick_ratio matcher: {dense_time * 1000:.1f} ms ({dense_time / len(responses) * 1e6:.1f} us/response)")
+    print(f"fast path matcher:         {fast_time * 1000:.1f} ms ({fast_time / len(responses) * 1e6:.1f} us/response)")
+    print(f"speedup: {dense_time / fast_time:.2f}x")
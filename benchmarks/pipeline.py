@@ -0,0 +1,150 @@
+"""End-to-end throughput of the inference pipelines against the mock engine, no GPU or server needed.
+
+Every configuration runs in a fresh subprocess (so that peak RSS is its own) on a synthetic dataset, and reports
+samples/s, requests/sample, the split of CPU time between pipeline work (markdown parsing and rendering, prompt
+formatting, score extraction), result I/O and model calls, the wall time spent waiting for the model, and peak RSS.
+Usage:
+
+    python -m benchmarks.pipeline --num-samples 64 --latency 0.01 --max-inflight-samples 8 --output bench.json
+    python -m benchmarks.pipeline --baseline bench.json --max-regression 0.1
+
+With `--baseline`, the exit code is 1 if the throughput of any configuration dropped by more than `--max-regression`.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import contextlib
+import subprocess
+from src.inference.mock import MockInferenceEngine
+from benchmarks.common import make_synthetic_dataset
+
+
+CONFIGS = {
+    "coarse": dict(granularity="coarse", multi_stage=True, separate_aspects=True, simple_answer_and_eval=True),
+    "coarse-single-stage": dict(granularity="coarse", multi_stage=False, separate_aspects=True, simple_answer_and_eval=True),
+    "coarse-joint-aspects": dict(granularity="coarse", multi_stage=True, separate_aspects=False, simple_answer_and_eval=True),
+    "coarse-single-stage-joint-aspects": dict(granularity="coarse", multi_stage=False, separate_aspects=False, simple_answer_and_eval=True),
+    "coarse-templated": dict(granularity="coarse", multi_stage=True, separate_aspects=True, simple_answer_and_eval=False),
+    "coarse-single-stage-templated": dict(granularity="coarse", multi_stage=False, separate_aspects=True, simple_answer_and_eval=False),
+    "coarse-ablation-1": dict(granularity="coarse", multi_stage=True, separate_aspects=False, ablation=1, simple_answer_and_eval=True),
+    "coarse-ablation-2": dict(granularity="coarse", multi_stage=True, separate_aspects=True, ablation=2, simple_answer_and_eval=True),
+    "fine": dict(granularity="fine", multi_stage=True, separate_aspects=True, simple_answer_and_eval=True),
+    "fine-single-stage": dict(granularity="fine", multi_stage=False, separate_aspects=True, simple_answer_and_eval=True),
+    "fine-summarize": dict(granularity="fine", multi_stage=True, separate_aspects=True, fine_grained_do_summarize=True, simple_answer_and_eval=True),
+    "fine-templated": dict(granularity="fine", multi_stage=True, separate_aspects=True, simple_answer_and_eval=False),
+}
+
+
+def run_config(args, config_name: str) -> dict:
+    inference_kwargs = CONFIGS[config_name]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_file = make_synthetic_dataset(os.path.join(tmp_dir, "data"), num_samples=args.num_samples)
+        engine = MockInferenceEngine(
+            data_file=data_file,
+            image_root=os.path.join(tmp_dir, "data"),
+            output_dir=os.path.join(tmp_dir, "output"),
+            max_inflight_questions=args.max_inflight_questions,
+            max_inflight_samples=args.max_inflight_samples,
+            max_batch_size=args.max_batch_size,
+            model_init_kwargs=dict(latency=args.latency, latency_jitter=args.latency_jitter)
+        )
+
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            if args.use_async:
+                asyncio.run(engine.ainference(**inference_kwargs))
+            else:
+                engine.inference(**inference_kwargs)
+        wall_time = time.perf_counter() - start_wall
+        cpu_time = time.process_time() - start_cpu
+
+    metrics = engine.metrics.snapshot()
+    num_samples = metrics["counters"].get("samples", 0)
+    io_cpu = metrics["cpu_times"].get("io", 0.0)
+    model_cpu = metrics["cpu_times"].get("wait", 0.0)
+    return {
+        "config": config_name,
+        "samples": num_samples,
+        "wall_time": wall_time,
+        "samples_per_second": num_samples / wall_time,
+        "requests_per_sample": metrics["counters"].get("requests", 0) / max(num_samples, 1),
+        "cpu_time": cpu_time,
+        # CPU time not spent in model calls or result I/O is the pipeline itself, mostly markdown parsing and rendering
+        "parse_cpu_time": max(cpu_time - io_cpu - model_cpu, 0.0),
+        "io_cpu_time": io_cpu,
+        "model_cpu_time": model_cpu,
+        "io_wall_time": metrics["wall_times"].get("io", 0.0),
+        "wait_wall_time": metrics["wall_times"].get("wait", 0.0),
+        "render_cache_hits": metrics["counters"].get("render_cache_hits", 0),
+        "render_cache_misses": metrics["counters"].get("render_cache_misses", 0),
+        "p99_sample_latency": engine.metrics.percentile("sample_latency", 99),
+        # kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+
+def run_in_subprocess(args, config_name: str) -> dict:
+    command = [sys.executable, "-m", "benchmarks.pipeline", "--run-config", config_name] + sys.argv[1:]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().split("\n")[-1])
+
+
+def print_results(results: list):
+    header = f"{'config':<36}{'samples/s':>10}{'req/sample':>11}{'cpu s':>8}{'parse s':>9}{'io s':>7}{'model s':>9}{'wait s':>9}{'p99 s':>8}{'rss MB':>8}"
+    print(header)
+    for result in results:
+        print(f"{result['config']:<36}{result['samples_per_second']:>10.2f}{result['requests_per_sample']:>11.1f}"
+              f"{result['cpu_time']:>8.2f}{result['parse_cpu_time']:>9.2f}{result['io_cpu_time']:>7.2f}"
+              f"{result['model_cpu_time']:>9.2f}{result['wait_wall_time']:>9.2f}{result['p99_sample_latency']:>8.2f}{result['peak_rss_mb']:>8.1f}")
+
+
+def check_regression(results: list, baseline_file: str, max_regression: float) -> bool:
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        baseline = {result["config"]: result for result in json.load(f)["results"]}
+    passed = True
+    for result in results:
+        if result["config"] not in baseline:
+            continue
+        reference = baseline[result["config"]]["samples_per_second"]
+        change = result["samples_per_second"] / reference - 1
+        if change < -max_regression:
+            passed = False
+            print(f"[!] regression in {result['config']}: {reference:.2f} -> {result['samples_per_second']:.2f} samples/s ({change * 100:.1f}%)")
+    return passed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--configs", type=str, nargs="+", default=list(CONFIGS), choices=list(CONFIGS))
+    parser.add_argument("--num-samples", type=int, default=32)
+    parser.add_argument("--latency", type=float, default=0.0, help="mean simulated latency of a request in seconds")
+    parser.add_argument("--latency-jitter", type=float, default=0.5)
+    parser.add_argument("--max-inflight-questions", type=int, default=1)
+    parser.add_argument("--max-inflight-samples", type=int, default=1)
+    parser.add_argument("--max-batch-size", type=int, default=1)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="run `ainference` on an event loop")
+    parser.add_argument("--output", type=str, default=None, help="dump the results to a json file")
+    parser.add_argument("--baseline", type=str, default=None, help="results of a previous run to compare with")
+    parser.add_argument("--max-regression", type=float, default=0.1)
+    parser.add_argument("--run-config", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_config is not None:
+        print(json.dumps(run_config(args, args.run_config)))
+        sys.exit(0)
+
+    results = [run_in_subprocess(args, config_name) for config_name in args.configs]
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "run_config")}, "results": results}, f, indent=4)
+
+    if args.baseline is not None and not check_regression(results, args.baseline, args.max_regression):
+        sys.exit(1)
@@ -0,0 +1,101 @@
+"""Prefill work per sample with and without prefix-friendly request ordering.
+
+The mock engine is driven by the batched driver and every issued prompt goes through a simulated automatic prefix cache
+(block hashes of the flattened prompt, LRU over a fixed number of blocks, as in vLLM). Usage:
+
+    python -m benchmarks.prefix_cache --num-samples 64 --max-batch-size 16 --max-inflight-samples 8
+"""
+import os
+import argparse
+import tempfile
+import contextlib
+from typing import List
+from collections import OrderedDict
+from src.inference.mock import MockInferenceEngine
+from src.inference.inference_engine import ChatRequest
+from benchmarks.common import make_synthetic_dataset
+
+
+class SimulatedPrefixCache:
+    def __init__(self, block_size: int, num_blocks: int) -> None:
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        self.blocks = OrderedDict()
+        self.prefilled_chars = 0
+        self.cached_chars = 0
+
+    def prefill(self, text: str):
+        num_full_blocks = len(text) // self.block_size
+        keys = [hash(text[:(i + 1) * self.block_size]) for i in range(num_full_blocks)]
+        num_hit = 0
+        while num_hit < num_full_blocks and keys[num_hit] in self.blocks:
+            num_hit += 1
+        for key in keys:
+            self.blocks[key] = True
+            self.blocks.move_to_end(key)
+        while len(self.blocks) > self.num_blocks:
+            self.blocks.popitem(last=False)
+        self.cached_chars += num_hit * self.block_size
+        self.prefilled_chars += len(text) - num_hit * self.block_size
+
+
+class PrefixCacheMockEngine(MockInferenceEngine):
+    def init_model(self, block_size: int = 64, num_blocks: int = 4096, **kwargs):
+        super().init_model(**kwargs)
+        self.prefix_cache = SimulatedPrefixCache(block_size=block_size, num_blocks=num_blocks)
+
+    def chat_batch(self, requests: List[ChatRequest]) -> List[tuple]:
+        for request in requests:
+            self.prefix_cache.prefill(self.prompt_layout(request))
+        return super().chat_batch(requests)
+
+
+def run(args, prefix_ordering: bool) -> dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        data_file = make_synthetic_dataset(os.path.join(tmp_dir, "data"), num_samples=args.num_samples)
+        engine = PrefixCacheMockEngine(
+            data_file=data_file,
+            image_root=os.path.join(tmp_dir, "data"),
+            output_dir=os.path.join(tmp_dir, "output"),
+            max_inflight_samples=args.max_inflight_samples,
+            max_batch_size=args.max_batch_size,
+            prefix_ordering=prefix_ordering,
+            track_prefix_stats=True,
+            model_init_kwargs=dict(block_size=args.block_size, num_blocks=args.num_blocks)
+        )
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            engine.inference(granularity=args.granularity, multi_stage=True, simple_answer_and_eval=True, separate_aspects=True)
+
+    cache = engine.prefix_cache
+    stats = engine.prefix_stats.get_stats()
+    total_chars = sum(stage["chars"] for stage in stats.values())
+    total_shared = sum(stage["shared_chars"] for stage in stats.values())
+    return {
+        "prefilled_chars_per_sample": cache.prefilled_chars / args.num_samples,
+        "cache_hit_ratio": cache.cached_chars / max(cache.cached_chars + cache.prefilled_chars, 1),
+        "shared_prefix_ratio": total_shared / max(total_chars, 1),
+        "stage_stats": engine.prefix_stats
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-samples", type=int, default=64)
+    parser.add_argument("--granularity", type=str, default="coarse", choices=["coarse", "fine"])
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-inflight-samples", type=int, default=8)
+    parser.add_argument("--block-size", type=int, default=64, help="characters per simulated cache block")
+    parser.add_argument("--num-blocks", type=int, default=2048, help="capacity of the simulated prefix cache in blocks")
+    parser.add_argument("--chars-per-token", type=float, default=4.0, help="used to estimate tokens from characters")
+    parser.add_argument("--verbose", action="store_true", help="print the shared prefix ratio of each stage")
+    args = parser.parse_args()
+
+    results = {"arrival order": run(args, prefix_ordering=False), "prefix ordering": run(args, prefix_ordering=True)}
+
+    print(f"{'':<18}{'prefilled chars/sample':>24}{'~tokens/sample':>16}{'cache hit':>12}{'shared prefix':>15}")
+    for name, result in results.items():
+        print(f"{name:<18}{round(result['prefilled_chars_per_sample']):>24}{round(result['prefilled_chars_per_sample'] / args.chars_per_token):>16}"
+              f"{round(result['cache_hit_ratio'] * 100, 2):>11}%{round(result['shared_prefix_ratio'] * 100, 2):>14}%")
+    if args.verbose:
+        for name, result in results.items():
+            print(f"\n# {name}\n{result['stage_stats'].format()}")
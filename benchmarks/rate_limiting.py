@@ -0,0 +1,92 @@
+"""Throughput of the OpenAI-compatible engine against a stub server with requests and tokens per minute limits.
+
+The stub server (`benchmarks/stub_server.py`) answers 429 to the requests beyond `--rpm` and `--tpm`, like a hosted
+API. The unlimited run sends as fast as the drivers allow and relies on the retries; the rate limited run paces the
+requests to the same budgets on the client. Usage:
+
+    python -m benchmarks.rate_limiting --num-samples 16 --rpm 1200 --tpm 300000 --max-inflight-samples 16
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import contextlib
+import urllib.request
+from src.inference.openai_compatible import OpenAICompatibleInferenceEngine, AsyncOpenAICompatibleInferenceEngine
+from benchmarks.common import make_synthetic_dataset, stub_server
+
+
+def run(args, rate_limited: bool) -> dict:
+    stub_args = ["--latency-dist", "uniform", "--latency-mean", str(args.latency), "--latency-std", str(args.latency / 2),
+                 "--rpm", str(args.rpm), "--tpm", str(args.tpm), "--rate-burst", str(args.rate_burst)]
+    with tempfile.TemporaryDirectory() as tmp_dir, stub_server(stub_args) as url:
+        data_file = make_synthetic_dataset(os.path.join(tmp_dir, "data"), num_samples=args.num_samples, create_images=True)
+        engine_cls = AsyncOpenAICompatibleInferenceEngine if args.use_async else OpenAICompatibleInferenceEngine
+        engine = engine_cls(
+            data_file=data_file,
+            image_root=os.path.join(tmp_dir, "data"),
+            output_dir=os.path.join(tmp_dir, "output"),
+            max_inflight_questions=args.max_inflight_questions,
+            max_inflight_samples=args.max_inflight_samples,
+            model_init_kwargs=dict(
+                base_url=f"{url}/v1",
+                max_retries=args.max_retries,
+                requests_per_minute=args.rpm if rate_limited else None,
+                tokens_per_minute=args.tpm if rate_limited else None
+            )
+        )
+        error = None
+        start = time.perf_counter()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            try:
+                if args.use_async:
+                    asyncio.run(engine.ainference(granularity="coarse", multi_stage=True, simple_answer_and_eval=True))
+                else:
+                    engine.inference(granularity="coarse", multi_stage=True, simple_answer_and_eval=True)
+            except Exception as e:
+                error = type(e).__name__
+        wall_time = time.perf_counter() - start
+
+        with urllib.request.urlopen(f"{url}/stats") as response:
+            server_stats = json.load(response)
+
+    num_samples = engine.metrics.snapshot()["counters"].get("samples", 0)
+    served = server_stats["requests"] - server_stats["rejected"]
+    return {
+        "mode": "limited" if rate_limited else "unlimited",
+        "error": error,
+        "samples_per_second": num_samples / wall_time,
+        "served": served,
+        "rejected": server_stats["rejected"],
+        "requests_per_minute": served / wall_time * 60,
+        "tokens_per_minute": server_stats["tokens"] / wall_time * 60,
+        "limiter": engine.rate_limiter.get_stats() if engine.rate_limiter is not None else None
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-samples", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.05, help="mean service time of a request on the stub server")
+    parser.add_argument("--rpm", type=float, default=1200, help="requests per minute allowed by the stub server and the client")
+    parser.add_argument("--tpm", type=float, default=300000, help="tokens per minute allowed by the stub server and the client")
+    parser.add_argument("--rate-burst", type=float, default=1.0, help="seconds of the budgets the stub server lets through at once")
+    parser.add_argument("--max-inflight-samples", type=int, default=16)
+    parser.add_argument("--max-inflight-questions", type=int, default=4)
+    parser.add_argument("--max-retries", type=int, default=8)
+    parser.add_argument("--async", dest="use_async", action="store_true", help="use the asyncio engine")
+    args = parser.parse_args()
+
+    print(f"{'mode':<11}{'samples/s':>10}{'served':>8}{'429s':>7}{'requests/min':>14}{'tokens/min':>12}{'delayed':>9}{'wait s':>8}")
+    for rate_limited in (False, True):
+        result = run(args, rate_limited=rate_limited)
+        limiter = result["limiter"]
+        line = (f"{result['mode']:<11}{result['samples_per_second']:>10.2f}{result['served']:>8}{result['rejected']:>7}"
+                f"{result['requests_per_minute']:>14.0f}{result['tokens_per_minute']:>12.0f}"
+                f"{str(limiter['delayed'] if limiter is not None else '-'):>9}"
+                f"{str(round(limiter['wait_time'], 1) if limiter is not None else '-'):>8}")
+        if result["error"] is not None:
+            line += f"  failed with {result['error']}"
+        print(line)
@@ -0,0 +1,276 @@
+"""OpenAI-compatible chat completions stub replaying the responses of a previous run, for load tests without GPUs.
+
+Responses are looked up by the hash of the conversation text (images removed) in the `*-result.jsonl` files of
+`--result-dir`. Conversations that were not recorded get the canned response of the mock engine. Every request waits
+for a latency drawn from `--latency-dist` and fails with one of `--error-codes` with probability `--error-rate`.
+
+With `--capacity`, at most that many requests are served at once and the others queue, like the running batch of a
+vLLM server: latencies rise with the load. Requests arriving with `--max-queue` requests already queued get a 429.
+With `--rpm` and `--tpm`, requests beyond the requests and tokens per minute budgets get a 429 with a retry-after, like
+a hosted API: the budgets are token buckets holding `--rate-burst` seconds of them, prompt tokens are charged on arrival
+and completion tokens once the response is generated. Usage:
+
+    python -m benchmarks.stub_server --result-dir output/minicpm-v-2_6 --port 8000 --latency-dist lognormal --latency-mean 1.0
+    python -m benchmarks.stub_server --port 8000 --latency-mean 0.2 --capacity 16 --max-queue 32
+    python -m benchmarks.stub_server --port 8000 --latency-mean 0.5 --rpm 500 --tpm 30000
+    python t2i_eval.py --service-url http://localhost:8000/v1 ...
+"""
+import os
+import math
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src.inference.mock import mock_response
+
+
+IMAGE_PLACEHOLDERS = ['<ImageHere>', '<ImagePlaceholder>']
+
+
+def conversation_key(texts: list) -> str:
+    normalized = []
+    for text in texts:
+        for placeholder in IMAGE_PLACEHOLDERS:
+            text = text.replace(placeholder, '')
+        normalized.append(text.strip())
+    return hashlib.sha1(json.dumps(normalized, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def load_recorded_responses(result_dir: str) -> dict:
+    responses = {}
+    for file in sorted(os.listdir(result_dir)):
+        if not file.endswith('-result.jsonl'):
+            continue
+        with open(os.path.join(result_dir, file), 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if not isinstance(record.get('query'), str) or not isinstance(record.get('response'), str):
+                    continue
+                # `history` holds the previous turns of the conversation as (query, response) pairs
+                texts = [text for turn in record.get('history') or [] for text in turn] + [record['query']]
+                responses[conversation_key(texts)] = record['response']
+    return responses
+
+
+def get_message_text(message: dict) -> str:
+    if isinstance(message['content'], str):
+        return message['content']
+    return ''.join(item['text'] for item in message['content'] if item['type'] == 'text')
+
+
+def count_images(message: dict) -> int:
+    if isinstance(message['content'], str):
+        return 0
+    return sum(1 for item in message['content'] if item['type'] == 'image_url')
+
+
+class LatencySampler:
+    def __init__(self, dist: str, mean: float, std: float, seed: int = 0) -> None:
+        self.dist = dist
+        self.mean = mean
+        self.std = std
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self) -> float:
+        with self.lock:
+            if self.dist == 'constant' or self.mean <= 0:
+                return max(self.mean, 0.0)
+            if self.dist == 'uniform':
+                return self.random.uniform(max(self.mean - self.std, 0.0), self.mean + self.std)
+            if self.dist == 'exponential':
+                return self.random.expovariate(1 / self.mean)
+            if self.dist == 'normal':
+                return max(self.random.gauss(self.mean, self.std), 0.0)
+            # lognormal with the given mean and standard deviation
+            sigma2 = math.log(1 + (self.std / self.mean) ** 2)
+            mu = math.log(self.mean) - sigma2 / 2
+            return self.random.lognormvariate(mu, math.sqrt(sigma2))
+
+
+class StubState:
+    def __init__(self, args) -> None:
+        self.model_name = args.model_name
+        self.responses = load_recorded_responses(args.result_dir) if args.result_dir is not None else {}
+        self.latency = LatencySampler(args.latency_dist, args.latency_mean, args.latency_std, seed=args.seed)
+        self.error_rate = args.error_rate
+        self.error_codes = args.error_codes
+        self.random = random.Random(args.seed + 1)
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'replayed': 0, 'fallback': 0, 'errors': 0, 'rejected': 0, 'tokens': 0, 'inflight': 0, 'max_inflight': 0}
+        self.capacity = threading.BoundedSemaphore(args.capacity) if args.capacity > 0 else None
+        self.max_queue = args.max_queue
+        self.queued = 0
+        self.rates = {}
+        if args.rpm is not None:
+            self.rates['requests'] = args.rpm / 60
+        if args.tpm is not None:
+            self.rates['tokens'] = args.tpm / 60
+        self.capacities = {name: rate * args.rate_burst for name, rate in self.rates.items()}
+        self.levels = dict(self.capacities)
+        self.updated = time.monotonic()
+
+    def incr(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] += value
+            if name == 'inflight':
+                self.counters['max_inflight'] = max(self.counters['max_inflight'], self.counters['inflight'])
+
+    def enter_queue(self) -> bool:
+        with self.lock:
+            if self.max_queue is not None and self.queued >= self.max_queue:
+                return False
+            self.queued += 1
+            return True
+
+    def leave_queue(self):
+        with self.lock:
+            self.queued -= 1
+
+    def charge(self, requests: int, tokens: int) -> float:
+        """Take a request and its tokens from the rate limit buckets, return 0 or the seconds to wait if they are short."""
+        costs = {'requests': requests, 'tokens': tokens}
+        with self.lock:
+            now = time.monotonic()
+            for name, rate in self.rates.items():
+                self.levels[name] = min(self.levels[name] + rate * (now - self.updated), self.capacities[name])
+            self.updated = now
+            wait = 0.0
+            for name, rate in self.rates.items():
+                # a full bucket admits a request larger than it, which leaves it below zero
+                if costs[name] > 0 and self.levels[name] < min(costs[name], self.capacities[name]):
+                    wait = max(wait, (min(costs[name], self.capacities[name]) - self.levels[name]) / rate)
+            if requests > 0 and wait > 0:
+                return wait
+            for name in self.rates:
+                self.levels[name] -= costs[name]
+            return 0.0
+
+    def draw_error(self):
+        with self.lock:
+            if self.random.random() < self.error_rate:
+                return self.random.choice(self.error_codes)
+        return None
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state: StubState = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status: int, obj: dict, headers: dict = None):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self.send_json(200, {'object': 'list', 'data': [{'id': self.state.model_name, 'object': 'model', 'created': 0, 'owned_by': 'stub'}]})
+        elif self.path.rstrip('/').endswith('/stats'):
+            self.send_json(200, dict(self.state.counters))
+        else:
+            self.send_json(404, {'error': {'message': f'unknown path {self.path}', 'type': 'invalid_request_error'}})
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self.send_json(404, {'error': {'message': f'unknown path {self.path}', 'type': 'invalid_request_error'}})
+            return
+
+        state = self.state
+        state.incr('requests')
+        request = json.loads(body)
+        texts = [get_message_text(message) for message in request['messages'] if message['role'] in ('user', 'assistant')]
+        # 4 characters per token, and 255 tokens per image (a 512px image at high detail for GPT-4o)
+        prompt_tokens = sum(len(text) for text in texts) // 4 + 255 * sum(count_images(message) for message in request['messages'])
+        if len(state.rates) > 0:
+            wait = state.charge(1, prompt_tokens)
+            if wait > 0:
+                state.incr('rejected')
+                self.send_json(429, {'error': {'message': 'rate limit reached', 'type': 'stub_error', 'code': 'rate_limit_exceeded'}},
+                               headers={'retry-after': f'{wait:.3f}'})
+                return
+        if state.capacity is not None and not state.enter_queue():
+            state.incr('rejected')
+            self.send_json(429, {'error': {'message': 'too many queued requests', 'type': 'stub_error', 'code': 429}})
+            return
+        if state.capacity is not None:
+            state.capacity.acquire()
+            state.leave_queue()
+        state.incr('inflight')
+        try:
+            time.sleep(state.latency.sample())
+
+            error_code = state.draw_error()
+            if error_code is not None:
+                state.incr('errors')
+                self.send_json(error_code, {'error': {'message': f'injected error {error_code}', 'type': 'stub_error', 'code': error_code}})
+                return
+
+            key = conversation_key(texts)
+            if key in state.responses:
+                state.incr('replayed')
+                content = state.responses[key]
+            else:
+                state.incr('fallback')
+                content = mock_response(texts[-1])
+
+            completion_tokens = len(content) // 4
+            if len(state.rates) > 0:
+                state.charge(0, completion_tokens)
+            state.incr('tokens', prompt_tokens + completion_tokens)
+            self.send_json(200, {
+                'id': f'chatcmpl-{key[:24]}',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': request.get('model', state.model_name),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens, 'total_tokens': prompt_tokens + completion_tokens}
+            })
+        finally:
+            state.incr('inflight', -1)
+            if state.capacity is not None:
+                state.capacity.release()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--result-dir', type=str, default=None, help='output directory of the run whose responses are replayed')
+    parser.add_argument('--model-name', type=str, default='stub')
+    parser.add_argument('--latency-dist', type=str, default='constant', choices=['constant', 'uniform', 'normal', 'exponential', 'lognormal'])
+    parser.add_argument('--latency-mean', type=float, default=0.0, help='seconds')
+    parser.add_argument('--latency-std', type=float, default=0.0, help='seconds, half width for the uniform distribution')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--error-codes', type=int, nargs='+', default=[429, 500, 503])
+    parser.add_argument('--capacity', type=int, default=0, help='requests served at once, the others queue; 0 serves all at once')
+    parser.add_argument('--max-queue', type=int, default=None, help='queued requests beyond which a 429 is returned, requires --capacity')
+    parser.add_argument('--rpm', type=float, default=None, help='requests per minute beyond which a 429 is returned')
+    parser.add_argument('--tpm', type=float, default=None, help='prompt and completion tokens per minute beyond which a 429 is returned')
+    parser.add_argument('--rate-burst', type=float, default=1.0, help='seconds of the --rpm and --tpm budgets that can be spent at once')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    StubHandler.state = StubState(args)
+    server = ThreadingHTTPServer((args.host, args.port), StubHandler)
+    server.daemon_threads = True
+    print(f"[!] serving {len(StubHandler.state.responses)} recorded responses on http://{args.host}:{args.port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -1,8 +1,9 @@
 from src.inference.inference_engine import InferenceEngine
-from src.inference.openai_compatible import OpenAICompatibleInferenceEngine
+from src.inference.openai_compatible import OpenAICompatibleInferenceEngine, AsyncOpenAICompatibleInferenceEngine
 
 
 __all__ = [
     'InferenceEngine',
-    'OpenAICompatibleInferenceEngine'
+    'OpenAICompatibleInferenceEngine',
+    'AsyncOpenAICompatibleInferenceEngine'
 ]
@@ -1,17 +1,29 @@
 import os
 import json
 import copy
-import markdown_to_json
+import time
+import asyncio
+import functools
+import threading
+import contextvars
 from tqdm import tqdm, trange
+from collections import deque, defaultdict
 from abc import abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict, Optional
 
 
-from src.utils.md_parser import parse_structured_data, json_to_markdown
+from src.utils.md_parser import parse_structured_data, parse_structured_markdown, markdown_to_dict, json_to_markdown, RenderCache
+from src.utils.progress_index import ProgressIndex
+from src.utils.result_writer import ResultWriter
+from src.utils.prefix_stats import PrefixStats
+from src.utils.metrics import Metrics
+from src.utils.response_cache import ResponseCache
 from src.utils.extract_scores import (
     extract_score_from_str,
     extract_score_list_from_str
 )
+
 from src.prompt import (
     EXTRACT_TEMPLATE,
     REF_FREE_APPEARANCE_ANSWER_TEMPLATE,
@@ -134,6 +146,10 @@ category_long_to_short = {
 }
 
 
+# `ChatRequest` being answered, for engines that route requests by sample or track latencies per stage
+CURRENT_REQUEST = contextvars.ContextVar("current_request", default=None)
+
+
 def delete_title(text: str):
     """Delete titles and reserve question only for generated text in answer and evaluation stages.
 
@@ -168,6 +184,55 @@ def add_line_sep_before_title(text: str):
     return "#".join(splits)
 
 
+class PipelineContext:
+    """State of a single sample's pipeline run.
+
+    Output lines are buffered per stage in `output_mapper` and dumped together once the sample is completed. Markdown
+    renders reused across the prompts of the sample (structure information, evaluation blocks) live in `render_cache`.
+    The outputs of the summarize stage (generated or cached) are kept in `summary` for the sample callbacks.
+    """
+    def __init__(self, sample_index: int, output_mapper: dict = None, metrics: Metrics = None) -> None:
+        self.sample_index = sample_index
+        self.output_mapper = output_mapper if output_mapper is not None else defaultdict(list)
+        self.render_cache = RenderCache(metrics=metrics)
+        self.summary = None
+        self.success = None
+        self.start_time = time.perf_counter()
+
+
+class ChatRequest:
+    """A single model request yielded by pipeline steps, answered with `(response, history)` by the driver."""
+    def __init__(self, stage: str, prompt: str, gt_image: str = None, ref_image: str = None, history = None, retry: bool = False) -> None:
+        self.stage = stage
+        self.prompt = prompt
+        self.gt_image = gt_image
+        self.ref_image = ref_image
+        self.history = history
+        self.retry = retry
+        self.sample_index = None
+        self.cache_key = None
+    
+    def chat_kwargs(self) -> dict:
+        return dict(prompt=self.prompt, gt_image=self.gt_image, ref_image=self.ref_image, history=self.history, retry=self.retry)
+
+
+class Gather:
+    """Independent pipeline steps yielded together, answered with the list of their return values in order."""
+    def __init__(self, steps: list) -> None:
+        self.steps = steps
+
+
+class _StepTask:
+    """Pipeline steps being advanced by the batched driver, possibly as one branch of a parent's `Gather`."""
+    def __init__(self, steps, context: PipelineContext, parent: "_StepTask" = None, slot: int = None) -> None:
+        self.steps = steps
+        self.context = context
+        self.parent = parent
+        self.slot = slot
+        self.results = None
+        self.remaining = 0
+
+
 class InferenceEngine:
     def __init__(
         self,
@@ -175,6 +240,16 @@ class InferenceEngine:
         image_root: str,
         output_dir: str,
         max_retry: int = 0,
+        max_inflight_questions: int = 1,
+        max_inflight_samples: int = 1,
+        max_outstanding_requests: int = None,
+        max_batch_size: int = 1,
+        flush_interval: float = 0.0,
+        fsync_interval: float = 5.0,
+        prefix_ordering: bool = False,
+        track_prefix_stats: bool = False,
+        response_cache_file: str = None,
+        response_cache_bytes: int = 1024 * 1024 * 1024,
         model_init_kwargs: dict = {}
     ) -> None:
         
@@ -236,25 +311,45 @@ class InferenceEngine:
             'coarse_grained': os.path.join(output_dir, f"coarse_grained_task_cache.jsonl"),
         }
         
-        # get completed ids for each stage
-        self.progress_map = {}
-        for stage in self.stages:
-            if os.path.exists(self.output_file_mapper[stage]):
-                with open(self.output_file_mapper[stage], "r+", encoding="utf-8") as f:
-                    lines = f.readlines()
-                    single_stage_results = [json.loads(line) for line in lines]
-                    self.progress_map[stage] = {
-                        result["id"]: result for result in single_stage_results
-                    }
-                del lines
-            else:
-                self.progress_map[stage] = {}
+        # requests, time spent waiting for the model and in result file I/O, see `benchmarks/pipeline.py`
+        self.metrics = Metrics()
+        
+        with self.metrics.timer("io"):
+            # torn lines of a crashed run are truncated before the result files are indexed
+            self.result_writer = ResultWriter(self.output_file_mapper, flush_interval=flush_interval, fsync_interval=fsync_interval)
+            
+            # get completed ids for each stage, records are loaded from the result files only when reused
+            self.progress_map = {
+                stage: ProgressIndex(self.output_file_mapper[stage])
+                for stage in self.stages
+            }
                 
         self.output_mapper = {stage: [] for stage in self.stages}
         
         assert max_retry >= 0
         self.max_retry = max_retry
+        # number of question-level answer -> eval chains dispatched concurrently within a sample
+        assert max_inflight_questions >= 1
+        self.max_inflight_questions = max_inflight_questions
+        # number of samples whose pipelines are in flight at the same time, each possibly at a different stage
+        assert max_inflight_samples >= 1
+        self.max_inflight_samples = max_inflight_samples
+        # global cap on requests waiting for the model, shared by all samples and questions in flight
+        assert max_outstanding_requests is None or max_outstanding_requests >= 1
+        self.max_outstanding_requests = max_outstanding_requests
+        self.request_slots = threading.BoundedSemaphore(max_outstanding_requests) if max_outstanding_requests is not None else None
+        self.async_request_slots = None
+        # maximum number of requests answered by a single `chat_batch` call, batching is enabled when > 1
+        assert max_batch_size >= 1
+        self.max_batch_size = max_batch_size
+        # issue pending requests sharing the prompt template back to back (batched driver only), for prefix caching
+        self.prefix_ordering = prefix_ordering
+        self.prefix_stats = PrefixStats() if track_prefix_stats else None
         self.orig_image_placeholder = '<ImagePlaceholder>'
+        # called with the `PipelineContext` of every sample once its results are dumped, in dataset order
+        self.sample_callbacks = []
+        # responses of earlier runs to byte-identical requests, shared by all runs using the same file
+        self.response_cache = ResponseCache(response_cache_file, max_bytes=response_cache_bytes) if response_cache_file is not None else None
         
         self.init_model(**model_init_kwargs)
         
@@ -270,7 +365,180 @@ class InferenceEngine:
     def chat_single_round(self, prompt: str, gt_image: str = None, ref_image: str = None, history = None, retry: bool = False) -> tuple:
         raise NotImplementedError
     
-    def inference(self, granularity: str, multi_stage: bool = True, first_stage_orig: bool = False, fine_grained_do_summarize: bool = False, separate_aspects: bool = True, simple_answer_and_eval: bool = True, coarse_grained_skip_summarize: bool = False, ablation: int = None):
+    async def achat_single_round(self, prompt: str, gt_image: str = None, ref_image: str = None, history = None, retry: bool = False) -> tuple:
+        """Asynchronous `chat_single_round`. Engines with a blocking backend run it in the default thread pool executor."""
+        # `run_in_executor` does not carry the context over, the request in `CURRENT_REQUEST` is needed in the thread
+        return await asyncio.get_running_loop().run_in_executor(
+            None,
+            functools.partial(
+                contextvars.copy_context().run,
+                self.chat_single_round, prompt=prompt, gt_image=gt_image, ref_image=ref_image, history=history, retry=retry
+            )
+        )
+    
+    def chat_batch(self, requests: List[ChatRequest]) -> List[tuple]:
+        """Answer several requests at once, in order. Engines able to batch generation override this."""
+        return [self._call_model(request) for request in requests]
+    
+    def build_history(self, messages: list, response: str) -> list:
+        return messages + [
+            {
+                "role": "assistant",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": response
+                    }
+                ]
+            }
+        ]
+    
+    def response_cache_namespace(self) -> dict:
+        """What, besides the request itself, determines a response: the model and its sampling settings."""
+        return {"engine": type(self).__name__}
+    
+    def _lookup_response(self, request: ChatRequest) -> tuple:
+        """`(response, history)` of a request answered before and kept in the response cache, None otherwise."""
+        if self.response_cache is None:
+            return None
+        request.cache_key = self.response_cache.make_key(
+            self.response_cache_namespace(), prompt=request.prompt, gt_image=request.gt_image, ref_image=request.ref_image, history=request.history
+        )
+        # a retry asks for another response than the one that failed to parse
+        if request.retry:
+            return None
+        response = self.response_cache.get(request.cache_key, stage=request.stage)
+        if response is None:
+            self.metrics.incr("response_cache_misses")
+            return None
+        self.metrics.incr("response_cache_hits")
+        messages = self.build_messages(prompt=request.prompt, gt_image=request.gt_image, ref_image=request.ref_image, history=request.history)
+        return response, self.build_history(messages=messages, response=response)
+    
+    def _store_response(self, request: ChatRequest, result: tuple):
+        if self.response_cache is not None and request.cache_key is not None and isinstance(result[0], str):
+            self.response_cache.put(request.cache_key, result[0], stage=request.stage)
+    
+    def prompt_layout(self, request: ChatRequest) -> str:
+        """Flatten a request into the sequence seen by the model, images replaced by markers, to measure shared prefixes."""
+        parts = []
+        for message in request.history or []:
+            for item in message['content']:
+                if item['type'] == 'text':
+                    parts.append(item['text'])
+                else:
+                    parts.append(f"<image:{hash(item['image_url']['url'])}>")
+        
+        if request.gt_image is not None and request.history is None:
+            images = [f"<image:{hash(request.gt_image)}>", f"<image:{hash(request.ref_image)}>"]
+            splits = request.prompt.split('<ImageHere>')
+            if len(splits) == 1:
+                parts.extend([images[0], request.prompt])
+            else:
+                for i, split in enumerate(splits):
+                    if i > 0:
+                        parts.append(images[i - 1])
+                    parts.append(split)
+        else:
+            parts.append(request.prompt)
+        return "".join(parts)
+    
+    def _record_prefix(self, request: ChatRequest):
+        if self.prefix_stats is not None:
+            self.prefix_stats.record(request.stage, self.prompt_layout(request))
+    
+    def _order_by_prefix(self, pending: deque) -> deque:
+        """Group pending requests by stage, i.e. by prompt template, groups ordered by their oldest request.
+
+        Requests of a sample are queued together, so within a group those sharing images and history stay adjacent.
+        """
+        groups = {}
+        for task, request in pending:
+            groups.setdefault(request.stage, []).append((task, request))
+        return deque(entry for group in groups.values() for entry in group)
+    
+    def _call_model(self, request: ChatRequest) -> tuple:
+        CURRENT_REQUEST.set(request)
+        if self.request_slots is None:
+            return self.chat_single_round(**request.chat_kwargs())
+        with self.request_slots:
+            return self.chat_single_round(**request.chat_kwargs())
+    
+    def _dispatch(self, request: ChatRequest) -> tuple:
+        result = self._lookup_response(request)
+        if result is None:
+            result = self._call_model(request)
+            self._store_response(request, result)
+        return result
+    
+    async def _adispatch(self, request: ChatRequest) -> tuple:
+        # the SQLite statements of the response cache and the hashing of the images block, they run in worker threads
+        if self.response_cache is not None:
+            result = await asyncio.to_thread(self._lookup_response, request)
+            if result is not None:
+                return result
+        CURRENT_REQUEST.set(request)
+        if self.async_request_slots is None:
+            result = await self.achat_single_round(**request.chat_kwargs())
+        else:
+            async with self.async_request_slots:
+                result = await self.achat_single_round(**request.chat_kwargs())
+        if self.response_cache is not None:
+            await asyncio.to_thread(self._store_response, request, result)
+        return result
+    
+    def _run_steps(self, steps, context: PipelineContext):
+        """Drive pipeline steps to completion, answering every yielded request with a blocking model call."""
+        value = None
+        while True:
+            try:
+                item = steps.send(value)
+            except StopIteration as stop:
+                return stop.value
+            if isinstance(item, Gather):
+                value = self._run_gather(item, context=context)
+            else:
+                item.sample_index = context.sample_index
+                self._record_prefix(item)
+                self.metrics.incr("requests")
+                with self.metrics.timer("wait"):
+                    value = self._dispatch(item)
+    
+    def _run_gather(self, gather: Gather, context: PipelineContext) -> list:
+        if self.max_inflight_questions == 1 or len(gather.steps) <= 1:
+            return [self._run_steps(steps, context=context) for steps in gather.steps]
+        with ThreadPoolExecutor(max_workers=min(self.max_inflight_questions, len(gather.steps))) as executor:
+            return list(executor.map(lambda steps: self._run_steps(steps, context=context), gather.steps))
+    
+    async def _arun_steps(self, steps, context: PipelineContext):
+        """Asynchronous counterpart of `_run_steps`."""
+        value = None
+        while True:
+            try:
+                item = steps.send(value)
+            except StopIteration as stop:
+                return stop.value
+            if isinstance(item, Gather):
+                value = await self._arun_gather(item, context=context)
+            else:
+                item.sample_index = context.sample_index
+                self._record_prefix(item)
+                self.metrics.incr("requests")
+                with self.metrics.timer("wait", cpu=False):
+                    value = await self._adispatch(item)
+    
+    async def _arun_gather(self, gather: Gather, context: PipelineContext) -> list:
+        if self.max_inflight_questions == 1 or len(gather.steps) <= 1:
+            return [await self._arun_steps(steps, context=context) for steps in gather.steps]
+        slots = asyncio.Semaphore(self.max_inflight_questions)
+        
+        async def run(steps):
+            async with slots:
+                return await self._arun_steps(steps, context=context)
+        
+        return list(await asyncio.gather(*[run(steps) for steps in gather.steps]))
+    
+    def _start_inference(self, granularity: str, multi_stage: bool = True, first_stage_orig: bool = False, fine_grained_do_summarize: bool = False, separate_aspects: bool = True, simple_answer_and_eval: bool = True, coarse_grained_skip_summarize: bool = False, ablation: int = None) -> tuple:
         assert granularity in ['fine', 'coarse']
         
         if multi_stage and first_stage_orig:
@@ -283,13 +551,33 @@ class InferenceEngine:
             tqdm.write(f"[!] Performing inference with explanation and scoring separated.[!]")
          
         if granularity == 'fine':
-            for i in trange(len(self.dataset)):
-                self.fine_grained_pipeline(sample_index=i, multi_stage=multi_stage, do_summarize=fine_grained_do_summarize, separate_aspects=separate_aspects, simple_answer_and_eval=simple_answer_and_eval)
-                self.dump_cache_to_file()
+            pipeline = self._fine_grained_pipeline
+            pipeline_kwargs = dict(multi_stage=multi_stage, do_summarize=fine_grained_do_summarize, separate_aspects=separate_aspects, simple_answer_and_eval=simple_answer_and_eval)
         else:
-            for i in trange(len(self.dataset)):
-                self.coarse_grained_pipeline(sample_index=i, multi_stage=multi_stage, separate_aspects=separate_aspects, simple_answer_and_eval=simple_answer_and_eval, skip_summarize=coarse_grained_skip_summarize, ablation=ablation)
-                self.dump_cache_to_file()
+            pipeline = self._coarse_grained_pipeline
+            pipeline_kwargs = dict(multi_stage=multi_stage, separate_aspects=separate_aspects, simple_answer_and_eval=simple_answer_and_eval, skip_summarize=coarse_grained_skip_summarize, ablation=ablation)
+        return pipeline, pipeline_kwargs
+    
+    def _finish_inference(self, multi_stage: bool = True, first_stage_orig: bool = False, **kwargs):
+        self.result_writer.flush(fsync=True)
+        stats = self.result_writer.get_stats()
+        tqdm.write(f"[!] result writer: {stats['lines']} lines, {round(stats['bytes'] / 1024 / 1024, 2)} MiB, "
+                   f"{stats['flushes']} flushes, {stats['fsyncs']} fsyncs, {round(stats['write_time'], 3)}s writing "
+                   f"({round(stats['lines_per_second'], 1)} lines/s)")
+        if self.prefix_stats is not None:
+            tqdm.write(f"[!] shared prompt prefix per stage:\n{self.prefix_stats.format()}")
+        counters = self.metrics.snapshot()["counters"]
+        render_hits, render_misses = counters.get("render_cache_hits", 0), counters.get("render_cache_misses", 0)
+        if render_hits + render_misses > 0:
+            tqdm.write(f"[!] per-sample render cache: {render_hits} hits, {render_misses} misses "
+                       f"({round(render_hits / (render_hits + render_misses) * 100, 1)}% hit rate)")
+        if self.response_cache is not None:
+            tqdm.write(f"[!] response cache {self.response_cache.path}, per stage:\n{self.response_cache.format()}")
+        if self.metrics.percentile("sample_latency", 50) is not None:
+            tqdm.write(f"[!] sample latency: p50 {round(self.metrics.percentile('sample_latency', 50), 2)}s, "
+                       f"p95 {round(self.metrics.percentile('sample_latency', 95), 2)}s, p99 {round(self.metrics.percentile('sample_latency', 99), 2)}s; "
+                       f"{counters.get('hedged_requests', 0)} hedged requests ({counters.get('hedge_wins', 0)} won by the hedge), "
+                       f"{counters.get('deadline_exceeded', 0)} deadlines exceeded")
         
         if multi_stage and first_stage_orig:
             tqdm.write(f"[!] Reset prompt template for explanation.[!]")
@@ -298,17 +586,202 @@ class InferenceEngine:
             EVALUATION_PROMPT["intrinsic - stage_1"] = INTRINSIC_EVAL_TEMPLATE_STAGE_1
             EVALUATION_PROMPT["relationship - stage_1"] = RELATIONSHIP_EVAL_TEMPLATE_STAGE_1
     
-    def dump_cache_to_file(self):
-        for key in self.output_mapper:
-            if len(self.output_mapper[key]) == 0:
-                continue
-            assert key in self.output_file_mapper
-            with open(self.output_file_mapper[key], "a+", encoding='utf-8') as f:
-                for line in self.output_mapper[key]:
-                    f.write(line)
-            self.output_mapper[key] = []
+    def close(self):
+        """Release what the engine holds besides the model at the end of `inference` / `ainference`, which therefore
+        run once per engine."""
+        self.result_writer.close()
+        if self.response_cache is not None:
+            self.response_cache.close()
+    
+    def inference(self, granularity: str, **kwargs):
+        pipeline, pipeline_kwargs = self._start_inference(granularity=granularity, **kwargs)
+        
+        try:
+            if self.max_batch_size > 1:
+                self._inference_batched(pipeline=pipeline, pipeline_kwargs=pipeline_kwargs)
+            elif self.max_inflight_samples == 1:
+                for i in trange(len(self.dataset)):
+                    context = PipelineContext(sample_index=i, output_mapper=self.output_mapper, metrics=self.metrics)
+                    self._complete_sample(context, self._run_steps(pipeline(sample_index=i, context=context, **pipeline_kwargs), context=context))
+                    self.dump_cache_to_file(context=context)
+            else:
+                self._inference_pipelined(pipeline=pipeline, pipeline_kwargs=pipeline_kwargs)
+            
+            self._finish_inference(**kwargs)
+        finally:
+            self.close()
+    
+    async def ainference(self, granularity: str, **kwargs):
+        """Asynchronous `inference`: sample pipelines and question chains are coroutines on the running event loop.
+
+        Samples are dumped in dataset order, the result files are identical to `inference`.
+        """
+        pipeline, pipeline_kwargs = self._start_inference(granularity=granularity, **kwargs)
+        self.async_request_slots = asyncio.Semaphore(self.max_outstanding_requests) if self.max_outstanding_requests is not None else None
+        sample_slots = asyncio.Semaphore(self.max_inflight_samples)
+        
+        async def run_sample(sample_index: int) -> PipelineContext:
+            async with sample_slots:
+                context = PipelineContext(sample_index=sample_index, metrics=self.metrics)
+                self._complete_sample(context, await self._arun_steps(pipeline(sample_index=sample_index, context=context, **pipeline_kwargs), context=context))
+                return context
+        
+        max_scheduled = 4 * self.max_inflight_samples
+        scheduled = deque()
+        next_index = 0
+        try:
+            with tqdm(total=len(self.dataset)) as pbar:
+                while next_index < len(self.dataset) or len(scheduled) > 0:
+                    while next_index < len(self.dataset) and len(scheduled) < max_scheduled:
+                        scheduled.append(asyncio.create_task(run_sample(next_index)))
+                        next_index += 1
+                    context = await scheduled.popleft()
+                    self.dump_cache_to_file(context=context)
+                    pbar.update(1)
+            self._finish_inference(**kwargs)
+        finally:
+            for task in scheduled:
+                task.cancel()
+            self.async_request_slots = None
+            self.close()
+    
+    def _inference_pipelined(self, pipeline, pipeline_kwargs: dict):
+        """Keep `max_inflight_samples` pipelines running at once on a thread pool.
+
+        Samples are still dumped strictly in dataset order, so the result files are identical to the sequential path.
+        Completed samples wait in memory for earlier ones, at most `4 * max_inflight_samples` are scheduled ahead.
+        """
+        def run_sample(sample_index: int) -> PipelineContext:
+            context = PipelineContext(sample_index=sample_index, metrics=self.metrics)
+            self._complete_sample(context, self._run_steps(pipeline(sample_index=sample_index, context=context, **pipeline_kwargs), context=context))
+            return context
+        
+        max_scheduled = 4 * self.max_inflight_samples
+        with ThreadPoolExecutor(max_workers=self.max_inflight_samples) as executor:
+            scheduled = deque()
+            next_index = 0
+            with tqdm(total=len(self.dataset)) as pbar:
+                while next_index < len(self.dataset) or len(scheduled) > 0:
+                    while next_index < len(self.dataset) and len(scheduled) < max_scheduled:
+                        scheduled.append(executor.submit(run_sample, next_index))
+                        next_index += 1
+                    context = scheduled.popleft().result()
+                    self.dump_cache_to_file(context=context)
+                    pbar.update(1)
+    
+    def _inference_batched(self, pipeline, pipeline_kwargs: dict):
+        """Advance up to `max_inflight_samples` pipelines in lockstep and answer their requests in batches.
+
+        Every pipeline, and every question chain of a `Gather`, runs until it waits for the model. The pending requests
+        are then answered in arrival order by `chat_batch` calls of at most `max_batch_size` requests. Samples are dumped
+        in dataset order, so the result files are identical to the sequential path.
+        """
+        ready = deque()
+        pending = deque()
+        completed = {}
+        num_running = 0
+        next_index = 0
+        next_dump = 0
+        max_scheduled = 4 * self.max_inflight_samples
+        with tqdm(total=len(self.dataset)) as pbar:
+            while next_dump < len(self.dataset):
+                while next_index < len(self.dataset) and num_running < self.max_inflight_samples and next_index - next_dump < max_scheduled:
+                    context = PipelineContext(sample_index=next_index, metrics=self.metrics)
+                    ready.append((_StepTask(pipeline(sample_index=next_index, context=context, **pipeline_kwargs), context=context), None))
+                    num_running += 1
+                    next_index += 1
+                
+                while len(ready) > 0:
+                    task, value = ready.popleft()
+                    try:
+                        item = task.steps.send(value)
+                    except StopIteration as stop:
+                        if task.parent is None:
+                            self._complete_sample(task.context, stop.value)
+                            completed[task.context.sample_index] = task.context
+                            num_running -= 1
+                        else:
+                            task.parent.results[task.slot] = stop.value
+                            task.parent.remaining -= 1
+                            if task.parent.remaining == 0:
+                                ready.append((task.parent, task.parent.results))
+                        continue
+                    
+                    if isinstance(item, Gather):
+                        task.results = [None] * len(item.steps)
+                        task.remaining = len(item.steps)
+                        if task.remaining == 0:
+                            ready.append((task, []))
+                        for slot, steps in enumerate(item.steps):
+                            ready.append((_StepTask(steps, context=task.context, parent=task, slot=slot), None))
+                    else:
+                        item.sample_index = task.context.sample_index
+                        cached = self._lookup_response(item)
+                        if cached is not None:
+                            self.metrics.incr("requests")
+                            ready.append((task, cached))
+                        else:
+                            pending.append((task, item))
+                
+                while next_dump in completed:
+                    self.dump_cache_to_file(context=completed.pop(next_dump))
+                    next_dump += 1
+                    pbar.update(1)
+                
+                if len(pending) > 0:
+                    if self.prefix_ordering:
+                        pending = self._order_by_prefix(pending)
+                    batch = [pending.popleft() for _ in range(min(len(pending), self.max_batch_size))]
+                    for _, request in batch:
+                        self._record_prefix(request)
+                    self.metrics.incr("requests", len(batch))
+                    with self.metrics.timer("wait"):
+                        responses = self.chat_batch([request for _, request in batch])
+                    for (_, request), response in zip(batch, responses):
+                        self._store_response(request, response)
+                    ready.extend((task, response) for (task, _), response in zip(batch, responses))
+    
+    def _complete_sample(self, context: PipelineContext, success):
+        context.success = success
+        # from the start of the pipeline to its last response, waiting for earlier samples to be dumped excluded
+        self.metrics.observe("sample_latency", time.perf_counter() - context.start_time)
+    
+    def add_sample_callback(self, callback):
+        self.sample_callbacks.append(callback)
+    
+    def dump_cache_to_file(self, output_mapper: dict = None, context: PipelineContext = None):
+        if output_mapper is None:
+            output_mapper = context.output_mapper if context is not None else self.output_mapper
+        with self.metrics.timer("io"):
+            self.result_writer.write(output_mapper)
+        for key in output_mapper:
+            output_mapper[key] = []
+        self.metrics.incr("samples")
+        if context is not None:
+            for callback in self.sample_callbacks:
+                callback(context)
+    
+    def fine_grained_pipeline(self, sample_index: int, context: PipelineContext = None, **kwargs):
+        if context is None:
+            context = PipelineContext(sample_index=sample_index, output_mapper=self.output_mapper, metrics=self.metrics)
+        return self._run_steps(self._fine_grained_pipeline(sample_index=sample_index, context=context, **kwargs), context=context)
+    
+    async def afine_grained_pipeline(self, sample_index: int, context: PipelineContext = None, **kwargs):
+        if context is None:
+            context = PipelineContext(sample_index=sample_index, output_mapper=self.output_mapper, metrics=self.metrics)
+        return await self._arun_steps(self._fine_grained_pipeline(sample_index=sample_index, context=context, **kwargs), context=context)
     
-    def fine_grained_pipeline(self, sample_index: int, multi_stage: bool = False, do_summarize: bool = False, separate_aspects: bool = False, simple_answer_and_eval: bool = False):
+    def coarse_grained_pipeline(self, sample_index: int, context: PipelineContext = None, **kwargs):
+        if context is None:
+            context = PipelineContext(sample_index=sample_index, output_mapper=self.output_mapper, metrics=self.metrics)
+        return self._run_steps(self._coarse_grained_pipeline(sample_index=sample_index, context=context, **kwargs), context=context)
+    
+    async def acoarse_grained_pipeline(self, sample_index: int, context: PipelineContext = None, **kwargs):
+        if context is None:
+            context = PipelineContext(sample_index=sample_index, output_mapper=self.output_mapper, metrics=self.metrics)
+        return await self._arun_steps(self._coarse_grained_pipeline(sample_index=sample_index, context=context, **kwargs), context=context)
+    
+    def _fine_grained_pipeline(self, sample_index: int, context: PipelineContext, multi_stage: bool = False, do_summarize: bool = False, separate_aspects: bool = False, simple_answer_and_eval: bool = False):
         sample = self.dataset[sample_index]
         tqdm.write(f"# Performing inference for sample {sample['id']}")
         
@@ -325,40 +798,43 @@ class InferenceEngine:
         extract_response_structured = sample['structured_info_str']
         
         # stage 2 & 3: answer & eval
-        evaluation_map = self.answer_and_eval_stage(
+        evaluation_map = yield from self._answer_and_eval_stage(
             question_map=question_map,
             extract_response_structured=extract_response_structured,
             gt_image=sample['gt_image'],
             ref_image=sample['ref_image'],
             multi_stage=multi_stage,
-            simple_answer_and_eval=simple_answer_and_eval
+            simple_answer_and_eval=simple_answer_and_eval,
+            context=context
         )
         if do_summarize:
             # stage 4: summarize
-            summary = self.summarize_stage(
+            summary = yield from self._summarize_stage(
                 gt_image=sample['gt_image'],
                 structure_info=extract_response_structured,
                 evaluation_map=evaluation_map,
                 sample_index=sample_index,
                 multi_stage=multi_stage,
-                separate_aspects=separate_aspects
+                separate_aspects=separate_aspects,
+                context=context
             )
             return summary is not None
         return evaluation_map is not None
     
-    def coarse_grained_pipeline(self, sample_index: int, multi_stage: bool = False, separate_aspects: bool = False, simple_answer_and_eval: bool = False, skip_summarize: bool = False, ablation: int = None):
+    def _coarse_grained_pipeline(self, sample_index: int, context: PipelineContext, multi_stage: bool = False, separate_aspects: bool = False, simple_answer_and_eval: bool = False, skip_summarize: bool = False, ablation: int = None):
         sample = self.dataset[sample_index]
         tqdm.write(f"# Performing inference for sample {sample['id']}")
         
         # stage 1: extract -> `matched_structured_data`, `qmap`
-        question_map, extract_response_structured = self.extract_stage(
+        question_map, extract_response_structured = yield from self._extract_stage(
             image_caption=sample['image_caption'],
             gt_image=sample['gt_image'],
-            sample_index=sample_index
+            sample_index=sample_index,
+            context=context
         )
         
         # stage 2 & 3: answer & eval
-        evaluation_map = self.answer_and_eval_stage(
+        evaluation_map = yield from self._answer_and_eval_stage(
             question_map=question_map,
             extract_response_structured=extract_response_structured,
             gt_image=sample['gt_image'],
@@ -366,31 +842,38 @@ class InferenceEngine:
             multi_stage=multi_stage,
             simple_answer_and_eval=simple_answer_and_eval,
             ablation=ablation,
-            sample_index=sample_index
+            sample_index=sample_index,
+            context=context
         )
         
         if not skip_summarize:
             # stage 4: summarize
-            summary = self.summarize_stage(
+            summary = yield from self._summarize_stage(
                 gt_image=sample['gt_image'],
                 structure_info=extract_response_structured,
                 evaluation_map=evaluation_map,
                 sample_index=sample_index,
                 multi_stage=multi_stage,
                 separate_aspects=separate_aspects,
-                ablation=ablation
+                ablation=ablation,
+                context=context
             )
             return summary is not None
         else:
             return evaluation_map is not None
     
-    def extract_stage(self, image_caption: str, gt_image: str, sample_index: int) -> tuple:
+    def extract_stage(self, image_caption: str, gt_image: str, sample_index: int, context: PipelineContext = None) -> tuple:
+        if context is None:
+            context = PipelineContext(sample_index=sample_index, output_mapper=self.output_mapper, metrics=self.metrics)
+        return self._run_steps(self._extract_stage(image_caption=image_caption, gt_image=gt_image, sample_index=sample_index, context=context), context=context)
+    
+    def _extract_stage(self, image_caption: str, gt_image: str, sample_index: int, context: PipelineContext) -> tuple:
         if sample_index in self.progress_map['extract'] and self.progress_map['extract'][sample_index]['questions'] is not None: # `self.progress_map['extract']['questions'] is not None` may be redundant
             extract_output = self.progress_map["extract"][sample_index]
             tqdm.write(f"  stage 1 (extract): using cached result")
         else:
             # 1.1 construct sample, generate response and parse
-            extract_output = self._extract_core(image_caption=image_caption, gt_image=gt_image)
+            extract_output = yield from self._extract_core(image_caption=image_caption, gt_image=gt_image)
             
             # 1.2 save result whether or not error occured
             extract_output['id'] = sample_index
@@ -400,14 +883,15 @@ class InferenceEngine:
                     for i in range(len(extract_output['questions'][key])):
                         extract_output['questions'][key][i]['id'] = f"{sample_index}-{i}"
                 
-                self.output_mapper["extract"].append(json.dumps(obj=extract_output, ensure_ascii=False) + "\n")
+                context.output_mapper["extract"].append(json.dumps(obj=extract_output, ensure_ascii=False) + "\n")
                 tqdm.write(f"  stage 1 (extract): generating and parsing completed")
             else:
                 if "extract-error" not in self.output_file_mapper:
                     error_file = f"{self.output_file_mapper['extract'][:self.output_file_mapper['extract'].find('-result.jsonl')]}-error-result.jsonl"
                     self.output_file_mapper["extract-error"] = error_file
-                    self.output_mapper["extract-error"] = []
-                self.output_mapper["extract-error"].append(json.dumps(obj=extract_output, ensure_ascii=False) + "\n")
+                if "extract-error" not in context.output_mapper:
+                    context.output_mapper["extract-error"] = []
+                context.output_mapper["extract-error"].append(json.dumps(obj=extract_output, ensure_ascii=False) + "\n")
                 
                 tqdm.write(f"  stage 1 (extract): parsing error confronted (sample {sample_index}, skip.\nRaw generation:\n{extract_output['response']}\n[!]")
                 
@@ -423,7 +907,8 @@ class InferenceEngine:
         success = False
         retry = 0
         while not success and retry <= self.max_retry:
-            extract_response, _ = self.chat_single_round(
+            extract_response, _ = yield ChatRequest(
+                stage="extract",
                 prompt=_extract_prompt,
                 gt_image=gt_image,
                 ref_image=None,
@@ -431,7 +916,7 @@ class InferenceEngine:
                 retry=retry != 0
             )
             extract_response = add_line_sep_before_title(extract_response)
-            extract_response_structured = markdown_to_json.dictify(extract_response)
+            extract_response_structured = markdown_to_dict(extract_response)
 
             # handle illegal output format
             try:
@@ -471,7 +956,22 @@ class InferenceEngine:
                 "error": True
             }
     
-    def answer_and_eval_stage(self, question_map: dict, extract_response_structured: dict, gt_image: str, ref_image: str = None, multi_stage: bool = False, simple_answer_and_eval: bool = False, ablation: int = None, sample_index: int = None):
+    def answer_and_eval_stage(self, question_map: dict, extract_response_structured: dict, gt_image: str, ref_image: str = None, multi_stage: bool = False, simple_answer_and_eval: bool = False, ablation: int = None, sample_index: int = None, context: PipelineContext = None):
+        if context is None:
+            context = PipelineContext(sample_index=sample_index, output_mapper=self.output_mapper, metrics=self.metrics)
+        return self._run_steps(self._answer_and_eval_stage(
+            question_map=question_map,
+            extract_response_structured=extract_response_structured,
+            gt_image=gt_image,
+            context=context,
+            ref_image=ref_image,
+            multi_stage=multi_stage,
+            simple_answer_and_eval=simple_answer_and_eval,
+            ablation=ablation,
+            sample_index=sample_index
+        ), context=context)
+    
+    def _answer_and_eval_stage(self, question_map: dict, extract_response_structured: dict, gt_image: str, context: PipelineContext, ref_image: str = None, multi_stage: bool = False, simple_answer_and_eval: bool = False, ablation: int = None, sample_index: int = None):
         tqdm.write(f"  stage 2 & 3 (answer & eval):")
         tqdm.write(f"    Question statistics:")
         for key, value in question_map.items():
@@ -484,21 +984,22 @@ class InferenceEngine:
                 eval_output = self.progress_map[f"all_in_one_eval"][sample_index]
                 tqdm.write(f"    {sample_index} (all-in-one answer & eval): using cached result")
             else:
-                answer_output, answer_history = self._answer_core_ablation_1(
+                answer_output, answer_history = yield from self._answer_core_ablation_1(
                     question_map=question_map,
                     gt_image=gt_image,
                     ref_image=ref_image,
                     sample_index=sample_index
                 )
-                eval_output = self._eval_core_ablation_1(
+                eval_output = yield from self._eval_core_ablation_1(
                     answer_output=answer_output,
                     structure_info=extract_response_structured,
                     gt_image=gt_image,
                     history=answer_history,
-                    sample_index=sample_index
+                    sample_index=sample_index,
+                    render_cache=context.render_cache
                 )
-                self.output_mapper["all_in_one_eval"].append(json.dumps(obj=eval_output, ensure_ascii=False) + "\n")
-                self.output_mapper["all_in_one_answer"].append(json.dumps(obj=answer_output, ensure_ascii=False) + "\n")
+                context.output_mapper["all_in_one_eval"].append(json.dumps(obj=eval_output, ensure_ascii=False) + "\n")
+                context.output_mapper["all_in_one_answer"].append(json.dumps(obj=answer_output, ensure_ascii=False) + "\n")
                 tqdm.write(f"    {sample_index} (all-in-one answer & eval): generating completed")
                 
             evaluation_map = {
@@ -514,7 +1015,7 @@ class InferenceEngine:
                         eval_output = self.progress_map[f"{category}_eval"][sample_index]
                     tqdm.write(f"    {sample_index} ({category}): using cached result")
                 else:
-                    answer_output, answer_history = self._answer_core_ablation_2(
+                    answer_output, answer_history = yield from self._answer_core_ablation_2(
                         question_list=question_list,
                         category=category,
                         gt_image=gt_image,
@@ -522,74 +1023,132 @@ class InferenceEngine:
                         sample_index=sample_index
                     )
                     if category != 'appearance':
-                        eval_output = self._eval_core_ablation_2(
+                        eval_output = yield from self._eval_core_ablation_2(
                             answer_output=answer_output,
                             category=category,
                             structure_info=extract_response_structured,
                             gt_image=gt_image,
                             history=answer_history,
-                            sample_index=sample_index
+                            sample_index=sample_index,
+                            render_cache=context.render_cache
                         )
-                        self.output_mapper[f"{category}_eval"].append(json.dumps(obj=eval_output, ensure_ascii=False) + "\n")
+                        context.output_mapper[f"{category}_eval"].append(json.dumps(obj=eval_output, ensure_ascii=False) + "\n")
                     else:
                         eval_output = answer_output
                     
-                    self.output_mapper[f"{category}_answer"].append(json.dumps(obj=answer_output, ensure_ascii=False) + "\n")
+                    context.output_mapper[f"{category}_answer"].append(json.dumps(obj=answer_output, ensure_ascii=False) + "\n")
                     tqdm.write(f"    {sample_index} ({category}): generating completed")
                 
                 evaluation_map[category] = eval_output
             return evaluation_map
         
-        for category, question_list in question_map.items():
-            for question in question_list:
-                q_id = question['id']
-                
-                if q_id in self.progress_map[f"{category}_answer"].keys():
-                    if category == 'appearance':
-                        eval_output = self.progress_map[f"{category}_answer"][q_id]
-                    else:
-                        eval_output = self.progress_map[f"{category}_eval"][q_id]
-                    tqdm.write(f"    {q_id} ({category}): using cached result")
-                else:
-                    answer_output, answer_output_stage_1, answer_output_stage_2, answer_history = self._answer_core(
-                        question=question,
-                        category=category,
-                        gt_image=gt_image,
-                        ref_image=ref_image,
-                        multi_stage=multi_stage,
-                        simple_format=simple_answer_and_eval
-                    )
-                    if category != 'appearance':
-                        eval_output, eval_output_stage_1, eval_output_stage_2 = self._eval_core(
-                            answer_output=answer_output,
-                            category=category,
-                            structure_info=extract_response_structured,
-                            gt_image=gt_image,
-                            history=answer_history,
-                            multi_stage=multi_stage,
-                            simple_format=simple_answer_and_eval
-                        )
-                        self.output_mapper[f"{category}_eval"].append(json.dumps(obj=eval_output, ensure_ascii=False) + "\n")
-                        if multi_stage and eval_output_stage_1 is not None and eval_output_stage_2 is not None:
-                            self.output_mapper[f"{category}_eval_stage_1"].append(json.dumps(obj=eval_output_stage_1, ensure_ascii=False) + "\n")
-                            self.output_mapper[f"{category}_eval_stage_2"].append(json.dumps(obj=eval_output_stage_2, ensure_ascii=False) + "\n")
-                    else:
-                        eval_output = answer_output
-                    
-                    self.output_mapper[f"{category}_answer"].append(json.dumps(obj=answer_output, ensure_ascii=False) + "\n")
-                    if multi_stage and answer_output_stage_1 is not None and answer_output_stage_2 is not None:
-                        self.output_mapper[f"{category}_answer_stage_1"].append(json.dumps(obj=answer_output_stage_1, ensure_ascii=False) + "\n")
-                        self.output_mapper[f"{category}_answer_stage_2"].append(json.dumps(obj=answer_output_stage_2, ensure_ascii=False) + "\n")
-                    tqdm.write(f"    {q_id} ({category}): generating completed")
-
-                # append evaluation result to evaluation map
-                evaluation_map[category].append(eval_output)
+        tasks = [
+            (category, question)
+            for category, question_list in question_map.items()
+            for question in question_list
+        ]
+        # question chains are independent, they are dispatched concurrently by the driver (see `max_inflight_questions`)
+        # and the results come back in the original question order
+        answers = yield Gather([
+            self._answer_question(
+                question=question,
+                category=category,
+                gt_image=gt_image,
+                ref_image=ref_image,
+                multi_stage=multi_stage,
+                simple_answer_and_eval=simple_answer_and_eval
+            )
+            for category, question in tasks
+        ])
+        eval_kwargs = dict(
+            extract_response_structured=extract_response_structured,
+            gt_image=gt_image,
+            multi_stage=multi_stage,
+            simple_answer_and_eval=simple_answer_and_eval,
+            render_cache=context.render_cache
+        )
+        if simple_answer_and_eval and multi_stage:
+            # the answer and explanation of a question are filled into its entry of the structure information, which
+            # the score prompts of the questions after it render: these evaluations run one after another, in order
+            results = []
+            for (category, question), answer in zip(tasks, answers):
+                result = yield from self._eval_question(question=question, category=category, answer=answer, **eval_kwargs)
+                results.append(result)
+        else:
+            results = yield Gather([
+                self._eval_question(question=question, category=category, answer=answer, **eval_kwargs)
+                for (category, question), answer in zip(tasks, answers)
+            ])
+        
+        for (category, _), (eval_output, records) in zip(tasks, results):
+            for stage, line in records:
+                context.output_mapper[stage].append(line)
+            # append evaluation result to evaluation map
+            evaluation_map[category].append(eval_output)
                 
         return evaluation_map
+    
+    def _answer_question(self, question: dict, category: str, gt_image: str, ref_image: str = None, multi_stage: bool = False, simple_answer_and_eval: bool = False):
+        """Answer a single question, or return None if its results are already in the progress map."""
+        if question['id'] in self.progress_map[f"{category}_answer"].keys():
+            return None
+        answer = yield from self._answer_core(
+            question=question,
+            category=category,
+            gt_image=gt_image,
+            ref_image=ref_image,
+            multi_stage=multi_stage,
+            simple_format=simple_answer_and_eval
+        )
+        return answer
+    
+    def _eval_question(self, question: dict, category: str, answer: tuple, extract_response_structured: dict, gt_image: str, multi_stage: bool = False, simple_answer_and_eval: bool = False, render_cache: RenderCache = None):
+        """Evaluate the answer of a single question given by `_answer_question`.
+
+        Returns:
+            tuple: evaluation output and the `(stage, line)` records to be dumped, in dumping order
+        """
+        q_id = question['id']
+        records = []
+        
+        if answer is None:
+            if category == 'appearance':
+                eval_output = self.progress_map[f"{category}_answer"][q_id]
+            else:
+                eval_output = self.progress_map[f"{category}_eval"][q_id]
+            tqdm.write(f"    {q_id} ({category}): using cached result")
+        else:
+            answer_output, answer_output_stage_1, answer_output_stage_2, answer_history = answer
+            if category != 'appearance':
+                eval_output, eval_output_stage_1, eval_output_stage_2 = yield from self._eval_core(
+                    answer_output=answer_output,
+                    category=category,
+                    structure_info=extract_response_structured,
+                    gt_image=gt_image,
+                    history=answer_history,
+                    multi_stage=multi_stage,
+                    simple_format=simple_answer_and_eval,
+                    render_cache=render_cache
+                )
+                records.append((f"{category}_eval", json.dumps(obj=eval_output, ensure_ascii=False) + "\n"))
+                if multi_stage and eval_output_stage_1 is not None and eval_output_stage_2 is not None:
+                    records.append((f"{category}_eval_stage_1", json.dumps(obj=eval_output_stage_1, ensure_ascii=False) + "\n"))
+                    records.append((f"{category}_eval_stage_2", json.dumps(obj=eval_output_stage_2, ensure_ascii=False) + "\n"))
+            else:
+                eval_output = answer_output
+            
+            records.append((f"{category}_answer", json.dumps(obj=answer_output, ensure_ascii=False) + "\n"))
+            if multi_stage and answer_output_stage_1 is not None and answer_output_stage_2 is not None:
+                records.append((f"{category}_answer_stage_1", json.dumps(obj=answer_output_stage_1, ensure_ascii=False) + "\n"))
+                records.append((f"{category}_answer_stage_2", json.dumps(obj=answer_output_stage_2, ensure_ascii=False) + "\n"))
+            tqdm.write(f"    {q_id} ({category}): generating completed")
+        
+        return eval_output, records
         
     def _answer_core(self, question: dict, category: str, gt_image: str, ref_image: str = None, multi_stage: bool = False, simple_format: bool = False):
         answer_prompt_category_1 = f"{category}"
         answer_prompt_category_2 = f"{category}"
+        answer_stage = f"{category}_answer"
         if category == 'appearance':
             if ref_image is not None:
                 answer_prompt_category_1 += ' + ref'
@@ -598,13 +1157,15 @@ class InferenceEngine:
             if multi_stage:
                 answer_prompt_category_1 += ' - stage_1'
                 answer_prompt_category_2 += ' - stage_2'
+                answer_stage += '_stage_1'
         
         if not simple_format:
             answer_prompt = self.replace_image_placeholder(
                 ANSWER_PROMPT[answer_prompt_category_1].format(
                     question=json_to_markdown(struct=question, ignore_score=True)
             ))
-            answer_response, history = self.chat_single_round(
+            answer_response, history = yield ChatRequest(
+                stage=answer_stage,
                 prompt=answer_prompt,
                 gt_image=gt_image,
                 ref_image=ref_image,
@@ -613,7 +1174,8 @@ class InferenceEngine:
             answer_response = add_line_sep_before_title(answer_response)
         else:
             answer_prompt = question['question']
-            answer_response, history = self.chat_single_round(
+            answer_response, history = yield ChatRequest(
+                stage=answer_stage,
                 prompt=answer_prompt,
                 gt_image=gt_image,
                 history=None
@@ -623,8 +1185,8 @@ class InferenceEngine:
         if multi_stage and category == 'appearance':
             if not simple_format:
                 try:
-                    answer_response_structured, _ = parse_structured_data(
-                        structured_data=json.loads(markdown_to_json.jsonify(answer_response)),
+                    answer_response_structured, _ = parse_structured_markdown(
+                        markdown=answer_response,
                         target_structure={"Answer": {question['entity']: None}},
                         force_struct_info=False
                     )
@@ -637,7 +1199,8 @@ class InferenceEngine:
                     question_and_exp=json_to_markdown(struct=answer_response_structured, ignore_score=True)
                 )
             )
-            answer_score_response, _ = self.chat_single_round(
+            answer_score_response, _ = yield ChatRequest(
+                stage=f"{category}_answer_stage_2",
                 prompt=answer_score_prompt,
                 gt_image=gt_image,
                 ref_image=ref_image,
@@ -713,7 +1276,8 @@ class InferenceEngine:
                 )
             )
         )
-        answer_response, history = self.chat_single_round(
+        answer_response, history = yield ChatRequest(
+            stage="all_in_one_answer",
             prompt=answer_prompt,
             gt_image=gt_image,
             ref_image=ref_image,
@@ -741,7 +1305,8 @@ class InferenceEngine:
         answer_prompt = self.replace_image_placeholder(
             ABLATION_2_ANSWER_PROMPT[answer_prompt_category].format(questions=json_to_markdown(struct=question_list, ignore_score=True)
         ))
-        answer_response, history = self.chat_single_round(
+        answer_response, history = yield ChatRequest(
+            stage=f"{category}_answer",
             prompt=answer_prompt,
             gt_image=gt_image,
             ref_image=ref_image,
@@ -760,25 +1325,28 @@ class InferenceEngine:
 
         return answer_output, history
     
-    def _eval_core(self, answer_output: dict, category: str, structure_info: dict, gt_image: str, history = None, multi_stage: bool = False, simple_format: bool = False):
+    def _eval_core(self, answer_output: dict, category: str, structure_info: dict, gt_image: str, history = None, multi_stage: bool = False, simple_format: bool = False, render_cache: RenderCache = None):
+        if render_cache is None:
+            render_cache = RenderCache(metrics=self.metrics)
         entity = answer_output['entity'] if 'entity' in answer_output else None
         
         eval_prompt_category_1 = f"{category}"
         eval_prompt_category_2 = f"{category} - stage_2"
+        eval_stage = f"{category}_eval"
         if multi_stage:
             eval_prompt_category_1 += ' - stage_1'
+            eval_stage += '_stage_1'
         
         if not simple_format:
             eval_prompt = EVALUATION_PROMPT[eval_prompt_category_1].format(
                 answer=answer_output['response'],
-                structure_info=json_to_markdown(
-                    struct=structure_info
-                )
+                structure_info=render_cache.render("structure_info", structure_info)
             )
         else:
             eval_prompt = f"Give an explanation for the answer according to the image.\nAnswer: {answer_output['response']}"
             
-        eval_response, _ = self.chat_single_round(
+        eval_response, _ = yield ChatRequest(
+            stage=eval_stage,
             prompt=eval_prompt,
             gt_image=gt_image,
             ref_image=None,
@@ -789,8 +1357,8 @@ class InferenceEngine:
         if multi_stage:
             if not simple_format:
                 try:
-                    eval_response_structured, _ = parse_structured_data(
-                        structured_data=json.loads(markdown_to_json.jsonify(eval_response)),
+                    eval_response_structured, _ = parse_structured_markdown(
+                        markdown=eval_response,
                         target_structure={"Evaluation": {entity: None} if entity is not None else None},
                         force_struct_info=False
                     )
@@ -810,13 +1378,13 @@ class InferenceEngine:
                         struct=eval_response_structured,
                         ignore_score=True
                     ),
-                    structure_info=json_to_markdown(
-                        struct=structure_info
-                    )
+                    # in the simple format the answers are filled into the structure information, it is rendered anew
+                    structure_info=json_to_markdown(struct=structure_info) if simple_format else render_cache.render("structure_info", structure_info)
                 )
             )
             
-            eval_score_response, _ = self.chat_single_round(
+            eval_score_response, _ = yield ChatRequest(
+                stage=f"{category}_eval_stage_2",
                 prompt=eval_score_prompt,
                 gt_image=gt_image,
                 ref_image=None,
@@ -875,15 +1443,16 @@ class InferenceEngine:
         
         return eval_output, eval_output_stage_1, eval_output_stage_2
     
-    def _eval_core_ablation_1(self, answer_output: dict, structure_info: dict, gt_image: str, history = None, sample_index: int = None):
+    def _eval_core_ablation_1(self, answer_output: dict, structure_info: dict, gt_image: str, history = None, sample_index: int = None, render_cache: RenderCache = None):
+        if render_cache is None:
+            render_cache = RenderCache(metrics=self.metrics)
         eval_prompt = EVAL_TEMPLATE_ABLATION_1.format(
             answers=answer_output['response'],
-            structure_info=json_to_markdown(
-                struct=structure_info
-            )
+            structure_info=render_cache.render("structure_info", structure_info)
         )
         
-        eval_response, _ = self.chat_single_round(
+        eval_response, _ = yield ChatRequest(
+            stage="all_in_one_eval",
             prompt=eval_prompt,
             gt_image=None,
             ref_image=None
@@ -901,15 +1470,16 @@ class InferenceEngine:
         
         return eval_output
     
-    def _eval_core_ablation_2(self, answer_output: str, category: str, structure_info: dict, gt_image: str, history = None, sample_index: int = None):
+    def _eval_core_ablation_2(self, answer_output: str, category: str, structure_info: dict, gt_image: str, history = None, sample_index: int = None, render_cache: RenderCache = None):
+        if render_cache is None:
+            render_cache = RenderCache(metrics=self.metrics)
         eval_prompt = ABLATION_2_EVAL_PROMPT[category].format(
             answers=answer_output['response'],
-            structure_info=json_to_markdown(
-                struct=structure_info
-            )
+            structure_info=render_cache.render("structure_info", structure_info)
         )
         
-        eval_response, _ = self.chat_single_round(
+        eval_response, _ = yield ChatRequest(
+            stage=f"{category}_eval",
             prompt=eval_prompt,
             gt_image=gt_image,
             ref_image=None
@@ -987,7 +1557,21 @@ class InferenceEngine:
             evaluations["Relationship Attribute Consistency Answers"] += eval_text
         return evaluations
     
-    def summarize_stage(self, gt_image: str, structure_info: dict, evaluation_map: dict, sample_index: int, multi_stage: bool = False, separate_aspects: bool = False, ablation: int = None):
+    def summarize_stage(self, gt_image: str, structure_info: dict, evaluation_map: dict, sample_index: int, multi_stage: bool = False, separate_aspects: bool = False, ablation: int = None, context: PipelineContext = None):
+        if context is None:
+            context = PipelineContext(sample_index=sample_index, output_mapper=self.output_mapper, metrics=self.metrics)
+        return self._run_steps(self._summarize_stage(
+            gt_image=gt_image,
+            structure_info=structure_info,
+            evaluation_map=evaluation_map,
+            sample_index=sample_index,
+            context=context,
+            multi_stage=multi_stage,
+            separate_aspects=separate_aspects,
+            ablation=ablation
+        ), context=context)
+    
+    def _summarize_stage(self, gt_image: str, structure_info: dict, evaluation_map: dict, sample_index: int, context: PipelineContext, multi_stage: bool = False, separate_aspects: bool = False, ablation: int = None):
         if sample_index in self.progress_map["summarize"] and not multi_stage:
             if not separate_aspects:
                 output_samples = {category: self.progress_map[category][sample_index] for category in self.categories_overall_summary if "stage" not in category}
@@ -1008,47 +1592,53 @@ class InferenceEngine:
             )
             
             if not separate_aspects:
-                output_samples = self._summarize_core(
+                output_samples = yield from self._summarize_core(
                     gt_image=gt_image,
                     structure_info=structure_info,
                     evaluations=reformatted_evaluations,
-                    multi_stage=multi_stage
+                    multi_stage=multi_stage,
+                    render_cache=context.render_cache
                 )
             else:
-                output_samples = self._summarize_core_separate_aspects(
+                output_samples = yield from self._summarize_core_separate_aspects(
                     gt_image=gt_image,
                     structure_info=structure_info,
                     evaluations=reformatted_evaluations,
-                    multi_stage=multi_stage
+                    multi_stage=multi_stage,
+                    render_cache=context.render_cache
                 )
             
             for sample_category, sample in output_samples.items():
                 sample['id'] = sample_index
                 
-                self.output_mapper[sample_category].append(json.dumps(obj=sample, ensure_ascii=False) + "\n")
+                context.output_mapper[sample_category].append(json.dumps(obj=sample, ensure_ascii=False) + "\n")
                 # with open(self.output_file_mapper[sample_category], "a+", encoding="utf-8") as f:
                 #     f.write(json.dumps(obj=sample, ensure_ascii=False) + "\n")
             tqdm.write(f"  stage 4 (summarize): generating completed")
             
+        context.summary = output_samples
         return output_samples
     
-    def _summarize_core(self, gt_image: str, structure_info: dict, evaluations: dict, multi_stage: bool = False):
+    def _summarize_core(self, gt_image: str, structure_info: dict, evaluations: dict, multi_stage: bool = False, render_cache: RenderCache = None):
+        if render_cache is None:
+            render_cache = RenderCache(metrics=self.metrics)
         output_samples = {}
         summarize_prompt = self.replace_image_placeholder(
             text=(OVERALL_SUMMARIZE_TEMPLATE if not multi_stage else OVERALL_SUMMARIZE_TEMPLATE_STAGE_1).format(
-                eval_result=json_to_markdown(evaluations),
-                structure_info=json_to_markdown(struct=structure_info),
+                eval_result=render_cache.render("evaluations", evaluations),
+                structure_info=render_cache.render("structure_info", structure_info),
             )
         )
-        summarize_response, _ = self.chat_single_round(
+        summarize_response, _ = yield ChatRequest(
+            stage="summarize" if not multi_stage else "summarize_stage_1",
             prompt=summarize_prompt,
             gt_image=gt_image,
             ref_image=None,
             history=None
         )
         summarize_response = add_line_sep_before_title(summarize_response)
-        summarize_response_structured, _ = parse_structured_data(
-            structured_data=json.loads(markdown_to_json.jsonify('## Overall Evaluation\n' + summarize_response)),
+        summarize_response_structured, _ = parse_structured_markdown(
+            markdown='## Overall Evaluation\n' + summarize_response,
             target_structure=OVERALL_STRUCTURE_TEMPLATE,
             match_questions=False,
             force_struct_info=False
@@ -1069,17 +1659,18 @@ class InferenceEngine:
         if multi_stage:
             summarize_score_prompt = self.replace_image_placeholder(
                 text=OVERALL_SUMMARIZE_TEMPLATE_STAGE_2.format(
-                    eval_result_and_exp=json_to_markdown(evaluations)
+                    eval_result_and_exp=render_cache.render("evaluations", evaluations)
                     + "\n# Overall Evaluation\n"
                     + json_to_markdown(
                         summarize_response_structured['Overall Evaluation'],
                         is_overall_eval=True,
                         ignore_score=True
                     ),
-                    structure_info=json_to_markdown(struct=structure_info),
+                    structure_info=render_cache.render("structure_info", structure_info),
                 )
             )
-            summarize_score_response, _ = self.chat_single_round(
+            summarize_score_response, _ = yield ChatRequest(
+                stage="summarize_stage_2",
                 prompt=summarize_score_prompt,
                 gt_image=gt_image,
                 ref_image=None,
@@ -1097,7 +1688,9 @@ class InferenceEngine:
             }
         return output_samples
     
-    def _summarize_core_separate_aspects(self, gt_image: str, structure_info: dict, evaluations: dict, multi_stage: bool = False):
+    def _summarize_core_separate_aspects(self, gt_image: str, structure_info: dict, evaluations: dict, multi_stage: bool = False, render_cache: RenderCache = None):
+        if render_cache is None:
+            render_cache = RenderCache(metrics=self.metrics)
         output_samples = {}
         result_dict = {}
         for category in list(category_long_to_short.keys()):
@@ -1105,19 +1698,20 @@ class InferenceEngine:
             sample_category = category_long_to_short[category] + '_summary' if not multi_stage else category_long_to_short[category] + '_summary_stage_1'
             category_summarize_prompt = self.replace_image_placeholder(
                 text=SUMMARIZE_PROMPT[prompt_category].format(
-                    eval_result=json_to_markdown({f"{category} Answers": evaluations[f"{category} Answers"]}),
-                    structure_info=json_to_markdown(struct=structure_info),
+                    eval_result=render_cache.render(f"evaluations/{category}", {f"{category} Answers": evaluations[f"{category} Answers"]}),
+                    structure_info=render_cache.render("structure_info", structure_info),
                 )
             )
-            category_summarize_response, _ = self.chat_single_round(
+            category_summarize_response, _ = yield ChatRequest(
+                stage=sample_category,
                 prompt=category_summarize_prompt,
                 gt_image=gt_image,
                 ref_image=None,
                 history=None
             )
             category_summarize_response = add_line_sep_before_title(category_summarize_response)
-            category_summarize_response_structured, _ = parse_structured_data(
-                structured_data=json.loads(markdown_to_json.jsonify('## Overall Evaluation\n' + category_summarize_response)),
+            category_summarize_response_structured, _ = parse_structured_markdown(
+                markdown='## Overall Evaluation\n' + category_summarize_response,
                 target_structure={"Overall Evaluation": {f"{category} Summary": None}},
                 match_questions=False,
                 force_struct_info=False
@@ -1139,17 +1733,18 @@ class InferenceEngine:
                 sample_category = category_long_to_short[category] + '_summary_stage_2'
                 category_score_prompt = self.replace_image_placeholder(
                     text=SUMMARIZE_PROMPT[prompt_category].format(
-                        eval_result_and_exp=json_to_markdown({f"{category} Answers": evaluations[f"{category} Answers"]})
+                        eval_result_and_exp=render_cache.render(f"evaluations/{category}", {f"{category} Answers": evaluations[f"{category} Answers"]})
                         + "\n# Overall Evaluation\n"
                         + json_to_markdown(
                             category_summarize_response_structured["Overall Evaluation"],
                             is_overall_eval=True,
                             ignore_score=True,
                         ),
-                        structure_info=json_to_markdown(struct=structure_info),
+                        structure_info=render_cache.render("structure_info", structure_info),
                     )
                 )
-                category_score_response, _ = self.chat_single_round(
+                category_score_response, _ = yield ChatRequest(
+                    stage=sample_category,
                     prompt=category_score_prompt,
                     gt_image=gt_image,
                     ref_image=None,
@@ -1172,20 +1767,21 @@ class InferenceEngine:
         # merge all aspects
         summarize_prompt = self.replace_image_placeholder(
             text=(MERGE_SUMMARIZE_TEMPLATE if not multi_stage else MERGE_SUMMARIZE_TEMPLATE_STAGE_1).format(
-                eval_result=json_to_markdown(evaluations)
+                eval_result=render_cache.render("evaluations", evaluations)
                 + "\n# Overall Evaluation\n"
-                + json_to_markdown(result_dict, is_overall_eval=True),
-                structure_info=json_to_markdown(struct=structure_info),
+                + render_cache.render("overall_evaluation", result_dict, is_overall_eval=True),
+                structure_info=render_cache.render("structure_info", structure_info),
             )
         )
-        summarize_response, _ = self.chat_single_round(
+        summarize_response, _ = yield ChatRequest(
+            stage="summarize" if not multi_stage else "summarize_stage_1",
             prompt=summarize_prompt,
             gt_image=gt_image,
             ref_image=None,
             history=None
         )
-        summarize_response_structured, _ = parse_structured_data(
-            structured_data=json.loads(markdown_to_json.jsonify('## Overall Evaluation\n' + summarize_response)),
+        summarize_response_structured, _ = parse_structured_markdown(
+            markdown='## Overall Evaluation\n' + summarize_response,
             target_structure={"Overall Evaluation": {"Overall Score": None}},
             match_questions=False,
             force_struct_info=False
@@ -1205,22 +1801,19 @@ class InferenceEngine:
         if multi_stage:
             summarize_score_prompt = self.replace_image_placeholder(
                 text=MERGE_SUMMARIZE_TEMPLATE_STAGE_2.format(
-                    eval_result_and_exp=json_to_markdown(evaluations)
+                    eval_result_and_exp=render_cache.render("evaluations", evaluations)
                     + "\n# Overall Evaluation\n"
-                    + json_to_markdown(
-                        result_dict,
-                        is_overall_eval=True,
-                        ignore_score=False
-                    )
+                    + render_cache.render("overall_evaluation", result_dict, is_overall_eval=True)
                     + json_to_markdown(
                         summarize_response_structured["Overall Evaluation"],
                         is_overall_eval=True,
                         ignore_score=True
                     ),
-                    structure_info=json_to_markdown(struct=structure_info),
+                    structure_info=render_cache.render("structure_info", structure_info),
                 )
             )
-            summarize_score_response, _ = self.chat_single_round(
+            summarize_score_response, _ = yield ChatRequest(
+                stage="summarize_stage_2",
                 prompt=summarize_score_prompt,
                 gt_image=gt_image,
                 ref_image=None,
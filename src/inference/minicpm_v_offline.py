@@ -1,11 +1,24 @@
+import threading
 from PIL import Image
+from typing import List
+from concurrent.futures import ThreadPoolExecutor
 from vllm import LLM, SamplingParams
 from transformers import AutoTokenizer
-from src.inference.inference_engine import InferenceEngine
+from src.inference.inference_engine import InferenceEngine, ChatRequest
+from src.utils.image_cache import ImageCache
+
+
+def load_rgb_image(image_path: str) -> Image.Image:
+    return Image.open(image_path).convert("RGB")
+
+
+def get_rgb_image_size(image: Image.Image) -> int:
+    return image.width * image.height * 3
 
 
 class MiniCPMVOfflineInferenceEngine(InferenceEngine):
-    def init_model(self, model_name_or_path: str):
+    def init_model(self, model_name_or_path: str, image_cache_bytes: int = 1024 * 1024 * 1024, prefetch_samples: int = 0):
+        self.model_name_or_path = model_name_or_path
         self.tokenizer = AutoTokenizer.from_pretrained(model_name_or_path, trust_remote_code=True)
         self.model = LLM(model=model_name_or_path, trust_remote_code=True, limit_mm_per_prompt={"image": 2}, max_model_len=8192, enforce_eager=True)
         self.image_placeholder = "(<image>./</image>)"
@@ -17,6 +30,33 @@ class MiniCPMVOfflineInferenceEngine(InferenceEngine):
             stop_token_ids=stop_token_ids, 
             max_tokens=2048
         )
+        
+        # decoded images are shared by all questions and stages of a sample, decode each of them once
+        self.image_cache = ImageCache(loader=load_rgb_image, max_bytes=image_cache_bytes, sizeof=get_rgb_image_size)
+        
+        # images of the next `prefetch_samples` samples are decoded in background while the GPU generates
+        self.prefetch_samples = prefetch_samples
+        self.prefetch_executor = ThreadPoolExecutor(max_workers=2) if prefetch_samples > 0 else None
+        self.prefetch_lock = threading.Lock()
+        self.prefetched_until = 0
+    
+    def prefetch(self, sample_index: int):
+        if self.prefetch_executor is None or sample_index is None:
+            return
+        
+        with self.prefetch_lock:
+            start = max(self.prefetched_until, sample_index + 1)
+            end = min(sample_index + 1 + self.prefetch_samples, len(self.dataset))
+            self.prefetched_until = max(self.prefetched_until, end)
+        
+        for i in range(start, end):
+            for image_path in (self.dataset[i]['gt_image'], self.dataset[i]['ref_image']):
+                if image_path is not None:
+                    # failures are ignored here, they are raised again when the image is actually needed
+                    self.prefetch_executor.submit(self.image_cache.get, image_path)
+    
+    def response_cache_namespace(self) -> dict:
+        return {"engine": "minicpm_v_offline", "model": self.model_name_or_path, "sampling_params": repr(self.sampling_params)}
     
     def replace_image_placeholder(self, text: str) -> str:
         text_splits = text.split(self.orig_image_placeholder)
@@ -33,7 +73,7 @@ class MiniCPMVOfflineInferenceEngine(InferenceEngine):
                     new_content += item['text']
                 elif item['type'] == 'image_url':
                     new_content += self.image_placeholder
-                    images.append(Image.open(item['image_url']['url']).convert("RGB"))
+                    images.append(self.image_cache.get(item['image_url']['url']))
                 else:
                     raise ValueError(f"the type of message item must be text or image_url, but got {item['type']}.")
             
@@ -57,7 +97,7 @@ class MiniCPMVOfflineInferenceEngine(InferenceEngine):
         
         return inputs
     
-    def chat_single_round(self, prompt: str, gt_image: str = None, ref_image: str = None, history=None, retry: bool = False) -> tuple:
+    def build_messages(self, prompt: str, gt_image: str = None, ref_image: str = None, history=None) -> list:
         content = []
         if gt_image is not None and history is None:
             splits = prompt.split('<ImageHere>')
@@ -140,21 +180,62 @@ class MiniCPMVOfflineInferenceEngine(InferenceEngine):
                     "content": content
                 }
             ]
-
-        model_inputs = self.convert_openai_messages_to_minicpm_v_inputs(messages=messages)
-
-        outputs = self.model.generate(model_inputs, sampling_params=self.sampling_params)
-
-        history = messages + [
+        
+        return messages
+    
+    def build_history(self, messages: list, response: str) -> list:
+        return messages + [
             {
                 "role": "assistant",
                 "content": [
                     {
                         "type": "text",
-                        "text": outputs[0].outputs[0].text
+                        "text": response
                     }
                 ]
             }
         ]
+    
+    def chat_single_round(self, prompt: str, gt_image: str = None, ref_image: str = None, history=None, retry: bool = False) -> tuple:
+        messages = self.build_messages(prompt=prompt, gt_image=gt_image, ref_image=ref_image, history=history)
+
+        model_inputs = self.convert_openai_messages_to_minicpm_v_inputs(messages=messages)
+
+        outputs = self.model.generate(model_inputs, sampling_params=self.sampling_params)
+        
+        return outputs[0].outputs[0].text, self.build_history(messages=messages, response=outputs[0].outputs[0].text)
+    
+    def _dispatch(self, request: ChatRequest) -> tuple:
+        self.prefetch(request.sample_index)
+        return super()._dispatch(request)
+    
+    def chat_batch(self, requests: List[ChatRequest]) -> List[tuple]:
+        self.prefetch(max((request.sample_index for request in requests if request.sample_index is not None), default=None))
+        
+        all_messages = [
+            self.build_messages(prompt=request.prompt, gt_image=request.gt_image, ref_image=request.ref_image, history=request.history)
+            for request in requests
+        ]
+        model_inputs = [self.convert_openai_messages_to_minicpm_v_inputs(messages=messages) for messages in all_messages]
+        
+        # vLLM schedules the whole batch with continuous batching, outputs keep the order of the inputs
+        outputs = self.model.generate(model_inputs, sampling_params=self.sampling_params, use_tqdm=False)
+        
+        return [
+            (output.outputs[0].text, self.build_history(messages=messages, response=output.outputs[0].text))
+            for messages, output in zip(all_messages, outputs)
+        ]
+    
+    def close(self):
+        super().close()
+        if self.prefetch_executor is not None:
+            # images not decoded yet are not needed anymore
+            self.prefetch_executor.shutdown(cancel_futures=True)
+
+    def inference(self, granularity: str, **kwargs):
+        self.prefetched_until = 0
+        super().inference(granularity=granularity, **kwargs)
         
-        return outputs[0].outputs[0].text, history
+        stats = self.image_cache.get_stats()
+        print(f"[!] image cache: {stats['hits']} hits, {stats['misses']} misses (hit rate {round(stats['hit_rate'] * 100, 2)}%), "
+              f"{stats['entries']} entries, {round(stats['bytes'] / 1024 / 1024, 2)} MiB, {stats['evictions']} evictions")
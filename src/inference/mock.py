@@ -0,0 +1,134 @@
+import re
+import time
+import random
+import hashlib
+from src.inference.inference_engine import InferenceEngine
+
+
+MOCK_EXTRACT_RESPONSE = """# Structure Information
+## Intrinsic Attributes
+### cat
+- attribute 1: quantity: one
+- attribute 2: color: black
+- attribute 3: existence: yes
+### sofa
+- attribute 1: quantity: one
+- attribute 2: existence: yes
+## Relationship Attributes
+### sitting on
+- entities involved: cat, sofa
+- value: sitting on
+
+# Questions
+## Appearance Quality Questions
+### cat
+- question1: Is the cat realistic?
+### sofa
+- question1: Is the sofa realistic?
+
+## Intrinsic Attribute Consistency Questions
+### cat
+- question1: How many cats are there?
+- question2: What color is the cat?
+### sofa
+- question1: How many sofas are there?
+
+## Relationship Attribute Consistency Questions
+- question1: Is the cat sitting on the sofa?
+    - entities: cat sofa
+- question2: Is the sofa under the cat?
+    - entities: sofa cat
+
+# Image Caption
+## cat
+- caption: a black cat
+## sofa
+- caption: a sofa
+"""
+
+
+MOCK_ENTITIES = re.findall(r'^## (.+)$', MOCK_EXTRACT_RESPONSE.split('# Image Caption', 1)[1], flags=re.M)
+
+
+def _prompt_question(prompt: str) -> str:
+    # the question a prompt is about is the first `- question:` line of its input data, the questions of the structure
+    # information are keyed `question1`, `question2`, ...
+    match = re.search(r'^\s*- question: (.+)$', prompt.split('# Output template', 1)[0], flags=re.M)
+    return match.group(1).strip() if match is not None else None
+
+
+def _prompt_entity(question: str) -> str:
+    # the first entity of the mock structure named in the question, `{entity name}` of the template
+    positions = []
+    for entity in MOCK_ENTITIES:
+        match = re.search(rf'\b{re.escape(entity)}', question or '')
+        if match is not None:
+            positions.append((match.start(), entity))
+    return min(positions)[1] if len(positions) > 0 else MOCK_ENTITIES[0]
+
+
+def mock_response(prompt: str) -> str:
+    """Canned response for a prompt of `src.prompt`, deterministic in the prompt so that runs are reproducible."""
+    seed = int(hashlib.md5(prompt.encode('utf-8')).hexdigest(), 16)
+    if 'You are an expert in information extraction' in prompt:
+        return MOCK_EXTRACT_RESPONSE
+    if prompt.rstrip().endswith('# Scores'):
+        return ' '.join(str((seed >> (4 * i)) % 11) for i in range(4))
+    if prompt.rstrip().endswith('# Score'):
+        return str(seed % 11)
+
+    # fill in the markdown template the prompt asks for
+    marker = '(Do NOT generate // comment in the template)\n'
+    if marker in prompt:
+        # templates are formatted into the prompts, their variables are in single braces there
+        question = _prompt_question(prompt)
+        lines = []
+        for line in prompt.split(marker, 1)[1].split('\n'):
+            if line.strip() in ('...', ''):
+                continue
+            line = re.sub(r'\{\{?entity name\}\}?', _prompt_entity(question), line)
+            if question is not None:
+                line = re.sub(r'\{\{?question\}\}?', question, line)
+            line = re.sub(r'\{\{?score\}\}?', str(seed % 11), line)
+            line = re.sub(r'\{\{?[^{}]*\}\}?', f'text {seed % 97}', line)
+            lines.append(line)
+        return '\n'.join(lines)
+    return f"Answer {seed % 1000}."
+
+
+class MockInferenceEngine(InferenceEngine):
+    """Engine answering every request with a canned response after a simulated latency, for benchmarks."""
+    def init_model(self, latency: float = 0.0, latency_jitter: float = 0.5, seed: int = 0):
+        # each request sleeps `latency * (1 +- latency_jitter)` seconds
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.random = random.Random(seed)
+        self.num_requests = 0
+
+    def replace_image_placeholder(self, text: str) -> str:
+        text_splits = text.split(self.orig_image_placeholder)
+        text = '<ImageHere>'.join(text_splits)
+        return text
+
+    def build_messages(self, prompt: str, gt_image: str = None, ref_image: str = None, history=None) -> list:
+        content = []
+        if gt_image is not None and history is None:
+            images = [gt_image, ref_image]
+            splits = prompt.split('<ImageHere>')
+            if len(splits) == 1:
+                content.append({'type': 'image_url', 'image_url': {'url': gt_image}})
+            for i, split in enumerate(splits):
+                if i > 0:
+                    content.append({'type': 'image_url', 'image_url': {'url': images[i - 1]}})
+                content.append({'type': 'text', 'text': split})
+        else:
+            content.append({'type': 'text', 'text': prompt})
+        return (history or []) + [{"role": "user", "content": content}]
+
+    def chat_single_round(self, prompt: str, gt_image: str = None, ref_image: str = None, history=None, retry: bool = False) -> tuple:
+        self.num_requests += 1
+        if self.latency > 0:
+            time.sleep(self.latency * (1 + self.latency_jitter * (2 * self.random.random() - 1)))
+        messages = self.build_messages(prompt=prompt, gt_image=gt_image, ref_image=ref_image, history=history)
+        response = mock_response(prompt)
+        return response, messages + [{"role": "assistant", "content": [{"type": "text", "text": response}]}]
@@ -1,8 +1,27 @@
+import time
 import base64
+import httpx
+import random
+import fnmatch
+import asyncio
+import threading
+import openai
 from PIL import Image
+from tqdm import tqdm
 from io import BytesIO
-from openai import OpenAI
-from src.inference.inference_engine import InferenceEngine
+from openai import OpenAI, AsyncOpenAI, DefaultAsyncHttpxClient
+from typing import List, Dict, Union
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from src.inference.inference_engine import InferenceEngine, ChatRequest, CURRENT_REQUEST
+from src.utils.image_cache import ImageCache
+from src.utils.adaptive_concurrency import AdaptiveConcurrencyLimit
+from src.utils.load_balancer import Endpoint, LoadBalancer
+from src.utils.hedging import HedgePolicy
+from src.utils.rate_limiter import RateLimiter, estimate_prompt_tokens
+
+
+# responses telling that the endpoint is overloaded: 429, 5xx, timeouts and refused connections
+OVERLOAD_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
 
 
 def convert_image_path_to_base64(image_path: str) -> str:
@@ -21,25 +40,237 @@ def convert_image_path_to_base64(image_path: str) -> str:
     return f'data:image/{image_format};base64,' + base64_str
 
 
+def is_unprocessed(error: Exception) -> bool:
+    """Whether the API surely did not process a request failing with `error`: the connection to it was never made, or
+    it rejected the request (4xx other than 429, which pauses the rate limits instead)."""
+    if isinstance(error, openai.APIConnectionError):
+        # matched by name: depending on its version, openai raises the exceptions of httpx or of its httpx2 fork
+        return type(error.__cause__).__name__ in ("ConnectError", "ConnectTimeout")
+    if isinstance(error, openai.APIStatusError):
+        return 400 <= error.status_code < 500 and not isinstance(error, openai.RateLimitError)
+    return False
+
+
+def get_retry_delay(error: Exception, attempt: int) -> float:
+    response = getattr(error, 'response', None)
+    if response is not None:
+        try:
+            return min(float(response.headers.get('retry-after')), 60.0)
+        except (TypeError, ValueError):
+            pass
+    return min(0.5 * 2 ** attempt, 8.0) * random.uniform(0.5, 1.0)
+
+
 class OpenAICompatibleInferenceEngine(InferenceEngine):
-    def init_model(self, api_key: str = None, base_url: str = None, model_name: str = None):
+    def init_model(
+        self,
+        api_key: str = None,
+        base_url: Union[str, List[str]] = None,
+        model_name: str = None,
+        image_cache_bytes: int = 256 * 1024 * 1024,
+        max_retries: int = 2,
+        adaptive_concurrency: bool = False,
+        initial_concurrency: int = 4,
+        min_concurrency: int = 1,
+        max_concurrency: int = 256,
+        health_check_interval: float = 10.0,
+        request_timeout: float = None,
+        stage_timeouts: Dict[str, float] = None,
+        hedge_quantile: float = None,
+        max_hedge_ratio: float = 0.1,
+        requests_per_minute: float = None,
+        tokens_per_minute: float = None
+    ):
         if api_key is None:
             api_key = 'pseudo_api_key'
             
         assert base_url is not None
-            
-        self.client = OpenAI(api_key=api_key, base_url=base_url)
+        base_urls = [base_url] if isinstance(base_url, str) else list(base_url)
+        if hedge_quantile is not None and len(base_urls) == 1:
+            # a hedge sent to the replica that is already slow on the request only adds to its load
+            tqdm.write(f"[!] hedging needs several --service-url replicas, it is disabled with a single one")
+            hedge_quantile = None
+        
+        # failed requests are retried here instead of in the client when they can go to another replica, or when an
+        # adaptive concurrency limit, the deadlines, the hedging or the rate limits must see every attempt
+        self.max_retries = max_retries
+        self.engine_retries = (
+            adaptive_concurrency or len(base_urls) > 1 or request_timeout is not None or stage_timeouts or hedge_quantile is not None
+            or requests_per_minute is not None or tokens_per_minute is not None
+        )
+        self.endpoints = [
+            Endpoint(url, client=OpenAI(api_key=api_key, base_url=url, max_retries=0 if self.engine_retries else max_retries))
+            for url in base_urls
+        ]
+        self.client = self.endpoints[0].client
         
         if model_name is None:
             model_name = self.client.models.list().data[0].id
         self.model_name = model_name
+        
+        # every question of a sample sends the same images, encode each of them once per run
+        self.image_url_cache = ImageCache(loader=convert_image_path_to_base64, max_bytes=image_cache_bytes)
+        
+        # one AIMD limit on the requests in flight per endpoint, otherwise the concurrency is fixed by the drivers
+        if adaptive_concurrency:
+            for endpoint in self.endpoints:
+                endpoint.concurrency_limit = AdaptiveConcurrencyLimit(
+                    name=endpoint.url, initial_limit=initial_concurrency, min_limit=min_concurrency, max_limit=max_concurrency
+                )
+        
+        self.load_balancer = LoadBalancer(
+            self.endpoints, health_check=self.check_endpoint, health_check_interval=health_check_interval
+        ) if len(self.endpoints) > 1 else None
+        
+        # deadline of every attempt, `stage_timeouts` maps fnmatch patterns of stage names to seconds
+        self.request_timeout = request_timeout
+        self.stage_timeouts = stage_timeouts or {}
+        
+        # duplicate requests unanswered after the `hedge_quantile` latency of their stage to another replica
+        self.hedge_policy = HedgePolicy(quantile=hedge_quantile, max_ratio=max_hedge_ratio) if hedge_quantile is not None else None
+        self.hedge_executor = ThreadPoolExecutor(
+            max_workers=max(2 * self.max_inflight_samples * self.max_inflight_questions, 4)
+        ) if hedge_quantile is not None else None
+        
+        # requests and tokens per minute of the API key, shared by all the endpoints
+        self.rate_limiter = RateLimiter(
+            requests_per_minute=requests_per_minute, tokens_per_minute=tokens_per_minute
+        ) if requests_per_minute is not None or tokens_per_minute is not None else None
+    
+    def get_request_timeout(self, stage: str) -> float:
+        for pattern, timeout in self.stage_timeouts.items():
+            if fnmatch.fnmatchcase(stage or "", pattern):
+                return timeout
+        return self.request_timeout
+    
+    def check_endpoint(self, endpoint: Endpoint) -> bool:
+        endpoint.client.with_options(timeout=5.0, max_retries=0).models.list()
+        return True
+    
+    def _acquire_endpoint(self, request: ChatRequest, exclude: Endpoint = None) -> Endpoint:
+        if self.load_balancer is None:
+            return self.endpoints[0]
+        return self.load_balancer.acquire(affinity=request.sample_index if request is not None else None, exclude=exclude)
+    
+    def _release_endpoint(self, endpoint: Endpoint, request: ChatRequest, latency: float, error: Exception = None, cancelled: bool = False):
+        stage = request.stage if request is not None else None
+        if endpoint.concurrency_limit is not None:
+            if cancelled:
+                endpoint.concurrency_limit.cancel()
+            else:
+                endpoint.concurrency_limit.release(latency, overloaded=error is not None, key=stage)
+        if self.load_balancer is not None and cancelled:
+            self.load_balancer.cancel(endpoint)
+        elif self.load_balancer is not None:
+            # a 429 comes from a busy replica, not from a failing one
+            self.load_balancer.release(endpoint, failed=error is not None and not isinstance(error, openai.RateLimitError))
+        if isinstance(error, openai.APITimeoutError):
+            self.metrics.incr("deadline_exceeded")
+        elif error is None and not cancelled:
+            self.metrics.observe("request_latency", latency)
+            if self.hedge_policy is not None:
+                self.hedge_policy.observe(stage, latency)
+    
+    def _record_usage(self, request: ChatRequest, prompt_tokens: int, reserved_tokens: int, response=None, error: BaseException = None):
+        """Settle the rate limits reservation of an attempt once it is over: the usage of its response corrects it, a
+        429 pauses the rate limits, a request the API did not process is refunded. Otherwise (deadline exceeded, 5xx,
+        cancelled in flight) the API may have counted the request, and the reservation is kept."""
+        if response is not None:
+            self.rate_limiter.record_usage(prompt_tokens, reserved_tokens, response.usage, key=request.stage if request is not None else None)
+        elif isinstance(error, openai.RateLimitError):
+            self.rate_limiter.pause(get_retry_delay(error, 0))
+        elif error is not None and is_unprocessed(error):
+            self.rate_limiter.refund(reserved_tokens)
+    
+    def _attempt(self, endpoint: Endpoint, messages: list, request: ChatRequest, answered: threading.Event = None) -> str:
+        """Send a request to `endpoint` once, within the rate limits and the deadline of its stage. A request of a
+        hedged pair is not sent (and None is returned) if the other one was `answered` while it waited for its turn."""
+        if self.rate_limiter is not None:
+            prompt_tokens = estimate_prompt_tokens(messages)
+            reserved_tokens = self.rate_limiter.acquire(prompt_tokens, key=request.stage if request is not None else None)
+        if endpoint.concurrency_limit is not None:
+            endpoint.concurrency_limit.acquire()
+        if answered is not None and answered.is_set():
+            if self.rate_limiter is not None:
+                self.rate_limiter.refund(reserved_tokens)
+            self._release_endpoint(endpoint, request, 0.0, cancelled=True)
+            return None
+        start = time.perf_counter()
+        response = None
+        error = None
+        failure = None
+        try:
+            timeout = self.get_request_timeout(request.stage if request is not None else None)
+            response = endpoint.client.chat.completions.create(
+                model=self.model_name, messages=messages, timeout=timeout if timeout is not None else openai.NOT_GIVEN
+            )
+            return response.choices[0].message.content
+        except OVERLOAD_ERRORS as e:
+            error = failure = e
+            raise
+        except BaseException as e:
+            failure = e
+            raise
+        finally:
+            if self.rate_limiter is not None:
+                self._record_usage(request, prompt_tokens, reserved_tokens, response=response, error=failure)
+            self._release_endpoint(endpoint, request, time.perf_counter() - start, error=error)
+    
+    def _hedged_attempt(self, endpoint: Endpoint, messages: list, request: ChatRequest) -> str:
+        """`_attempt`, duplicated to another endpoint if it is still unanswered after the hedge delay of its stage.
+
+        The first successful response wins. The blocking client cannot cancel the other request, its response is
+        discarded when it arrives (or when its deadline expires). If it still waits for its turn, it is not sent.
+        """
+        delay = self.hedge_policy.get_delay(request.stage if request is not None else None) if self.hedge_policy is not None else None
+        if delay is None:
+            return self._attempt(endpoint, messages, request)
+        
+        answered = threading.Event()
+        primary = self.hedge_executor.submit(self._attempt, endpoint, messages, request, answered)
+        done, _ = wait([primary], timeout=delay)
+        if len(done) > 0 or not self.hedge_policy.try_hedge():
+            return primary.result()
+        self.metrics.incr("hedged_requests")
+        hedge = self.hedge_executor.submit(self._attempt, self._acquire_endpoint(request, exclude=endpoint), messages, request, answered)
+        pending = {primary, hedge}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.metrics.incr("hedge_wins")
+                    answered.set()
+                    return future.result()
+            if len(pending) == 0:
+                raise done.pop().exception()
+    
+    def create_chat_completion(self, messages: list) -> str:
+        if not self.engine_retries:
+            response = self.client.chat.completions.create(model=self.model_name, messages=messages)
+            return response.choices[0].message.content
+        
+        request = CURRENT_REQUEST.get()
+        endpoint = None
+        for attempt in range(self.max_retries + 1):
+            endpoint = self._acquire_endpoint(request, exclude=endpoint)
+            try:
+                return self._hedged_attempt(endpoint, messages, request)
+            except OVERLOAD_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(get_retry_delay(e, attempt))
+    
+    def response_cache_namespace(self) -> dict:
+        # sampling settings are the server defaults
+        return {"engine": "openai_compatible", "model": self.model_name}
     
     def replace_image_placeholder(self, text: str) -> str:
         text_splits = text.split(self.orig_image_placeholder)
         text = '<ImageHere>'.join(text_splits)
         return text
     
-    def chat_single_round(self, prompt: str, gt_image: str = None, ref_image: str = None, history=None, retry: bool = False) -> tuple:
+    def build_messages(self, prompt: str, gt_image: str = None, ref_image: str = None, history=None) -> list:
         content = []
         if gt_image is not None and history is None:
             splits = prompt.split('<ImageHere>')
@@ -48,7 +279,7 @@ class OpenAICompatibleInferenceEngine(InferenceEngine):
                     {
                         'type': 'image_url',
                         'image_url': {
-                            'url': convert_image_path_to_base64(image_path=gt_image)
+                            'url': self.image_url_cache.get(gt_image)
                         }
                     },
                     {
@@ -66,7 +297,7 @@ class OpenAICompatibleInferenceEngine(InferenceEngine):
                     {
                         'type': 'image_url',
                         'image_url': {
-                            'url': convert_image_path_to_base64(image_path=gt_image)
+                            'url': self.image_url_cache.get(gt_image)
                         }
                     },
                     {
@@ -84,7 +315,7 @@ class OpenAICompatibleInferenceEngine(InferenceEngine):
                     {
                         'type': 'image_url',
                         'image_url': {
-                            'url': convert_image_path_to_base64(image_path=gt_image)
+                            'url': self.image_url_cache.get(gt_image)
                         }
                     },
                     {
@@ -94,7 +325,7 @@ class OpenAICompatibleInferenceEngine(InferenceEngine):
                     {
                         'type': 'image_url',
                         'image_url': {
-                            'url': convert_image_path_to_base64(image_path=ref_image)
+                            'url': self.image_url_cache.get(ref_image)
                         }
                     },
                     {
@@ -123,20 +354,187 @@ class OpenAICompatibleInferenceEngine(InferenceEngine):
                 }
             ]
 
-        response = self.client.chat.completions.create(
-            model=self.model_name,
-            messages=messages
-        )
-        history = messages + [
+        return messages
+    
+    def build_history(self, messages: list, response: str) -> list:
+        return messages + [
             {
                 "role": "assistant",
                 "content": [
                     {
                         "type": "text",
-                        "text": response.choices[0].message.content
+                        "text": response
                     }
                 ]
             }
         ]
+    
+    def chat_single_round(self, prompt: str, gt_image: str = None, ref_image: str = None, history=None, retry: bool = False) -> tuple:
+        messages = self.build_messages(prompt=prompt, gt_image=gt_image, ref_image=ref_image, history=history)
+        response = self.create_chat_completion(messages=messages)
+        return response, self.build_history(messages=messages, response=response)
+    
+    def print_image_cache_stats(self):
+        stats = self.image_url_cache.get_stats()
+        tqdm.write(f"[!] image cache: {stats['hits']} hits, {stats['misses']} misses (hit rate {round(stats['hit_rate'] * 100, 2)}%), "
+                   f"{stats['entries']} entries, {round(stats['bytes'] / 1024 / 1024, 2)} MiB, {stats['evictions']} evictions")
+    
+    def print_endpoint_stats(self):
+        for endpoint in self.endpoints:
+            if endpoint.concurrency_limit is not None:
+                tqdm.write(f"[!] adaptive concurrency of {endpoint.concurrency_limit.format()}")
+        if self.load_balancer is not None:
+            tqdm.write(f"[!] load balancing over {len(self.endpoints)} endpoints:\n{self.load_balancer.format()}")
+        if self.rate_limiter is not None:
+            tqdm.write(f"[!] rate limits: {self.rate_limiter.format()}")
+    
+    def close(self):
+        super().close()
+        if self.load_balancer is not None:
+            self.load_balancer.stop()
+        if self.hedge_executor is not None:
+            # the losing attempts still running cannot be cancelled, their threads exit once they are answered
+            self.hedge_executor.shutdown(wait=False, cancel_futures=True)
+    
+    def inference(self, granularity: str, **kwargs):
+        super().inference(granularity=granularity, **kwargs)
+        self.print_image_cache_stats()
+        self.print_endpoint_stats()
+
+
+class AsyncOpenAICompatibleInferenceEngine(OpenAICompatibleInferenceEngine):
+    """OpenAI-compatible engine driven by an asyncio event loop.
+
+    All requests of a run to an endpoint share one `AsyncOpenAI` client and its connection pool, so thousands of requests can be
+    outstanding from a single process without threads. `inference` runs `ainference` on a new event loop.
+    """
+    def init_model(self, max_connections: int = 1000, **kwargs):
+        super().init_model(**kwargs)
+        self.max_connections = max_connections
+        self.async_client = None
+    
+    def _create_async_client(self, client: OpenAI) -> AsyncOpenAI:
+        return AsyncOpenAI(
+            api_key=client.api_key,
+            base_url=client.base_url,
+            max_retries=client.max_retries,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections)
+            )
+        )
+    
+    async def _aattempt(self, endpoint: Endpoint, messages: list, request: ChatRequest) -> str:
+        if self.rate_limiter is not None:
+            prompt_tokens = estimate_prompt_tokens(messages)
+            try:
+                reserved_tokens = await self.rate_limiter.aacquire(prompt_tokens, key=request.stage if request is not None else None)
+            except asyncio.CancelledError:
+                if self.load_balancer is not None:
+                    self.load_balancer.cancel(endpoint)
+                raise
+        if endpoint.concurrency_limit is not None:
+            try:
+                await endpoint.concurrency_limit.aacquire()
+            except asyncio.CancelledError:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.refund(reserved_tokens)
+                if self.load_balancer is not None:
+                    self.load_balancer.cancel(endpoint)
+                raise
+        start = time.perf_counter()
+        response = None
+        error = None
+        failure = None
+        cancelled = False
+        try:
+            timeout = self.get_request_timeout(request.stage if request is not None else None)
+            response = await endpoint.async_client.chat.completions.create(
+                model=self.model_name, messages=messages, timeout=timeout if timeout is not None else openai.NOT_GIVEN
+            )
+            return response.choices[0].message.content
+        except OVERLOAD_ERRORS as e:
+            error = failure = e
+            raise
+        except asyncio.CancelledError as e:
+            cancelled = True
+            failure = e
+            raise
+        except BaseException as e:
+            failure = e
+            raise
+        finally:
+            if self.rate_limiter is not None:
+                self._record_usage(request, prompt_tokens, reserved_tokens, response=response, error=failure)
+            self._release_endpoint(endpoint, request, time.perf_counter() - start, error=error, cancelled=cancelled)
+    
+    async def _ahedged_attempt(self, endpoint: Endpoint, messages: list, request: ChatRequest) -> str:
+        """Asynchronous `_hedged_attempt`, the request that loses the race is cancelled (its connection is closed)."""
+        delay = self.hedge_policy.get_delay(request.stage if request is not None else None) if self.hedge_policy is not None else None
+        if delay is None:
+            return await self._aattempt(endpoint, messages, request)
+        
+        primary = asyncio.ensure_future(self._aattempt(endpoint, messages, request))
+        tasks = [primary]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if len(done) > 0 or not self.hedge_policy.try_hedge():
+                return await primary
+            self.metrics.incr("hedged_requests")
+            hedge = asyncio.ensure_future(self._aattempt(self._acquire_endpoint(request, exclude=endpoint), messages, request))
+            tasks.append(hedge)
+            pending = set(tasks)
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.metrics.incr("hedge_wins")
+                        return task.result()
+                if len(pending) == 0:
+                    raise done.pop().exception()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    # retrieved, so that the failure of the losing request is not reported as never retrieved
+                    task.exception()
+    
+    async def acreate_chat_completion(self, messages: list) -> str:
+        if not self.engine_retries:
+            response = await self.async_client.chat.completions.create(model=self.model_name, messages=messages)
+            return response.choices[0].message.content
         
-        return response.choices[0].message.content, history
+        request = CURRENT_REQUEST.get()
+        endpoint = None
+        for attempt in range(self.max_retries + 1):
+            endpoint = self._acquire_endpoint(request, exclude=endpoint)
+            try:
+                return await self._ahedged_attempt(endpoint, messages, request)
+            except OVERLOAD_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(get_retry_delay(e, attempt))
+    
+    async def achat_single_round(self, prompt: str, gt_image: str = None, ref_image: str = None, history=None, retry: bool = False) -> tuple:
+        messages = self.build_messages(prompt=prompt, gt_image=gt_image, ref_image=ref_image, history=history)
+        response = await self.acreate_chat_completion(messages=messages)
+        return response, self.build_history(messages=messages, response=response)
+    
+    async def ainference(self, granularity: str, **kwargs):
+        # the connection pool is bound to the event loop, so clients are created for each run
+        for endpoint in self.endpoints:
+            endpoint.async_client = self._create_async_client(endpoint.client)
+        self.async_client = self.endpoints[0].async_client
+        try:
+            await super().ainference(granularity=granularity, **kwargs)
+        finally:
+            for endpoint in self.endpoints:
+                await endpoint.async_client.close()
+                endpoint.async_client = None
+            self.async_client = None
+    
+    def inference(self, granularity: str, **kwargs):
+        asyncio.run(self.ainference(granularity=granularity, **kwargs))
+        self.print_image_cache_stats()
+        self.print_endpoint_stats()
@@ -0,0 +1,171 @@
+import time
+import asyncio
+import threading
+from collections import deque, defaultdict
+
+
+class AdaptiveConcurrencyLimit:
+    """AIMD limit on the requests in flight to one endpoint, usable from threads and from coroutines.
+
+    The limit doubles every window until the first decrease (slow start, as in TCP), then grows by one per window of
+    `limit` successful requests, as long as the smoothed latency stays within
+    `latency_tolerance` times its baseline, and is multiplied by `backoff` on an overload (429, 5xx, connection error)
+    or on a latency above the tolerance. Only requests started after the last decrease can decrease the limit again, so
+    the failures of one burst count once. Latencies are tracked per key (the pipeline stage): an extract response takes
+    much longer than a score, and only a rise relative to requests of the same kind signals queueing on the server.
+    """
+    def __init__(
+        self,
+        name: str = None,
+        initial_limit: int = 4,
+        min_limit: int = 1,
+        max_limit: int = 256,
+        backoff: float = 0.7,
+        latency_tolerance: float = 2.0,
+        smoothing: float = 0.2,
+        baseline_drift: float = 0.01,
+        throughput_window: float = 10.0
+    ) -> None:
+        assert 1 <= min_limit <= initial_limit <= max_limit
+        assert 0 < backoff < 1 and latency_tolerance > 1
+        self.name = name
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.latency_tolerance = latency_tolerance
+        self.smoothing = smoothing
+        # the baseline follows a server that became slower for good (e.g. longer prompts) instead of pinning the limit
+        self.baseline_drift = baseline_drift
+        self.throughput_window = throughput_window
+
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.async_waiters = deque()
+        self.inflight = 0
+        self.last_decrease = 0.0
+        self.slow_start = True
+        self.smoothed_latency = {}
+        self.baseline_latency = {}
+        self.completions = deque()
+        self.created = time.perf_counter()
+        self.counters = defaultdict(int)
+
+    def current_limit(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    def _try_acquire(self) -> bool:
+        if self.inflight < self.current_limit():
+            self.inflight += 1
+            self.counters["peak_inflight"] = max(self.counters["peak_inflight"], self.inflight)
+            return True
+        return False
+
+    def acquire(self):
+        with self.condition:
+            while not self._try_acquire():
+                self.condition.wait()
+
+    async def aacquire(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                if self._try_acquire():
+                    return
+                waiter = loop.create_future()
+                self.async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self.lock:
+                    if (loop, waiter) in self.async_waiters:
+                        self.async_waiters.remove((loop, waiter))
+                    else:
+                        # woken but cancelled before it could take the slot: pass the wake-up on to the next waiter
+                        self._wake()
+                raise
+
+    def _wake(self):
+        free = self.current_limit() - self.inflight
+        if free <= 0:
+            return
+        self.condition.notify(free)
+        while free > 0 and len(self.async_waiters) > 0:
+            loop, waiter = self.async_waiters.popleft()
+            if not waiter.done():
+                loop.call_soon_threadsafe(lambda waiter=waiter: waiter.done() or waiter.set_result(None))
+                free -= 1
+
+    def release(self, latency: float, overloaded: bool = False, key: str = None):
+        """Return the slot of a request that took `latency` seconds, `overloaded` if the endpoint refused or failed it."""
+        now = time.perf_counter()
+        with self.lock:
+            utilized = self.inflight * 2 >= self.current_limit()
+            self.inflight -= 1
+            started_after_decrease = now - latency >= self.last_decrease
+            if overloaded:
+                self.counters["overloads"] += 1
+                if started_after_decrease:
+                    self._decrease(now)
+            else:
+                self.counters["successes"] += 1
+                self.completions.append(now)
+                self._trim_completions(now)
+                smoothed = self.smoothed_latency.get(key, latency) * (1 - self.smoothing) + latency * self.smoothing
+                self.smoothed_latency[key] = smoothed
+                baseline = min(self.baseline_latency.get(key, smoothed), smoothed)
+                baseline += (smoothed - baseline) * self.baseline_drift
+                self.baseline_latency[key] = baseline
+                if smoothed > baseline * self.latency_tolerance:
+                    if started_after_decrease:
+                        self.counters["latency_backoffs"] += 1
+                        self._decrease(now)
+                elif utilized and self.limit < self.max_limit:
+                    # additive increase, one more slot after a full window of successful requests
+                    increase = 1.0 if self.slow_start else 1 / self.current_limit()
+                    self.limit = min(self.limit + increase, float(self.max_limit))
+            self._wake()
+
+    def cancel(self):
+        """Return the slot of a request abandoned before its end (e.g. the loser of a hedged pair), without feedback."""
+        with self.lock:
+            self.inflight -= 1
+            self._wake()
+
+    def _decrease(self, now: float):
+        self.limit = max(self.limit * self.backoff, float(self.min_limit))
+        self.last_decrease = now
+        self.slow_start = False
+        self.counters["decreases"] += 1
+
+    def _trim_completions(self, now: float):
+        while len(self.completions) > 0 and self.completions[0] < now - self.throughput_window:
+            self.completions.popleft()
+
+    def throughput(self) -> float:
+        """Successful requests per second over the last `throughput_window` seconds."""
+        now = time.perf_counter()
+        with self.lock:
+            self._trim_completions(now)
+            return len(self.completions) / max(min(self.throughput_window, now - self.created), 1e-6)
+
+    def get_stats(self) -> dict:
+        throughput = self.throughput()
+        with self.lock:
+            return {
+                "name": self.name,
+                "limit": self.current_limit(),
+                "inflight": self.inflight,
+                "throughput": throughput,
+                "successes": self.counters["successes"],
+                "overloads": self.counters["overloads"],
+                "latency_backoffs": self.counters["latency_backoffs"],
+                "decreases": self.counters["decreases"],
+                "peak_inflight": self.counters["peak_inflight"]
+            }
+
+    def format(self) -> str:
+        stats = self.get_stats()
+        return (f"{stats['name']}: limit {stats['limit']} (peak {stats['peak_inflight']} in flight), "
+                f"{round(stats['throughput'], 2)} requests/s over the last {self.throughput_window:g}s, "
+                f"{stats['successes']} successes, {stats['overloads']} overloads, {stats['latency_backoffs']} latency backoffs")
@@ -1,24 +1,34 @@
 import os
+import csv
 import json
+import time
+import warnings
+import functools
 import numpy as np
 from scipy import stats
 from tabulate import tabulate
+from concurrent.futures import ProcessPoolExecutor
 
 
-def fill_na(score_list: list, strategy: str = "mean"):
-    for i in range(len(score_list)):
-        if not isinstance(score_list[i], int) and not isinstance(score_list[i], float):
-            score_list[i] = None
+CORRELATION_TYPES = ["spearman", "kendall", "pearson"]
+
+
+def fill_na_array(score_list: list, strategy: str = "mean") -> np.ndarray:
+    """float64 copy of a score series, non-numeric entries (e.g. 'N/A', None) are filled by `strategy`."""
     assert strategy in ["mean", "zero"]
-    if strategy == "mean":
-        arr = np.array(score_list)
-        value = np.mean(np.delete(arr, np.where(arr == None)))
-    else:
-        value = 0
-    for i in range(len(score_list)):
-        if score_list[i] is None:
-            score_list[i] = value
-    return score_list
+    scores = np.asarray(score_list)
+    if scores.dtype.kind in "biuf":
+        # only numbers, nothing to fill
+        return scores.astype(np.float64)
+    missing = np.array([not isinstance(score, (int, float)) for score in score_list], dtype=bool)
+    scores = np.array([score if not is_missing else 0 for score, is_missing in zip(score_list, missing)], dtype=np.float64)
+    if strategy == "mean" and missing.any():
+        scores[missing] = scores[~missing].mean() if not missing.all() else np.nan
+    return scores
+
+
+def fill_na(score_list: list, strategy: str = "mean"):
+    return fill_na_array(score_list, strategy=strategy).tolist()
 
 
 def get_fine_grained_score_mapper(
@@ -92,30 +102,323 @@ def get_coarse_grained_score_mapper(ref_score_list: list, result_score_list: lis
     }
 
 
-def calc_correlation(score_dict: dict, corr_type: str = 'spearman'):
+def _corrcoef_columns(data: np.ndarray) -> np.ndarray:
+    # all pairs at once, NaN for constant columns and columns containing NaN
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlation = np.atleast_2d(np.corrcoef(data, rowvar=False))
+    # rounding in the mean makes constant columns look slightly non-constant
+    constant = (data == data[:1]).all(axis=0)
+    correlation[constant, :] = np.nan
+    correlation[:, constant] = np.nan
+    return correlation
+
+
+def _correlation_pvalue(correlation: np.ndarray, n: int) -> np.ndarray:
+    # two-sided p-value of the t statistic with n - 2 degrees of freedom, as `stats.spearmanr` and `stats.pearsonr`
+    dof = n - 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t = correlation * np.sqrt((dof / ((correlation + 1.0) * (1.0 - correlation))).clip(0))
+    return stats.t.sf(np.abs(t), dof) * 2
+
+
+def calc_correlation_matrix(score_dict: dict, corr_type: str = 'spearman', strategy: str = "mean"):
+    """Correlation and p-value matrices between all score series of `score_dict`, in key order.
+
+    Every series is converted to a float64 column once (missing scores filled by `strategy`, the input is left
+    untouched). Spearman and Pearson correlations are computed for all pairs at once from the (ranked) columns, Kendall
+    falls back to `stats.kendalltau` per pair.
+    """
     keys = list(score_dict.keys())
-    num_keys = len(keys)
-    correlation_matrix = np.zeros((num_keys, num_keys))
-    pvalue_matrix = np.zeros((num_keys, num_keys))
-    for i, key_1 in enumerate(keys):
-        for j, key_2 in enumerate(keys):
-            if i > j:
-                if corr_type == 'spearman':
-                    corr = stats.spearmanr(
-                        fill_na(score_dict[key_1]), fill_na(score_dict[key_2])
-                    )
-                elif corr_type == 'pearson':
-                    corr = stats.pearsonr(
-                        fill_na(score_dict[key_1]), fill_na(score_dict[key_2])
-                    )
-                elif corr_type == 'kendall':
-                    corr = stats.kendalltau(
-                        fill_na(score_dict[key_1]), fill_na(score_dict[key_2])
-                    )
-                else:
-                    raise ValueError(f"[!] invalid correlation type: {corr_type}")
-                correlation_matrix[i][j] = corr.correlation
-                pvalue_matrix[i][j] = corr.pvalue
+    scores = np.column_stack([fill_na_array(score_dict[key], strategy=strategy) for key in keys])
+    num_samples, num_keys = scores.shape
+    if corr_type in ['spearman', 'pearson']:
+        columns = stats.rankdata(scores, axis=0) if corr_type == 'spearman' else scores
+        correlation_matrix = _corrcoef_columns(columns)
+        pvalue_matrix = _correlation_pvalue(correlation_matrix, num_samples)
+    elif corr_type == 'kendall':
+        correlation_matrix = np.eye(num_keys)
+        pvalue_matrix = np.zeros((num_keys, num_keys))
+        for i in range(num_keys):
+            for j in range(i):
+                corr = stats.kendalltau(scores[:, i], scores[:, j])
+                correlation_matrix[i][j] = correlation_matrix[j][i] = corr.correlation
+                pvalue_matrix[i][j] = pvalue_matrix[j][i] = corr.pvalue
+    else:
+        raise ValueError(f"[!] invalid correlation type: {corr_type}")
+    return keys, correlation_matrix, pvalue_matrix
+
+
+# resamples per task of the bootstrap and permutation workers, fixed so that results only depend on the seed
+_RESAMPLES_PER_CHUNK = 500
+# resampled scores materialized at once in a worker
+_MAX_BATCH_ELEMENTS = 1 << 21
+# scores with few distinct values (e.g. 1-5 ratings) are resampled as contingency tables of at most this many cells
+_MAX_TABLE_CELLS = 4096
+
+
+def _encode_column(scores: np.ndarray):
+    # ranks, values and concordance of a resample only depend on the codes of the distinct values
+    levels, codes = np.unique(scores, return_inverse=True)
+    return levels, codes.reshape(-1)
+
+
+def _level_ranks(counts: np.ndarray) -> np.ndarray:
+    # average rank (1-based, as `stats.rankdata`) of every level given the counts of the levels
+    return np.cumsum(counts, axis=-1) - (counts - 1) / 2.0
+
+
+def _batch_pearson(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    x = x - x.mean(axis=1, keepdims=True)
+    y = y - y.mean(axis=1, keepdims=True)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlation = (x * y).sum(axis=1) / np.sqrt((x * x).sum(axis=1) * (y * y).sum(axis=1))
+    return np.clip(correlation, -1.0, 1.0)
+
+
+def _table_correlation(table: np.ndarray, levels_x: np.ndarray, levels_y: np.ndarray, corr_type: str) -> np.ndarray:
+    """Correlations of a batch of contingency tables (batch, len(levels_x), len(levels_y)) of paired codes."""
+    rows = table.sum(axis=2)
+    cols = table.sum(axis=1)
+    if corr_type == "kendall":
+        # tau-b, pairs where the other sample is greater in x and greater (concordant) or lower (discordant) in y
+        greater = table[:, ::-1, ::-1].cumsum(axis=1).cumsum(axis=2)[:, ::-1, ::-1]
+        lower = table[:, ::-1, :].cumsum(axis=1)[:, ::-1, :].cumsum(axis=2)
+        concordant = (table[:, :-1, :-1] * greater[:, 1:, 1:]).sum(axis=(1, 2))
+        discordant = (table[:, :-1, 1:] * lower[:, 1:, :-1]).sum(axis=(1, 2))
+        num_samples = rows.sum(axis=1)
+        total_pairs = num_samples * (num_samples - 1) / 2
+        x_ties = (rows * (rows - 1) / 2).sum(axis=1)
+        y_ties = (cols * (cols - 1) / 2).sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            correlation = (concordant - discordant) / np.sqrt((total_pairs - x_ties) * (total_pairs - y_ties))
+        return np.clip(correlation, -1.0, 1.0)
+
+    if corr_type == "spearman":
+        x, y = _level_ranks(rows), _level_ranks(cols)
+    else:
+        x, y = np.broadcast_to(levels_x, rows.shape), np.broadcast_to(levels_y, cols.shape)
+    num_samples = rows.sum(axis=1, keepdims=True)
+    x = x - (rows * x).sum(axis=1, keepdims=True) / num_samples
+    y = y - (cols * y).sum(axis=1, keepdims=True) / num_samples
+    covariance = np.einsum("bij,bi,bj->b", table, x, y)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        correlation = covariance / np.sqrt((rows * x * x).sum(axis=1) * (cols * y * y).sum(axis=1))
+    # rounding in the means makes constant resamples look slightly non-constant
+    correlation[((rows > 0).sum(axis=1) <= 1) | ((cols > 0).sum(axis=1) <= 1)] = np.nan
+    return np.clip(correlation, -1.0, 1.0)
+
+
+def contingency_correlation(table: np.ndarray, levels_x: list, levels_y: list, corr_type: str = "spearman") -> float:
+    """Correlation of paired scores given by the counts `table[i][j]` of the pairs (`levels_x[i]`, `levels_y[j]`) of
+    their sorted distinct values, e.g. maintained incrementally as scores arrive."""
+    if corr_type not in CORRELATION_TYPES:
+        raise ValueError(f"[!] invalid correlation type: {corr_type}")
+    table = np.asarray(table, dtype=np.float64)
+    if table.sum() < 2:
+        return np.nan
+    return float(_table_correlation(table[None], np.asarray(levels_x, dtype=np.float64), np.asarray(levels_y, dtype=np.float64), corr_type)[0])
+
+
+def _batch_correlation(codes_x: np.ndarray, levels_x: np.ndarray, codes_y: np.ndarray, levels_y: np.ndarray, corr_type: str) -> np.ndarray:
+    """Correlation of every row pair of codes (batch, num_samples), the codes index the sorted distinct values `levels_*`."""
+    num_rows = codes_x.shape[0]
+    num_cells = len(levels_x) * len(levels_y)
+    if num_cells <= _MAX_TABLE_CELLS:
+        offsets = np.arange(num_rows)[:, None] * num_cells
+        table = np.bincount((codes_x * len(levels_y) + codes_y + offsets).ravel(), minlength=num_rows * num_cells)
+        return _table_correlation(table.reshape(num_rows, len(levels_x), len(levels_y)).astype(np.float64), levels_x, levels_y, corr_type)
+
+    if corr_type == "kendall":
+        return np.array([stats.kendalltau(levels_x[x], levels_y[y]).correlation for x, y in zip(codes_x, codes_y)])
+    if corr_type == "spearman":
+        x = np.take_along_axis(_level_ranks(_batch_counts(codes_x, len(levels_x))), codes_x, axis=1)
+        y = np.take_along_axis(_level_ranks(_batch_counts(codes_y, len(levels_y))), codes_y, axis=1)
+    else:
+        x, y = levels_x[codes_x], levels_y[codes_y]
+    return _batch_pearson(x, y)
+
+
+def _batch_counts(codes: np.ndarray, num_levels: int) -> np.ndarray:
+    num_rows = codes.shape[0]
+    offsets = np.arange(num_rows)[:, None] * num_levels
+    return np.bincount((codes + offsets).ravel(), minlength=num_rows * num_levels).reshape(num_rows, num_levels)
+
+
+def _batch_size(num_samples: int, levels: list) -> int:
+    max_levels = max(len(level) for level in levels)
+    return max(1, _MAX_BATCH_ELEMENTS // max(num_samples, min(max_levels * max_levels, _MAX_TABLE_CELLS)))
+
+
+def _bootstrap_chunk(codes: np.ndarray, levels: list, reference: int, corr_type: str, num_resamples: int, seed) -> np.ndarray:
+    """Correlations of every column with the reference column on `num_resamples` bootstrap resamples of the rows."""
+    rng = np.random.default_rng(seed)
+    num_samples, num_keys = codes.shape
+    batch_size = _batch_size(num_samples, levels)
+    result = np.empty((num_resamples, num_keys))
+    for start in range(0, num_resamples, batch_size):
+        indices = rng.integers(0, num_samples, size=(min(batch_size, num_resamples - start), num_samples))
+        codes_y = codes[:, reference][indices]
+        for j in range(num_keys):
+            result[start:start + len(indices), j] = _batch_correlation(codes[:, j][indices], levels[j], codes_y, levels[reference], corr_type)
+    return result
+
+
+def _permutation_chunk(
+    pair_codes: np.ndarray, pair_levels: np.ndarray, reference_codes: np.ndarray, reference_levels: np.ndarray,
+    corr_type: str, num_permutations: int, seed
+) -> np.ndarray:
+    """Correlation differences of the two evaluators when their (standardized) scores are swapped on random samples."""
+    rng = np.random.default_rng(seed)
+    num_samples = len(reference_codes)
+    batch_size = _batch_size(num_samples, [pair_levels, reference_levels])
+    result = np.empty(num_permutations)
+    for start in range(0, num_permutations, batch_size):
+        swap = rng.random((min(batch_size, num_permutations - start), num_samples)) < 0.5
+        codes_y = np.broadcast_to(reference_codes, swap.shape)
+        correlation_1 = _batch_correlation(np.where(swap, pair_codes[:, 1], pair_codes[:, 0]), pair_levels, codes_y, reference_levels, corr_type)
+        correlation_2 = _batch_correlation(np.where(swap, pair_codes[:, 0], pair_codes[:, 1]), pair_levels, codes_y, reference_levels, corr_type)
+        result[start:start + len(swap)] = correlation_1 - correlation_2
+    return result
+
+
+def _map_chunks(chunk_fn, num_resamples: int, seed: int, num_workers: int = None) -> np.ndarray:
+    """Runs `chunk_fn(num_resamples, seed)` on chunks of the resamples, in worker processes if there are several cores."""
+    chunk_sizes = [min(_RESAMPLES_PER_CHUNK, num_resamples - start) for start in range(0, num_resamples, _RESAMPLES_PER_CHUNK)]
+    seeds = np.random.SeedSequence(seed).spawn(len(chunk_sizes))
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+    num_workers = min(num_workers, len(chunk_sizes))
+    if num_workers <= 1:
+        return np.concatenate([chunk_fn(size, chunk_seed) for size, chunk_seed in zip(chunk_sizes, seeds)])
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        return np.concatenate(list(executor.map(chunk_fn, chunk_sizes, seeds)))
+
+
+def _encode_score_dict(score_dict: dict, keys: list, strategy: str):
+    levels, codes, invalid = [], [], []
+    for key in keys:
+        scores = fill_na_array(score_dict[key], strategy=strategy)
+        # a series without any score has no correlation
+        invalid.append(bool(np.isnan(scores).any()))
+        level, code = _encode_column(np.nan_to_num(scores))
+        levels.append(level)
+        codes.append(code)
+    return levels, np.column_stack(codes), np.array(invalid)
+
+
+def bootstrap_correlation(
+    score_dict: dict, reference_key: str, corr_type: str = "spearman", num_resamples: int = 10000, seed: int = 0,
+    num_workers: int = None, strategy: str = "mean"
+):
+    """Correlations of every score series with `score_dict[reference_key]`, on the data and on bootstrap resamples.
+
+    Scores are encoded once as codes of their distinct values, every resample only gathers codes and derives ranks
+    (Spearman) or contingency tables (Kendall) from level counts, vectorized over batches of resamples. Resamples are
+    drawn from `seed` independently of the number of workers, and are the same for any series of the same length.
+
+    Returns the keys, the correlations (num_keys,) and the resampled correlations (num_resamples, num_keys), NaN where
+    a resample is constant.
+    """
+    if corr_type not in CORRELATION_TYPES:
+        raise ValueError(f"[!] invalid correlation type: {corr_type}")
+    keys = list(score_dict.keys())
+    levels, codes, invalid = _encode_score_dict(score_dict, keys, strategy)
+    reference = keys.index(reference_key)
+
+    correlation = np.empty(len(keys))
+    for j in range(len(keys)):
+        correlation[j] = _batch_correlation(codes[None, :, j], levels[j], codes[None, :, reference], levels[reference], corr_type)[0]
+
+    chunk_fn = functools.partial(_bootstrap_chunk, codes, levels, reference, corr_type)
+    resampled = _map_chunks(chunk_fn, num_resamples, seed=seed, num_workers=num_workers)
+    invalid = invalid | invalid[reference]
+    correlation[invalid] = np.nan
+    resampled[:, invalid] = np.nan
+    return keys, correlation, resampled
+
+
+def bootstrap_confidence_intervals(
+    score_dict: dict, reference_key: str, corr_type: str = "spearman", num_resamples: int = 10000,
+    confidence: float = 0.95, seed: int = 0, num_workers: int = None, strategy: str = "mean"
+) -> dict:
+    """Percentile bootstrap confidence intervals of the correlation of every other series with the reference."""
+    keys, correlation, resampled = bootstrap_correlation(
+        score_dict, reference_key, corr_type=corr_type, num_resamples=num_resamples, seed=seed,
+        num_workers=num_workers, strategy=strategy
+    )
+    alpha = (1 - confidence) / 2
+    with warnings.catch_warnings():
+        # all-NaN columns
+        warnings.simplefilter("ignore", RuntimeWarning)
+        ci_low, ci_high = np.nanquantile(resampled, [alpha, 1 - alpha], axis=0)
+        std = np.nanstd(resampled, axis=0)
+    return {
+        key: {"correlation": correlation[j], "ci_low": ci_low[j], "ci_high": ci_high[j], "std": std[j]}
+        for j, key in enumerate(keys) if key != reference_key
+    }
+
+
+def paired_significance_test(
+    score_dict: dict, reference_key: str, key_1: str, key_2: str, corr_type: str = "spearman",
+    method: str = "bootstrap", num_resamples: int = 10000, confidence: float = 0.95, seed: int = 0,
+    num_workers: int = None, strategy: str = "mean"
+) -> dict:
+    """Two-sided test of whether `key_1` and `key_2` correlate equally with `reference_key` on the same samples.
+
+    `bootstrap` resamples the samples jointly for both evaluators and reports a confidence interval of the difference,
+    with the p-value of the shifted (null-centered) bootstrap distribution. `permutation` swaps the standardized scores
+    of the two evaluators on random samples.
+    """
+    if method == "bootstrap":
+        keys, correlation, resampled = bootstrap_correlation(
+            {key: score_dict[key] for key in [key_1, key_2, reference_key]}, reference_key, corr_type=corr_type,
+            num_resamples=num_resamples, seed=seed, num_workers=num_workers, strategy=strategy
+        )
+        observed = correlation[0] - correlation[1]
+        deltas = resampled[:, 0] - resampled[:, 1]
+        deltas = deltas[~np.isnan(deltas)]
+        alpha = (1 - confidence) / 2
+        ci_low, ci_high = np.quantile(deltas, [alpha, 1 - alpha]) if len(deltas) > 0 else (np.nan, np.nan)
+        null_deltas = deltas - observed
+    elif method == "permutation":
+        if corr_type not in CORRELATION_TYPES:
+            raise ValueError(f"[!] invalid correlation type: {corr_type}")
+        pair = np.column_stack([fill_na_array(score_dict[key], strategy=strategy) for key in [key_1, key_2]])
+        reference_levels, reference_codes = _encode_column(np.nan_to_num(fill_na_array(score_dict[reference_key], strategy=strategy)))
+        std = pair.std(axis=0)
+        pair = (pair - pair.mean(axis=0)) / np.where(std > 0, std, 1.0)
+        # both evaluators share the codes of the union of their standardized scores
+        pair_levels, pair_codes = _encode_column(np.nan_to_num(pair).ravel())
+        pair_codes = pair_codes.reshape(pair.shape)
+
+        correlation = [
+            _batch_correlation(pair_codes[None, :, i], pair_levels, reference_codes[None, :], reference_levels, corr_type)[0]
+            for i in range(2)
+        ]
+        observed = correlation[0] - correlation[1]
+        chunk_fn = functools.partial(_permutation_chunk, pair_codes, pair_levels, reference_codes, reference_levels, corr_type)
+        null_deltas = _map_chunks(chunk_fn, num_resamples, seed=seed, num_workers=num_workers)
+        null_deltas = null_deltas[~np.isnan(null_deltas)]
+        ci_low = ci_high = np.nan
+    else:
+        raise ValueError(f"[!] invalid significance test: {method}")
+
+    if np.isnan(observed) or len(null_deltas) == 0:
+        pvalue = np.nan
+    else:
+        # deltas as extreme as the observed one, up to rounding
+        num_extreme = np.count_nonzero(np.abs(null_deltas) >= np.abs(observed) - 1e-12)
+        pvalue = (1 + num_extreme) / (1 + len(null_deltas))
+    return {
+        "method": method, "key_1": key_1, "key_2": key_2, "correlation_1": correlation[0], "correlation_2": correlation[1],
+        "delta": observed, "ci_low": ci_low, "ci_high": ci_high, "pvalue": pvalue
+    }
+
+
+def format_correlation_tables(keys: list, correlation_matrix: np.ndarray, pvalue_matrix: np.ndarray):
+    # only the lower triangle is reported
+    correlation_matrix = np.tril(correlation_matrix, k=-1)
+    pvalue_matrix = np.tril(pvalue_matrix, k=-1)
     corr_table = [[""] + keys]
     for i, key in enumerate(keys):
         corr_table.append([key] + correlation_matrix[i].tolist())
@@ -129,16 +432,147 @@ def calc_correlation(score_dict: dict, corr_type: str = 'spearman'):
     return corr_table, pvalue_table
 
 
+def calc_correlation(score_dict: dict, corr_type: str = 'spearman'):
+    return format_correlation_tables(*calc_correlation_matrix(score_dict, corr_type=corr_type))
+
+
 def get_result(mapper: dict, name: str = None, corr_type: str = 'spearman'):
-    corr, pvalue = calc_correlation(mapper, corr_type=corr_type)
+    keys, correlation_matrix, pvalue_matrix = calc_correlation_matrix(mapper, corr_type=corr_type)
+    corr, pvalue = format_correlation_tables(keys, correlation_matrix, pvalue_matrix)
     print(f"# Result for {name}:")
     print(f"correlation:")
     print(corr)
     print(f"pvalue:")
     print(pvalue)
+    return keys, correlation_matrix, pvalue_matrix
+
+
+def get_bootstrap_result(
+    mapper: dict, name: str = None, corr_type: str = 'spearman', reference_key: str = "manual_score_avg",
+    compare_keys: tuple = ("result_score", "openai_score"), num_resamples: int = 10000, significance_test: str = "bootstrap",
+    confidence: float = 0.95, seed: int = 0, num_workers: int = None
+):
+    intervals = bootstrap_confidence_intervals(
+        mapper, reference_key, corr_type=corr_type, num_resamples=num_resamples, confidence=confidence, seed=seed,
+        num_workers=num_workers
+    )
+    print(f"# Bootstrap {confidence:.0%} confidence intervals for {name} ({num_resamples} resamples, reference: {reference_key}):")
+    print(tabulate(
+        [[key, value["correlation"], value["ci_low"], value["ci_high"], value["std"]] for key, value in intervals.items()],
+        headers=["", "correlation", "ci_low", "ci_high", "std"]
+    ))
+    if compare_keys is None:
+        return intervals, None
+    key_1, key_2 = compare_keys
+    test = paired_significance_test(
+        mapper, reference_key, key_1, key_2, corr_type=corr_type, method=significance_test, num_resamples=num_resamples,
+        confidence=confidence, seed=seed, num_workers=num_workers
+    )
+    print(f"paired {significance_test} test, {key_1} - {key_2}: delta = {test['delta']:.4f}", end="")
+    if significance_test == "bootstrap":
+        print(f", {confidence:.0%} CI = [{test['ci_low']:.4f}, {test['ci_high']:.4f}]", end="")
+    print(f", pvalue = {test['pvalue']:.4g}")
+    return intervals, test
+
+
+REPORT_CSV_FIELDS = [
+    "category", "corr_type", "key_1", "key_2", "correlation", "pvalue", "n", "missing_1", "missing_2", "ci_low", "ci_high"
+]
+
+
+def _json_value(value):
+    # numpy scalars to plain Python, NaN to null so that the report is strict JSON
+    if isinstance(value, dict):
+        return {key: _json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_json_value(item) for item in value]
+    if isinstance(value, (np.floating, float)):
+        return None if np.isnan(value) else float(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+def count_missing_scores(score_list: list) -> int:
+    """Number of scores that are filled by `fill_na_array` (e.g. 'N/A', None)."""
+    return sum(not isinstance(score, (int, float)) for score in score_list)
+
+
+def build_category_report(
+    score_dict: dict, results: dict, reference_key: str = None, bootstrap_results: dict = None
+) -> dict:
+    """Report of one category: score counts of every evaluator and, per correlation type, all evaluator pairs of the
+    lower triangle (`results[corr_type]` is the output of `calc_correlation_matrix`), with the bootstrap confidence
+    intervals and paired test of `bootstrap_results[corr_type]` if any."""
+    report = {
+        "evaluators": {key: {"n": len(scores), "missing": count_missing_scores(scores)} for key, scores in score_dict.items()}
+    }
+    for corr_type, (keys, correlation_matrix, pvalue_matrix) in results.items():
+        intervals, test = (bootstrap_results or {}).get(corr_type, (None, None))
+        pairs = []
+        for i, key_1 in enumerate(keys):
+            for j, key_2 in enumerate(keys[:i]):
+                pair = {
+                    "key_1": key_1, "key_2": key_2, "correlation": correlation_matrix[i][j], "pvalue": pvalue_matrix[i][j],
+                    "n": len(score_dict[key_1]), "missing_1": report["evaluators"][key_1]["missing"],
+                    "missing_2": report["evaluators"][key_2]["missing"], "ci_low": None, "ci_high": None
+                }
+                other = key_2 if key_1 == reference_key else key_1 if key_2 == reference_key else None
+                if intervals is not None and other is not None:
+                    pair["ci_low"], pair["ci_high"] = intervals[other]["ci_low"], intervals[other]["ci_high"]
+                pairs.append(pair)
+        report[corr_type] = {"pairs": pairs}
+        if intervals is not None:
+            report[corr_type]["bootstrap"] = intervals
+        if test is not None:
+            report[corr_type]["paired_test"] = test
+    return _json_value(report)
+
+
+def write_correlation_report(report: dict, result_dir: str, history_file: str = None):
+    """Writes `correlation-report.json` and the flat `correlation-report.csv` (one row per evaluator pair) to
+    `result_dir`, and appends a one-line summary (correlations with the reference evaluator) to `history_file`."""
+    with open(os.path.join(result_dir, "correlation-report.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+
+    with open(os.path.join(result_dir, "correlation-report.csv"), "w", encoding="utf-8", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_CSV_FIELDS)
+        writer.writeheader()
+        for category, category_report in report["categories"].items():
+            for corr_type in CORRELATION_TYPES:
+                for pair in category_report.get(corr_type, {}).get("pairs", []):
+                    writer.writerow({"category": category, "corr_type": corr_type, **pair})
+
+    if history_file is None:
+        return
+    reference_key = report["reference_key"]
+    summary = {key: report[key] for key in ["created", "result_dir", "ref_score_file", "num_samples", "num_missing_samples", "reference_key"]}
+    summary["categories"] = {}
+    for category, category_report in report["categories"].items():
+        summary["categories"][category] = {"missing": {key: value["missing"] for key, value in category_report["evaluators"].items()}}
+        for corr_type in CORRELATION_TYPES:
+            if corr_type not in category_report:
+                continue
+            summary["categories"][category][corr_type] = {
+                pair["key_1"] if pair["key_2"] == reference_key else pair["key_2"]: [pair["correlation"], pair["pvalue"]]
+                for pair in category_report[corr_type]["pairs"] if reference_key in (pair["key_1"], pair["key_2"])
+            }
+    with open(history_file, "a", encoding="utf-8") as f:
+        f.write(json.dumps(summary, ensure_ascii=False) + "\n")
 
 
-def calc_correlation_from_result_dir(result_dir: str, ref_score_file: str, ):
+def calc_correlation_from_result_dir(
+    result_dir: str, ref_score_file: str, num_resamples: int = 0, significance_test: str = "bootstrap",
+    reference_key: str = "manual_score_avg", compare_keys: tuple = ("result_score", "openai_score"),
+    confidence: float = 0.95, seed: int = 0, num_workers: int = None, history_file: str = None
+):
+    """Prints the correlations between all evaluators, and with `num_resamples` > 0 the bootstrap confidence intervals
+    of their correlation with `reference_key` and a paired significance test of `compare_keys`.
+
+    The same results are written to `correlation-report.json` / `.csv` in `result_dir`, and summarized in
+    `history_file` to follow evaluators across runs. It defaults to `correlation-history.jsonl` next to
+    `ref_score_file`, so that all the runs scored against the same reference share it.
+    """
     with open(ref_score_file, "r+", encoding="utf-8") as f:
         ref_scores = json.load(f)
     
@@ -148,12 +582,41 @@ def calc_correlation_from_result_dir(result_dir: str, ref_score_file: str, ):
         result_scores = [json.loads(line) for line in f.readlines()]
     
     mapper = get_coarse_grained_score_mapper(ref_scores, result_scores)
+    bootstrap_kwargs = dict(
+        reference_key=reference_key, compare_keys=compare_keys, num_resamples=num_resamples,
+        significance_test=significance_test, confidence=confidence, seed=seed, num_workers=num_workers
+    )
+    results = {category: {} for category in mapper}
+    bootstrap_results = {category: {} for category in mapper}
     
     print('\n' + '*' * 20 + '\nSpearman Correlation\n' + '*' * 20 + '\n')
     for key, value in mapper.items():
-        get_result(value, key, 'spearman')
+        results[key]['spearman'] = get_result(value, key, 'spearman')
+        if num_resamples > 0:
+            bootstrap_results[key]['spearman'] = get_bootstrap_result(value, key, 'spearman', **bootstrap_kwargs)
 
     print('\n' + '*' * 19 + '\nKendall Correlation\n' + '*' * 19 + '\n')
     for key, value in mapper.items():
-        get_result(value, key, 'kendall')
-    
\ No newline at end of file
+        results[key]['kendall'] = get_result(value, key, 'kendall')
+        if num_resamples > 0:
+            bootstrap_results[key]['kendall'] = get_bootstrap_result(value, key, 'kendall', **bootstrap_kwargs)
+
+    num_samples = len(next(iter(next(iter(mapper.values())).values())))
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "result_dir": result_dir,
+        "ref_score_file": ref_score_file,
+        "num_samples": num_samples,
+        "num_missing_samples": len(ref_scores) - num_samples,
+        "reference_key": reference_key,
+        "num_resamples": num_resamples,
+        "categories": {
+            category: build_category_report(mapper[category], results[category], reference_key, bootstrap_results[category])
+            for category in mapper
+        }
+    }
+    if history_file is None:
+        history_file = os.path.join(os.path.dirname(os.path.abspath(ref_score_file)), "correlation-history.jsonl")
+    write_correlation_report(report, result_dir, history_file=history_file)
+    print(f"[!] correlation report written to {os.path.join(result_dir, 'correlation-report.json')}")
+    print(f"[!] run summary appended to {history_file}")
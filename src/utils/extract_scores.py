@@ -1,6 +1,9 @@
 import os
 import json
+import time
+import argparse
 from tqdm import tqdm
+from src.utils.progress_index import FINGERPRINT_BYTES, file_fingerprint
 
 
 def extract_score_list_from_str(string: str, force_four_scores: bool = True):
@@ -37,7 +40,68 @@ def extract_score_from_str(score_str: str):
     return 'N/A'
 
 
-def extract_scores_from_result_dir(result_dir: str):
+ANSWER_RESULT_FILES = [
+    "appearance_answer_stage_2-result.jsonl",
+    "intrinsic_eval_stage_2-result.jsonl",
+    "relationship_eval_stage_2-result.jsonl",
+    "appearance_answer-result.jsonl",
+    "intrinsic_answer-result.jsonl",
+    "relationship_answer-result.jsonl",
+]
+ASPECT_SUMMARY_RESULT_FILES = [
+    "appearance_summary_stage_2-result.jsonl",
+    "intrinsic_summary_stage_2-result.jsonl",
+    "relationship_summary_stage_2-result.jsonl",
+]
+SUMMARIZE_RESULT_FILE = "summarize_stage_2-result.jsonl"
+SUMMARIZE_SCORE_KEYS = ["id", "appearance_score", "intrinsic_score", "relationship_score", "overall_score"]
+
+# offsets of the result files already extracted by `extract_scores_from_result_dir(incremental=True)`
+SCORE_STATE_FILE = "extract-scores-state.json"
+
+
+def get_score_file_name(basename: str) -> str:
+    if '_stage_2' in basename:
+        return f"{basename[:basename.find('_stage_2-result.jsonl')]}-result-score.jsonl"
+    return f"{basename[:basename.find('-result.jsonl')]}-result-score.jsonl"
+
+
+def extract_scores_from_summary(summary: dict) -> dict:
+    """Category scores of a sample from the outputs of its multi-stage summarize stage, as the lines of
+    `summarize-result-score.jsonl`. None if the sample has no stage 2 summary."""
+    if summary is None or "summarize_stage_2" not in summary:
+        return None
+    if all(basename[:-len("-result.jsonl")] in summary for basename in ASPECT_SUMMARY_RESULT_FILES):
+        return {
+            "appearance_score": summary["appearance_summary_stage_2"]["score"],
+            "intrinsic_score": summary["intrinsic_summary_stage_2"]["score"],
+            "relationship_score": summary["relationship_summary_stage_2"]["score"],
+            "overall_score": summary["summarize_stage_2"]["score"]
+        }
+    scores = summary["summarize_stage_2"]["scores"]
+    return {
+        "appearance_score": scores[0],
+        "intrinsic_score": scores[1],
+        "relationship_score": scores[2],
+        "overall_score": scores[3]
+    }
+
+
+def extract_scores_from_result_dir(result_dir: str, incremental: bool = False):
+    """Writes the `*-result-score.jsonl` files of the result files in `result_dir`.
+
+    With `incremental`, only the lines appended to the result files since the previous incremental extraction are
+    parsed and their scores are appended to the score files, e.g. to refresh scores during a run. A summary score is
+    only appended once the summaries of all aspects of the sample are there.
+    """
+    if incremental:
+        return extract_appended_scores_from_result_dir(result_dir)
+
+    # the score files are rewritten, the offsets of incremental extractions no longer apply
+    state_file = os.path.join(result_dir, SCORE_STATE_FILE)
+    if os.path.exists(state_file):
+        os.remove(state_file)
+
     result_files = [
         os.path.join(result_dir, file)
         for file in sorted(os.listdir(result_dir))
@@ -47,23 +111,12 @@ def extract_scores_from_result_dir(result_dir: str):
     separate_aspect = False
     for file in result_files:
         basename = os.path.basename(file)
-        if basename in [
-            "appearance_summary_stage_2-result.jsonl",
-            "intrinsic_summary_stage_2-result.jsonl",
-            "relationship_summary_stage_2-result.jsonl",
-        ]:
+        if basename in ASPECT_SUMMARY_RESULT_FILES:
             separate_aspect = True
             continue
         
         score_dict = {}
-        if basename in [
-            "appearance_answer_stage_2-result.jsonl",
-            "intrinsic_eval_stage_2-result.jsonl",
-            "relationship_eval_stage_2-result.jsonl",
-            "appearance_answer-result.jsonl",
-            "intrinsic_answer-result.jsonl",
-            "relationship_answer-result.jsonl",
-        ]:
+        if basename in ANSWER_RESULT_FILES:
             with open(file, "r+", encoding="utf-8") as f:
                 result_list = [json.loads(line) for line in f.readlines()]
 
@@ -71,7 +124,7 @@ def extract_scores_from_result_dir(result_dir: str):
                 score = {"id": result['id'], "score": extract_score_from_str(result['response'])}
                 score_dict[result['id']] = score
         
-        elif basename == "summarize_stage_2-result.jsonl":
+        elif basename == SUMMARIZE_RESULT_FILE:
             with open(file, "r+", encoding="utf-8") as f:
                 result_list = [json.loads(line) for line in f.readlines()]
             
@@ -112,11 +165,135 @@ def extract_scores_from_result_dir(result_dir: str):
         else:
             continue
 
-        if '_stage_2' in basename:
-            score_file = os.path.join(result_dir, f"{basename[:basename.find('_stage_2-result.jsonl')]}-result-score.jsonl")
-        else:
-            score_file = os.path.join(result_dir, f"{basename[:basename.find('-result.jsonl')]}-result-score.jsonl")
+        score_file = os.path.join(result_dir, get_score_file_name(basename))
         with open(score_file, 'w+', encoding='utf-8') as f:
             for _, value in score_dict.items():
                 f.write(json.dumps(value, ensure_ascii=False) + '\n')
-    
+
+
+def _read_appended_results(file: str, source_state: dict):
+    """Results appended to `file` after `source_state["offset"]` and the new state of the file, or None if the file
+    was rewritten. A trailing line without line separator is still being written and is left for the next call."""
+    offset = source_state["offset"]
+    if offset > 0 and (
+        os.path.getsize(file) < offset or file_fingerprint(file, min(offset, FINGERPRINT_BYTES)) != source_state["fingerprint"]
+    ):
+        return None
+    with open(file, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    end = data.rfind(b"\n") + 1
+    results = [json.loads(line) for line in data[:end].decode("utf-8").splitlines() if line.strip()]
+    offset += end
+    return results, {"offset": offset, "fingerprint": file_fingerprint(file, min(offset, FINGERPRINT_BYTES))}
+
+
+def _append_scores(result_dir: str, score_basename: str, sources: list, file_state: dict, rebuild: bool = False):
+    """Appends the scores of the samples appended to the result files `sources` to `score_basename`.
+
+    `sources[0]` gives the scores of the samples, the other sources (aspect summaries) are joined to it by sample id.
+    Samples missing from a source are kept in `file_state["pending"]`. If a source was rewritten or a sample that was
+    already written shows up again, the score file is extracted again from scratch.
+    """
+    score_file = os.path.join(result_dir, score_basename)
+    if rebuild or file_state is None or list(file_state["sources"]) != sources \
+            or not os.path.exists(score_file) or os.path.getsize(score_file) < file_state["size"]:
+        file_state = {"sources": {source: {"offset": 0, "fingerprint": None} for source in sources}, "size": 0, "ids": [], "pending": []}
+    # scores appended after the state was saved, by an interrupted extraction
+    with open(score_file, "a", encoding="utf-8") as f:
+        f.truncate(file_state["size"])
+
+    source_states = {}
+    appended_results = {}
+    for source in sources:
+        appended = _read_appended_results(os.path.join(result_dir, source), file_state["sources"][source])
+        if appended is None:
+            if rebuild:
+                raise RuntimeError(f"[!] {source} changed while its scores were extracted")
+            return _append_scores(result_dir, score_basename, sources, None, rebuild=True)
+        appended_results[source], source_states[source] = appended
+
+    joined = len(sources) > 1
+    written_ids = set(file_state["ids"])
+    pending = {entry["id"]: entry for entry in file_state["pending"]}
+    for source in sources:
+        for result in appended_results[source]:
+            if result['id'] in written_ids:
+                if rebuild:
+                    raise RuntimeError(f"[!] sample {result['id']} of {source} changed while its scores were extracted")
+                return _append_scores(result_dir, score_basename, sources, None, rebuild=True)
+            entry = pending.setdefault(result['id'], {"id": result['id'], "score": {}, "seen": []})
+            if source in ASPECT_SUMMARY_RESULT_FILES:
+                entry["score"][f"{source[:source.find('_summary')]}_score"] = result['score']
+            elif source == SUMMARIZE_RESULT_FILE and joined:
+                entry["score"]["overall_score"] = result['score']
+            elif source == SUMMARIZE_RESULT_FILE:
+                scores = result['scores']
+                entry["score"].update(appearance_score=scores[0], intrinsic_score=scores[1], relationship_score=scores[2], overall_score=scores[3])
+            else:
+                entry["score"]["score"] = extract_score_from_str(result['response'])
+            if source not in entry["seen"]:
+                entry["seen"].append(source)
+
+    score_keys = SUMMARIZE_SCORE_KEYS if sources[0] == SUMMARIZE_RESULT_FILE else ["id", "score"]
+    lines = []
+    for sample_id, entry in list(pending.items()):
+        if len(entry["seen"]) < len(sources):
+            continue
+        score = {"id": sample_id, **entry["score"]}
+        lines.append(json.dumps({key: score[key] for key in score_keys}, ensure_ascii=False) + '\n')
+        written_ids.add(sample_id)
+        file_state["ids"].append(sample_id)
+        pending.pop(sample_id)
+
+    with open(score_file, "a", encoding="utf-8") as f:
+        f.writelines(lines)
+    file_state["size"] = os.path.getsize(score_file)
+    file_state["sources"] = source_states
+    file_state["pending"] = list(pending.values())
+    return file_state, len(lines)
+
+
+def extract_appended_scores_from_result_dir(result_dir: str):
+    state_file = os.path.join(result_dir, SCORE_STATE_FILE)
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file, "r", encoding="utf-8") as f:
+            state = json.load(f)
+
+    result_files = set(os.listdir(result_dir))
+    # as in a full extraction, the stage 2 results replace the scores of the stage 1 results of the same name
+    score_sources = {
+        get_score_file_name(basename): [basename] for basename in sorted(result_files) if basename in ANSWER_RESULT_FILES
+    }
+    if SUMMARIZE_RESULT_FILE in result_files:
+        score_sources[get_score_file_name(SUMMARIZE_RESULT_FILE)] = [SUMMARIZE_RESULT_FILE] + [
+            basename for basename in ASPECT_SUMMARY_RESULT_FILES if basename in result_files
+        ]
+
+    num_scores = 0
+    for score_basename, sources in score_sources.items():
+        state[score_basename], num_appended = _append_scores(result_dir, score_basename, sources, state.get(score_basename))
+        num_scores += num_appended
+
+    # the state is replaced atomically, score lines appended after the previous state are truncated by the next call
+    with open(state_file + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(state_file + ".tmp", state_file)
+    return num_scores
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--result-dir", type=str, required=True)
+    parser.add_argument("--incremental", action="store_true", help="only extract the scores of the appended results")
+    parser.add_argument("--interval", type=float, default=0.0, help="seconds between incremental extractions, 0 runs once")
+    args = parser.parse_args()
+
+    while True:
+        num_scores = extract_scores_from_result_dir(result_dir=args.result_dir, incremental=args.incremental)
+        if args.incremental:
+            print(f"[!] {num_scores} new scores extracted from {args.result_dir}")
+        if not args.incremental or args.interval <= 0:
+            break
+        time.sleep(args.interval)
@@ -0,0 +1,48 @@
+import threading
+from collections import deque, defaultdict
+
+
+class HedgePolicy:
+    """When to send a duplicate of a request that is still unanswered: after the `quantile` of the latencies of its stage.
+
+    The latencies of the last `window` requests of every stage are kept, and their quantile is recomputed every
+    `refresh_every` new ones. Requests of a stage with fewer than `min_samples` known latencies are not hedged, and
+    hedges are limited to `max_ratio` of the requests, so that a server slow for every request does not get twice the
+    load.
+    """
+    def __init__(self, quantile: float = 0.95, window: int = 1000, refresh_every: int = 50, min_samples: int = 20, max_ratio: float = 0.1) -> None:
+        assert 0 < quantile < 1 and 0 < max_ratio <= 1
+        self.quantile = quantile
+        self.window = window
+        self.refresh_every = refresh_every
+        self.min_samples = min_samples
+        self.max_ratio = max_ratio
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(lambda: deque(maxlen=window))
+        self.pending_refresh = defaultdict(int)
+        self.delays = {}
+        self.requests = 0
+        self.hedges = 0
+
+    def observe(self, stage: str, latency: float):
+        with self.lock:
+            latencies = self.latencies[stage]
+            latencies.append(latency)
+            self.pending_refresh[stage] += 1
+            if len(latencies) >= self.min_samples and (stage not in self.delays or self.pending_refresh[stage] >= self.refresh_every):
+                values = sorted(latencies)
+                self.delays[stage] = values[int(self.quantile * (len(values) - 1))]
+                self.pending_refresh[stage] = 0
+
+    def get_delay(self, stage: str) -> float:
+        """Seconds after which a request of `stage` is hedged, None if it is not."""
+        with self.lock:
+            self.requests += 1
+            return self.delays.get(stage)
+
+    def try_hedge(self) -> bool:
+        with self.lock:
+            if self.hedges + 1 > self.max_ratio * self.requests:
+                return False
+            self.hedges += 1
+            return True
@@ -0,0 +1,71 @@
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+
+
+class ImageCache:
+    """Thread-safe LRU cache of values loaded from image files.
+
+    Entries are keyed by (path, mtime, size), so an image rewritten on disk is loaded again. The cache is bounded by the
+    total `sizeof` of its values: the least recently used entries are evicted once `max_bytes` is exceeded, a value
+    larger than `max_bytes` is returned without being cached.
+    """
+    def __init__(self, loader: Callable[[str], Any], max_bytes: int = 256 * 1024 * 1024, sizeof: Callable[[Any], int] = len) -> None:
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _make_key(self, image_path: str) -> tuple:
+        if image_path.startswith('file://'):
+            image_path = image_path[7:]
+        stat = os.stat(image_path)
+        return image_path, stat.st_mtime_ns, stat.st_size
+
+    def get(self, image_path: str) -> Any:
+        key = self._make_key(image_path)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+
+        # load outside of the lock, concurrent misses of the same image may load it twice but never block other images
+        value = self.loader(key[0])
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return value
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = (value, size)
+                self.num_bytes += size
+                while self.num_bytes > self.max_bytes:
+                    _, (_, evicted_size) = self.entries.popitem(last=False)
+                    self.num_bytes -= evicted_size
+                    self.evictions += 1
+        return value
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total > 0 else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.num_bytes
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.num_bytes = 0
@@ -0,0 +1,173 @@
+import time
+import hashlib
+import threading
+from tqdm import tqdm
+
+
+class Endpoint:
+    def __init__(self, url: str, client=None) -> None:
+        self.url = url
+        self.client = client
+        self.async_client = None
+        self.concurrency_limit = None
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejection_streak = 0
+        self.ejected_until = None
+
+    def is_ejected(self) -> bool:
+        return self.ejected_until is not None
+
+
+class LoadBalancer:
+    """Route requests to the endpoint with the fewest outstanding requests, keeping the requests of a sample together.
+
+    A request with an affinity key (the sample index) goes to the endpoint ranked first for that key by rendezvous
+    hashing, unless it has `stickiness` more outstanding requests than the least loaded one: the replica keeps the
+    prefix cache of the sample (images, history) warm, and only the samples of an ejected replica move elsewhere.
+
+    An endpoint failing `max_failures` requests in a row, or a health check, is ejected for `eject_seconds`, doubled
+    on every consecutive ejection, and re-admitted once that time has passed and a health check succeeds (without
+    health checks, as soon as the time has passed). A re-admitted endpoint is ejected again on its first failure. When
+    every endpoint is ejected, requests go to the least loaded one anyway rather than failing.
+    """
+    def __init__(
+        self,
+        endpoints: list,
+        stickiness: int = 4,
+        max_failures: int = 3,
+        eject_seconds: float = 5.0,
+        max_eject_seconds: float = 300.0,
+        health_check=None,
+        health_check_interval: float = 10.0
+    ) -> None:
+        assert len(endpoints) > 0
+        self.endpoints = endpoints
+        self.stickiness = stickiness
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self.lock = threading.Lock()
+        # requests with an affinity key sent to their preferred endpoint, and elsewhere
+        self.affinity_hits = 0
+        self.affinity_misses = 0
+
+        # `health_check(endpoint) -> bool` runs on a daemon thread, for every endpoint each `health_check_interval`
+        self.health_check = health_check
+        self.health_check_interval = health_check_interval
+        self.stopped = threading.Event()
+        self.health_check_thread = None
+        if health_check is not None:
+            self.health_check_thread = threading.Thread(target=self._run_health_checks, daemon=True)
+            self.health_check_thread.start()
+
+    @staticmethod
+    def _rank(affinity, endpoint: Endpoint) -> bytes:
+        return hashlib.md5(f"{affinity}@{endpoint.url}".encode("utf-8")).digest()
+
+    def acquire(self, affinity=None, exclude: Endpoint = None) -> Endpoint:
+        """Pick an endpoint for a request, other than `exclude` (where its previous attempt failed) if possible."""
+        with self.lock:
+            if self.health_check is None:
+                now = time.monotonic()
+                for endpoint in self.endpoints:
+                    if endpoint.is_ejected() and now >= endpoint.ejected_until:
+                        self._readmit(endpoint)
+            candidates = [endpoint for endpoint in self.endpoints if not endpoint.is_ejected()] or self.endpoints
+            candidates = [endpoint for endpoint in candidates if endpoint is not exclude] or candidates
+            least_loaded = min(candidates, key=lambda endpoint: endpoint.outstanding)
+            endpoint = least_loaded
+            if affinity is not None:
+                preferred = max(candidates, key=lambda endpoint: self._rank(affinity, endpoint))
+                if preferred.outstanding <= least_loaded.outstanding + self.stickiness:
+                    endpoint = preferred
+                    self.affinity_hits += 1
+                else:
+                    self.affinity_misses += 1
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+            return endpoint
+
+    def release(self, endpoint: Endpoint, failed: bool = False):
+        with self.lock:
+            endpoint.outstanding -= 1
+            if not failed:
+                endpoint.consecutive_failures = 0
+                if not endpoint.is_ejected():
+                    endpoint.ejection_streak = 0
+                return
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            if endpoint.consecutive_failures >= self.max_failures and not endpoint.is_ejected():
+                self._eject(endpoint)
+
+    def cancel(self, endpoint: Endpoint):
+        """Release a request abandoned before its end (e.g. the loser of a hedged pair), which says nothing of the endpoint."""
+        with self.lock:
+            endpoint.outstanding -= 1
+
+    def _eject(self, endpoint: Endpoint):
+        duration = min(self.eject_seconds * 2 ** endpoint.ejection_streak, self.max_eject_seconds)
+        endpoint.ejections += 1
+        endpoint.ejection_streak += 1
+        endpoint.ejected_until = time.monotonic() + duration
+        tqdm.write(f"[!] ejected {endpoint.url} for {duration:g}s after {endpoint.consecutive_failures} failures")
+
+    def _readmit(self, endpoint: Endpoint):
+        endpoint.ejected_until = None
+        # half open: the next failure ejects the endpoint again, for twice as long
+        endpoint.consecutive_failures = self.max_failures - 1
+        tqdm.write(f"[!] re-admitted {endpoint.url}")
+
+    def check_health(self):
+        for endpoint in self.endpoints:
+            try:
+                healthy = self.health_check(endpoint)
+            except Exception:
+                healthy = False
+            with self.lock:
+                if not healthy:
+                    endpoint.consecutive_failures = max(endpoint.consecutive_failures, self.max_failures)
+                    if not endpoint.is_ejected():
+                        self._eject(endpoint)
+                elif endpoint.is_ejected() and time.monotonic() >= endpoint.ejected_until:
+                    self._readmit(endpoint)
+
+    def _run_health_checks(self):
+        while not self.stopped.wait(self.health_check_interval):
+            self.check_health()
+
+    def stop(self):
+        """Stop the health checks, waiting for the one in progress if any."""
+        self.stopped.set()
+        if self.health_check_thread is not None:
+            self.health_check_thread.join()
+
+    def get_stats(self) -> list:
+        with self.lock:
+            return [
+                {
+                    "url": endpoint.url,
+                    "requests": endpoint.requests,
+                    "failures": endpoint.failures,
+                    "outstanding": endpoint.outstanding,
+                    "ejections": endpoint.ejections,
+                    "ejected": endpoint.is_ejected()
+                }
+                for endpoint in self.endpoints
+            ]
+
+    def format(self) -> str:
+        lines = [
+            f"  {stats['url']}: {stats['requests']} requests, {stats['failures']} failures, {stats['ejections']} ejections"
+            f"{' (ejected)' if stats['ejected'] else ''}"
+            for stats in self.get_stats()
+        ]
+        total = self.affinity_hits + self.affinity_misses
+        if total > 0:
+            lines.append(f"  {self.affinity_hits} of {total} requests on the preferred endpoint of their sample "
+                         f"({round(self.affinity_hits / total * 100, 1)}%)")
+        return "\n".join(lines)
@@ -1,5 +1,7 @@
+import re
 import json
 import copy
+import functools
 import numpy as np
 from tqdm import tqdm
 from difflib import SequenceMatcher
@@ -59,36 +61,91 @@ def extract_score_from_str(score_str: str):
     return 'N/A'
 
 
+@functools.lru_cache(maxsize=65536)
+def _get_key_profile(key: str) -> tuple:
+    """Normalized key and its character signature (sorted characters).
+
+    `SequenceMatcher.quick_ratio` only depends on the character multisets of the two strings, so two keys have a
+    similarity of 1.0 exactly when their signatures are equal.
+    """
+    normalized = key.strip().lower()
+    return normalized, "".join(sorted(normalized))
+
+
+def _get_char_histograms(keys: list, alphabet: np.ndarray) -> np.ndarray:
+    codes = [np.frombuffer(key.encode("utf-32-le"), dtype=np.uint32) for key in keys]
+    rows = np.repeat(np.arange(len(keys)), [len(code) for code in codes])
+    columns = np.searchsorted(alphabet, np.concatenate(codes)) if len(rows) > 0 else rows
+    return np.bincount(rows * len(alphabet) + columns, minlength=len(keys) * len(alphabet)).reshape(len(keys), len(alphabet))
+
+
+def _get_similarity_matrix(source: list, target: list) -> np.ndarray:
+    # vectorized `quick_ratio`: 2 * (size of the character multiset intersection) / (total length)
+    alphabet = np.unique(np.frombuffer("".join(source + target).encode("utf-32-le"), dtype=np.uint32))
+    source_hist = _get_char_histograms(source, alphabet)
+    target_hist = _get_char_histograms(target, alphabet)
+    matches = np.minimum(source_hist[:, None, :], target_hist[None, :, :]).sum(axis=2)
+    lengths = source_hist.sum(axis=1)[:, None] + target_hist.sum(axis=1)[None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sim_matrix = np.where(lengths > 0, 2.0 * matches / lengths, 1.0)
+    return sim_matrix
+
+
 def _get_best_match(source, target, path: str = None, mismatch_log: dict = None):
-    # calculate sequence similarity matrix
-    sim_matrix = np.zeros([len(source), len(target)])
-    for i, src_key in enumerate(source):
-        for j, tgt_key in enumerate(target):
-            sim_matrix[i][j] = SequenceMatcher(
-                None, a=src_key.strip().lower(), b=tgt_key.strip().lower()
-            ).quick_ratio()
-
-    # assign match result
-    src_best_match_indices = np.argmax(sim_matrix, axis=1)
-    tgt_best_match_indices = np.argmax(sim_matrix, axis=0)
-    src_match = [(i, tgt) for i, tgt in enumerate(src_best_match_indices)]
-    tgt_match = [(src, i) for i, src in enumerate(tgt_best_match_indices)]
-    match_pairs = list(set(src_match) & set(tgt_match))
-    match_pairs = sorted(match_pairs, key=lambda s: s[1])
+    if len(source) == 0 or len(target) == 0:
+        raise ValueError("attempt to get argmax of an empty sequence")
+    
+    source_profiles = [_get_key_profile(key) for key in source]
+    target_profiles = [_get_key_profile(key) for key in target]
+    
+    # fast path: a key with a perfect similarity is best matched by the first key of equal signature
+    first_source_by_signature = {}
+    for i, (_, signature) in enumerate(source_profiles):
+        first_source_by_signature.setdefault(signature, i)
+    first_target_by_signature = {}
+    for j, (_, signature) in enumerate(target_profiles):
+        first_target_by_signature.setdefault(signature, j)
+    src_best_match_indices = [first_target_by_signature.get(signature) for _, signature in source_profiles]
+    tgt_best_match_indices = [first_source_by_signature.get(signature) for _, signature in target_profiles]
+    
+    # fall back to the similarity of unmatched source keys against all target keys. An unmatched target key can only
+    # be paired with an unmatched source key whose best match it is, only those target keys are compared to all sources
+    unmatched_src = [i for i, j in enumerate(src_best_match_indices) if j is None]
+    row_sims, col_sims = {}, {}
+    if len(unmatched_src) > 0:
+        sim_matrix = _get_similarity_matrix([source_profiles[i][0] for i in unmatched_src], [profile[0] for profile in target_profiles])
+        for row, i in enumerate(unmatched_src):
+            row_sims[i] = sim_matrix[row]
+            src_best_match_indices[i] = int(np.argmax(sim_matrix[row]))
+    unmatched_tgt = sorted(set(src_best_match_indices[i] for i in unmatched_src if tgt_best_match_indices[src_best_match_indices[i]] is None))
+    if len(unmatched_tgt) > 0:
+        sim_matrix = _get_similarity_matrix([profile[0] for profile in source_profiles], [target_profiles[j][0] for j in unmatched_tgt])
+        for col, j in enumerate(unmatched_tgt):
+            col_sims[j] = sim_matrix[:, col]
+            tgt_best_match_indices[j] = int(np.argmax(sim_matrix[:, col]))
+    
+    # assign match result, pairs of mutual best matches in target order
+    match_pairs = [(src_idx, tgt_idx) for tgt_idx, src_idx in enumerate(tgt_best_match_indices) if src_idx is not None and src_best_match_indices[src_idx] == tgt_idx]
 
     # convert result to text format
     match_result = []
     for src_idx, tgt_idx in match_pairs:
         src_key = source[src_idx]
         tgt_key = target[tgt_idx]
+        if src_idx in row_sims:
+            similarity = row_sims[src_idx][tgt_idx]
+        elif tgt_idx in col_sims:
+            similarity = col_sims[tgt_idx][src_idx]
+        else:
+            similarity = np.float64(1.0)
         # log imperfect match
-        if sim_matrix[src_idx][tgt_idx] < 0.9 and mismatch_log is not None:
+        if similarity < 0.9 and mismatch_log is not None:
             mismatch_log["imperfect_match"].append(
                 {
                     "path": path,
                     "src_key": src_key,
                     "tgt_key": tgt_key,
-                    "similarity": sim_matrix[src_idx][tgt_idx],
+                    "similarity": similarity,
                 }
             )
             mismatch_log["error"] = True
@@ -159,6 +216,271 @@ def _get_path_from_key_chain(key_chain):
     return path
 
 
+class _UnsupportedMarkdown(Exception):
+    pass
+
+
+class _Block:
+    __slots__ = ("type", "parent", "children", "strings", "level", "list_data", "start_line", "is_open", "last_line_blank")
+
+    def __init__(self, type: str, start_line: int, parent=None) -> None:
+        self.type = type
+        self.parent = parent
+        self.children = []
+        self.strings = []
+        self.level = None
+        self.list_data = None
+        self.start_line = start_line
+        self.is_open = True
+        self.last_line_blank = False
+
+
+_BLOCK_START_CHARS = frozenset(" #`~*+_=<>0123456789-")
+_ATX_HEADER_RE = re.compile(r"#{1,6}(?: +|$)")
+_ATX_CLOSING_RE = re.compile(r"(?:(\\#) *#*| *#+) *$")
+_FENCE_RE = re.compile(r"`{3,}(?!.*`)|~{3,}(?!.*~)")
+_SETEXT_RE = re.compile(r"(?:=+|-+) *$")
+_HRULE_RE = re.compile(r"(?:(?:\* *){3,}|(?:_ *){3,}|(?:- *){3,}) *$")
+_BULLET_RE = re.compile(r"[*+-]( +|$)")
+_ORDERED_RE = re.compile(r"(\d+)([.)])( +|$)")
+_LINE_SEP_RE = re.compile(r"\r\n|\n|\r")
+_TRAILING_NEWLINE_RE = re.compile(r"\n$")
+
+
+class _MarkdownBlockParser:
+    """Block structure of the markdown subset produced by the models: ATX headings, (nested) lists and paragraphs.
+
+    A line-by-line port of the block parser vendored by `markdown_to_json` (CommonMark.py), without inline parsing.
+    Anything else (code, quotes, html, setext headings, rules, tabs) raises `_UnsupportedMarkdown`.
+    """
+    def __init__(self) -> None:
+        self.doc = _Block("Document", 1)
+        self.tip = self.doc
+
+    def finalize(self, block: _Block):
+        if not block.is_open:
+            return
+        block.is_open = False
+        if block.type == "Paragraph":
+            block.strings = [line.lstrip(" ") for line in block.strings]
+        self.tip = block.parent
+
+    def add_child(self, type: str, line_number: int) -> _Block:
+        while not (self.tip.type in ("Document", "ListItem") or (self.tip.type == "List" and type == "ListItem")):
+            self.finalize(self.tip)
+        block = _Block(type, line_number, parent=self.tip)
+        self.tip.children.append(block)
+        self.tip = block
+        return block
+
+    def break_out_of_lists(self, block: _Block):
+        last_list = None
+        parent = block
+        while parent is not None:
+            if parent.type == "List":
+                last_list = parent
+            parent = parent.parent
+        if last_list is not None:
+            while block is not last_list:
+                self.finalize(block)
+                block = block.parent
+            self.finalize(last_list)
+            self.tip = last_list.parent
+
+    @staticmethod
+    def parse_list_marker(rest: str):
+        if _HRULE_RE.match(rest):
+            return None
+        match = _BULLET_RE.match(rest)
+        if match:
+            data = ("Bullet", match.group(0)[0], None)
+            spaces_after_marker = len(match.group(1))
+        else:
+            match = _ORDERED_RE.match(rest)
+            if not match:
+                return None
+            data = ("Ordered", None, match.group(2))
+            spaces_after_marker = len(match.group(3))
+        padding = len(match.group(0))
+        if spaces_after_marker >= 5 or spaces_after_marker < 1:
+            padding = padding - spaces_after_marker + 1
+        return data, padding
+
+    def incorporate_line(self, line: str, line_number: int):
+        if "\t" in line:
+            raise _UnsupportedMarkdown("tab")
+        offset = 0
+        container = self.doc
+        old_tip = self.tip
+        blank = False
+
+        # match the line against the open containers
+        while container.children and container.children[-1].is_open:
+            container = container.children[-1]
+            first_nonspace = len(line) - len(line[offset:].lstrip(" "))
+            blank = first_nonspace == len(line)
+            indent = first_nonspace - offset
+            matched = True
+            if container.type == "ListItem":
+                marker_offset, padding = container.list_data[1:]
+                if indent >= marker_offset + padding:
+                    offset += marker_offset + padding
+                elif blank:
+                    offset = first_nonspace
+                else:
+                    matched = False
+            elif container.type == "ATXHeader":
+                matched = False
+            elif container.type == "Paragraph" and blank:
+                container.last_line_blank = True
+                matched = False
+            if not matched:
+                container = container.parent
+                break
+        last_matched_container = container
+
+        closed = False
+
+        def close_unmatched_blocks():
+            nonlocal closed, old_tip
+            while not closed and old_tip is not last_matched_container:
+                self.finalize(old_tip)
+                old_tip = old_tip.parent
+            closed = True
+
+        if blank and container.last_line_blank:
+            self.break_out_of_lists(container)
+
+        # open new containers
+        while offset < len(line) and line[offset] in _BLOCK_START_CHARS:
+            first_nonspace = len(line) - len(line[offset:].lstrip(" "))
+            blank = first_nonspace == len(line)
+            rest = line[first_nonspace:]
+            indent = first_nonspace - offset
+            if indent >= 4:
+                if self.tip.type != "Paragraph" and not blank:
+                    raise _UnsupportedMarkdown("indented code")
+                break
+            if rest.startswith((">", "<")):
+                raise _UnsupportedMarkdown("block quote or html")
+            match = _ATX_HEADER_RE.match(rest)
+            if match:
+                offset = first_nonspace + len(match.group(0))
+                close_unmatched_blocks()
+                container = self.add_child("ATXHeader", line_number)
+                container.level = len(match.group(0).strip())
+                container.strings = [_ATX_CLOSING_RE.sub(r"\g<1>" if "\\#" in line[offset:] else "", line[offset:])]
+                break
+            if _FENCE_RE.match(rest):
+                raise _UnsupportedMarkdown("fenced code")
+            if container.type == "Paragraph" and len(container.strings) == 1 and _SETEXT_RE.match(rest):
+                raise _UnsupportedMarkdown("setext heading")
+            if _HRULE_RE.match(rest):
+                raise _UnsupportedMarkdown("horizontal rule")
+            marker = self.parse_list_marker(rest)
+            if marker is None:
+                break
+            close_unmatched_blocks()
+            (list_type, bullet_char, delimiter), padding = marker
+            offset = first_nonspace + padding
+            if container.type != "List" or container.list_data[0] != (list_type, bullet_char, delimiter):
+                container = self.add_child("List", line_number)
+                container.list_data = ((list_type, bullet_char, delimiter), indent, padding)
+            container = self.add_child("ListItem", line_number)
+            container.list_data = ((list_type, bullet_char, delimiter), indent, padding)
+
+        first_nonspace = len(line) - len(line[offset:].lstrip(" "))
+        blank = first_nonspace >= len(line)
+
+        if self.tip is not last_matched_container and not blank and self.tip.type == "Paragraph" and self.tip.strings:
+            # lazy paragraph continuation
+            self.tip.strings.append(line[offset:])
+            return
+
+        close_unmatched_blocks()
+        container.last_line_blank = blank and not (
+            container.type == "ListItem" and not container.children and container.start_line == line_number
+        )
+        parent = container.parent
+        while parent is not None:
+            parent.last_line_blank = False
+            parent = parent.parent
+        if container.type == "ATXHeader":
+            pass
+        elif container.type == "Paragraph":
+            container.strings.append(line[first_nonspace:])
+        elif not blank:
+            container = self.add_child("Paragraph", line_number)
+            container.strings.append(line[first_nonspace:])
+
+    def parse(self, text: str) -> _Block:
+        lines = _LINE_SEP_RE.split(_TRAILING_NEWLINE_RE.sub("", text))
+        for i, line in enumerate(lines):
+            self.incorporate_line(line, i + 1)
+        while self.tip is not None:
+            self.finalize(self.tip)
+        return self.doc
+
+
+def _render_block(block: _Block):
+    if block.type == "List":
+        items = []
+        for item in block.children:
+            items += _render_block(item)
+        return items
+    if block.strings:
+        return "\n".join(block.strings)
+    return [_render_block(child) for child in block.children]
+
+
+def _nest_blocks(blocks: list, heading_level: int):
+    if not any(block.type == "ATXHeader" and block.level == heading_level for block in blocks):
+        if len(blocks) == 0:
+            return ""
+        if blocks[0].type == "List":
+            return _render_block(blocks[0])
+        return "\n\n".join(str(_render_block(block)) for block in blocks)
+
+    nested = {}
+    heading, children = None, []
+    for block in blocks + [None]:
+        if block is None or (block.type == "ATXHeader" and block.level == heading_level):
+            if heading is not None:
+                nested[_render_block(heading)] = _nest_blocks(children, heading_level + 1)
+            heading, children = block, []
+        elif heading is not None:
+            children.append(block)
+    return nested
+
+
+def markdown_to_dict(text: str) -> dict:
+    """Nested dict of a markdown response, equal to `json.loads(markdown_to_json.jsonify(text))`.
+
+    Headings are keys (the smallest level at the top), lists become (nested) lists of strings and other content is
+    kept as text. Responses using markdown beyond headings, lists and paragraphs go through `markdown_to_json`.
+    """
+    try:
+        doc = _MarkdownBlockParser().parse(text)
+    except _UnsupportedMarkdown:
+        import markdown_to_json
+        return json.loads(markdown_to_json.jsonify(text))
+
+    # the smallest heading level of the top-level blocks gives the keys, documents without headings go to "root"
+    heading_levels = [block.level for block in doc.children if block.type == "ATXHeader"]
+    if len(heading_levels) == 0:
+        return {"root": [_render_block(block) for block in doc.children]}
+    return _nest_blocks(doc.children, min(heading_levels))
+
+
+def _copy_structure(struct):
+    # target structures only hold dicts and scalars, a recursive copy is much cheaper than `copy.deepcopy`
+    if isinstance(struct, dict):
+        return {key: _copy_structure(value) for key, value in struct.items()}
+    if struct is None or isinstance(struct, (str, int, float)):
+        return struct
+    return copy.deepcopy(struct)
+
+
 def parse_structured_data(
     structured_data: dict,
     target_structure: dict,
@@ -168,7 +490,7 @@ def parse_structured_data(
     strict_questions: bool = True,
     force_struct_info: bool = True
 ):
-    target_structure = copy.deepcopy(target_structure)
+    target_structure = _copy_structure(target_structure)
     mismatch_log = {
         "file": file,
         "missed_keys": {},
@@ -234,27 +556,27 @@ def parse_structured_data(
                     for key in list(target[tgt_key]["Intrinsic Attributes"].keys())
                 }
                 if "Questions" in target:
-                    target["Questions"]["Appearance Quality Questions"] = copy.deepcopy(
+                    target["Questions"]["Appearance Quality Questions"] = _copy_structure(
                         entity_dict
                     )
                     target["Questions"]["Intrinsic Attribute Consistency Questions"] = (
-                        copy.deepcopy(entity_dict)
+                        _copy_structure(entity_dict)
                     )
                 if "Image Caption" in target:
-                    target["Image Caption"] = copy.deepcopy(entity_dict)
+                    target["Image Caption"] = _copy_structure(entity_dict)
                 if "Answers" in target:
-                    target["Answers"]["Appearance Quality Questions"] = copy.deepcopy(
+                    target["Answers"]["Appearance Quality Questions"] = _copy_structure(
                         entity_dict
                     )
                     target["Answers"]["Intrinsic Attribute Consistency Questions"] = (
-                        copy.deepcopy(entity_dict)
+                        _copy_structure(entity_dict)
                     )
                 if "Evaluation" in target:
-                    target["Evaluation"]["Appearance Quality Answers"] = copy.deepcopy(
+                    target["Evaluation"]["Appearance Quality Answers"] = _copy_structure(
                         entity_dict
                     )
                     target["Evaluation"]["Intrinsic Attribute Consistency Answers"] = (
-                        copy.deepcopy(entity_dict)
+                        _copy_structure(entity_dict)
                     )
 
         # handle missed & redundant keys
@@ -492,91 +814,98 @@ def parse_structured_data(
     return target_structure, mismatch_log
 
 
-def json_to_markdown(
-    struct,
-    title_level: int = 0,
-    list_level: int = 0,
-    from_list: bool = False,
-    is_overall_eval: bool = False,
-    ignore_score: bool = False,
-):
-    if isinstance(struct, dict) and not is_overall_eval:
-        text = ""
+def parse_structured_markdown(markdown: str, target_structure: dict, **kwargs):
+    """`parse_structured_data` on a markdown response, parsed by `markdown_to_dict`."""
+    return parse_structured_data(structured_data=markdown_to_dict(markdown), target_structure=target_structure, **kwargs)
+
+
+def _render_question(struct: dict, out: list, list_level: int, ignore_score: bool):
+    out.append(f"{'    ' * list_level}- question: {struct['question']}\n")
+    if struct["value"] is not None:
+        indent = "    " * (list_level + 1)
+        for key, value in struct["value"].items():
+            if ignore_score and (key == "score" or key == "manual_score"):
+                continue
+            out.append(f"{indent}- {key}: {value}\n")
+
+
+def _render_overall_evaluation(struct: dict, out: list, ignore_score: bool):
+    for key, value in struct.items():
+        out.append(f"- {key}\n")
+        if isinstance(value, dict):
+            for _key, _value in value.items():
+                # NOTE: `manual_score` is compared with the outer key, kept for identical prompts
+                if ignore_score and (_key == "score" or key == "manual_score"):
+                    continue
+                out.append(f"    - {_key}: {_value}\n")
+        else:
+            out.append("    - explanation: N/A\n    - score: N/A\n")
+
+
+def _render_markdown(struct, out: list, title_level: int, list_level: int, from_list: bool, ignore_score: bool):
+    if isinstance(struct, dict):
         if "question" in struct and "value" in struct:
-            if not ignore_score:
-                new_struct = (
-                    [
-                        f"question: {struct['question']}",
-                        [f"{key}: {value}" for key, value in struct["value"].items()],
-                    ]
-                    if struct["value"] is not None
-                    else [f"question: {struct['question']}"]
-                )
-            else:
-                new_struct = (
-                    [
-                        f"question: {struct['question']}",
-                        [
-                            f"{key}: {value}"
-                            for key, value in struct["value"].items()
-                            if key != "score" and key != "manual_score"
-                        ],
-                    ]
-                    if struct["value"] is not None
-                    else [f"question: {struct['question']}"]
-                )
-            text += json_to_markdown(
-                new_struct,
-                title_level=title_level,
-                list_level=list_level - 1 if from_list else list_level,
-                ignore_score=ignore_score,
-            )
+            _render_question(struct, out, list_level - 1 if from_list else list_level, ignore_score)
         else:
             for key, value in struct.items():
                 if value is not None:
-                    sub_text = json_to_markdown(
-                        value,
-                        title_level=title_level + 1,
-                        list_level=list_level,
-                        ignore_score=ignore_score,
-                    )
-                    text += f"{'#' * (title_level + 1)} {key}\n"
-                    text += sub_text
-        return text
+                    out.append(f"{'#' * (title_level + 1)} {key}\n")
+                    _render_markdown(value, out, title_level + 1, list_level, False, ignore_score)
     elif isinstance(struct, list):
-        text = ""
+        indent = "    " * list_level
         for item in struct:
-            sub_text = json_to_markdown(
-                item,
-                title_level=title_level,
-                list_level=list_level + 1,
-                from_list=True,
-                ignore_score=ignore_score,
-            )
             if isinstance(item, list) or isinstance(item, dict):
-                text += f"{sub_text}"
+                _render_markdown(item, out, title_level, list_level + 1, True, ignore_score)
             else:
-                text += f"{'    ' * (list_level)}- {sub_text}\n"
-        return text
-    elif isinstance(struct, dict) and is_overall_eval:
-        new_struct = []
-        for key, value in struct.items():
-            new_struct.append(key)
-            if isinstance(value, dict):
-                if not ignore_score:
-                    new_struct.append(
-                        [f"{_key}: {_value}" for _key, _value in value.items()]
-                    )
-                else:
-                    new_struct.append(
-                        [
-                            f"{_key}: {_value}"
-                            for _key, _value in value.items()
-                            if _key != "score" and key != "manual_score"
-                        ]
-                    )
-            else:
-                new_struct.append([f"explanation: N/A", f"score: N/A"])
-        return json_to_markdown(new_struct, ignore_score=ignore_score)
+                out.append(f"{indent}- {str(item)}\n")
+    else:
+        out.append(str(struct))
+
+
+def json_to_markdown(
+    struct,
+    title_level: int = 0,
+    list_level: int = 0,
+    from_list: bool = False,
+    is_overall_eval: bool = False,
+    ignore_score: bool = False,
+):
+    """Render a structure back to markdown: dict keys become headings, lists become (nested) bullet lists and
+    question dicts become a question bullet with its attributes as sub-bullets.
+
+    Everything is appended to a single buffer that is joined once.
+    """
+    out = []
+    if isinstance(struct, dict) and is_overall_eval:
+        _render_overall_evaluation(struct, out, ignore_score)
     else:
-        return str(struct)
+        _render_markdown(struct, out, title_level, list_level, from_list, ignore_score)
+    return "".join(out)
+
+
+class RenderCache:
+    """Markdown renders of the structures of a single sample, keyed by name.
+
+    The structure information and the evaluation blocks of a sample are rendered into many of its prompts, they are
+    rendered once and looked up afterwards. Hits and misses are counted in `metrics` if given.
+    """
+    def __init__(self, metrics=None) -> None:
+        self.metrics = metrics
+        self.renders = {}
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, name: str, struct, **kwargs) -> str:
+        key = (name, tuple(sorted(kwargs.items())))
+        text = self.renders.get(key)
+        if text is not None:
+            self.hits += 1
+            if self.metrics is not None:
+                self.metrics.incr("render_cache_hits")
+            return text
+        text = json_to_markdown(struct, **kwargs)
+        self.renders[key] = text
+        self.misses += 1
+        if self.metrics is not None:
+            self.metrics.incr("render_cache_misses")
+        return text
@@ -0,0 +1,65 @@
+import time
+import threading
+import contextlib
+from collections import defaultdict
+
+
+class Metrics:
+    """Thread-safe counters, timers and value observations of an inference run.
+
+    Timers accumulate wall time and the CPU time of the calling thread. Observations (e.g. latencies) are kept to
+    compute percentiles.
+    """
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.counters = defaultdict(int)
+        self.wall_times = defaultdict(float)
+        self.cpu_times = defaultdict(float)
+        self.observations = defaultdict(list)
+
+    def incr(self, name: str, value: int = 1):
+        with self.lock:
+            self.counters[name] += value
+
+    def add_time(self, name: str, wall_time: float, cpu_time: float = 0.0):
+        with self.lock:
+            self.wall_times[name] += wall_time
+            self.cpu_times[name] += cpu_time
+
+    @contextlib.contextmanager
+    def timer(self, name: str, cpu: bool = True):
+        # CPU time is meaningless for coroutines, other tasks run on the same thread while they are suspended
+        start_wall = time.perf_counter()
+        start_cpu = time.thread_time() if cpu else 0.0
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start_wall, time.thread_time() - start_cpu if cpu else 0.0)
+
+    def observe(self, name: str, value: float):
+        with self.lock:
+            self.observations[name].append(value)
+
+    def percentile(self, name: str, q: float) -> float:
+        with self.lock:
+            values = sorted(self.observations[name])
+        if len(values) == 0:
+            return None
+        index = min(len(values) - 1, max(0, int(round(q / 100 * (len(values) - 1)))))
+        return values[index]
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.wall_times.clear()
+            self.cpu_times.clear()
+            self.observations.clear()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "counters": dict(self.counters),
+                "wall_times": dict(self.wall_times),
+                "cpu_times": dict(self.cpu_times),
+                "observations": {name: len(values) for name, values in self.observations.items()}
+            }
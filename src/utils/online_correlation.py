@@ -0,0 +1,129 @@
+import os
+import json
+import bisect
+import threading
+import numpy as np
+from tqdm import tqdm
+from tabulate import tabulate
+from src.utils.calc_correlation import contingency_correlation
+from src.utils.extract_scores import extract_scores_from_summary
+
+
+CATEGORIES = ["appearance", "intrinsic", "relationship", "overall"]
+
+
+def get_sample_score(key: str, category: str, reference: dict, result: dict):
+    """Score of `key` (as in `get_coarse_grained_score_mapper`) for one sample, `reference` is its `overall` entry in
+    the reference score file and `result` its extracted scores."""
+    if key == "result_score":
+        return result[f"{category}_score"]
+    if key == "openai_score":
+        return reference[category]["score"]
+    if key == "manual_score_avg":
+        return reference[category]["manual_score"][3]
+    return reference[category]["manual_score"][int(key[len("manual_score_"):]) - 1]
+
+
+class ContingencyTable:
+    """Counts of the pairs of distinct values of two score series, grown one pair at a time.
+
+    The distinct values of each series are kept sorted (bisect), a new value inserts a row or column, so ranks and
+    concordance are available without sorting the samples again. Meant for scores with few distinct values.
+    """
+    def __init__(self) -> None:
+        self.levels_x = []
+        self.levels_y = []
+        self.table = np.zeros((0, 0), dtype=np.int64)
+
+    def add(self, x: float, y: float):
+        i = bisect.bisect_left(self.levels_x, x)
+        if i == len(self.levels_x) or self.levels_x[i] != x:
+            self.levels_x.insert(i, x)
+            self.table = np.insert(self.table, i, 0, axis=0)
+        j = bisect.bisect_left(self.levels_y, y)
+        if j == len(self.levels_y) or self.levels_y[j] != y:
+            self.levels_y.insert(j, y)
+            self.table = np.insert(self.table, j, 0, axis=1)
+        self.table[i, j] += 1
+
+    def __len__(self) -> int:
+        return int(self.table.sum())
+
+    def correlation(self, corr_type: str = "spearman") -> float:
+        return contingency_correlation(self.table, self.levels_x, self.levels_y, corr_type=corr_type)
+
+
+class OnlineCorrelation:
+    """Correlations with the reference scores of the samples evaluated so far, updated as every sample is dumped.
+
+    Register it with `InferenceEngine.add_sample_callback`: the scores of every sample are extracted from its summarize
+    stage and paired with the reference scores of the same id. Every `report_interval` samples the correlations of
+    `compare_keys` with `reference_key` are printed and written to `output_file`. Missing ('N/A') scores are skipped,
+    while `calc_correlation_from_result_dir` fills them with the mean, so the final values can differ slightly.
+    """
+    def __init__(
+        self, ref_scores: list, reference_key: str = "manual_score_avg", compare_keys: tuple = ("result_score", "openai_score"),
+        corr_types: tuple = ("spearman", "kendall"), report_interval: int = 50, output_file: str = None
+    ) -> None:
+        self.references = {str(sample["id"]): sample["overall"] for sample in ref_scores}
+        self.reference_key = reference_key
+        self.compare_keys = list(compare_keys)
+        self.corr_types = list(corr_types)
+        self.report_interval = report_interval
+        self.output_file = output_file
+        self.lock = threading.Lock()
+        self.num_samples = 0
+        self.tables = {category: {key: ContingencyTable() for key in self.compare_keys} for category in CATEGORIES}
+        self.missing = {category: {key: 0 for key in self.compare_keys} for category in CATEGORIES}
+
+    def __call__(self, context):
+        reference = self.references.get(str(context.sample_index))
+        result = extract_scores_from_summary(context.summary)
+        if reference is None or result is None:
+            return
+        self.update(reference, result)
+        if self.report_interval > 0 and self.num_samples % self.report_interval == 0:
+            self.report()
+
+    def update(self, reference: dict, result: dict):
+        with self.lock:
+            self.num_samples += 1
+            for category in CATEGORIES:
+                y = get_sample_score(self.reference_key, category, reference, result)
+                for key in self.compare_keys:
+                    x = get_sample_score(key, category, reference, result)
+                    if not isinstance(x, (int, float)) or not isinstance(y, (int, float)):
+                        self.missing[category][key] += 1
+                        continue
+                    self.tables[category][key].add(x, y)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            categories = {}
+            for category in CATEGORIES:
+                categories[category] = {}
+                for key in self.compare_keys:
+                    table = self.tables[category][key]
+                    categories[category][key] = {"n": len(table), "missing": self.missing[category][key]}
+                    for corr_type in self.corr_types:
+                        correlation = table.correlation(corr_type)
+                        categories[category][key][corr_type] = None if np.isnan(correlation) else correlation
+            return {"num_samples": self.num_samples, "reference_key": self.reference_key, "categories": categories}
+
+    def format(self, snapshot: dict = None) -> str:
+        if snapshot is None:
+            snapshot = self.snapshot()
+        headers = ["", "n"] + [f"{key} {corr_type}" for key in self.compare_keys for corr_type in self.corr_types]
+        rows = []
+        for category, values in snapshot["categories"].items():
+            n = max(value["n"] for value in values.values())
+            rows.append([category, n] + [values[key][corr_type] for key in self.compare_keys for corr_type in self.corr_types])
+        return tabulate(rows, headers=headers, floatfmt=".4f", missingval="-")
+
+    def report(self):
+        snapshot = self.snapshot()
+        tqdm.write(f"[!] correlation with {self.reference_key} after {snapshot['num_samples']} samples:\n{self.format(snapshot)}")
+        if self.output_file is not None:
+            with open(self.output_file + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(snapshot, f, ensure_ascii=False, indent=4)
+            os.replace(self.output_file + ".tmp", self.output_file)
@@ -0,0 +1,53 @@
+import threading
+from collections import deque, defaultdict
+
+
+def common_prefix_length(a: str, b: str) -> int:
+    # binary search on slice comparisons, which run in C
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        mid = (low + high + 1) // 2
+        if a[:mid] == b[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+    return low
+
+
+class PrefixStats:
+    """Per-stage share of prompt characters repeating a prefix of one of the last `window` issued prompts.
+
+    Prompts are recorded in issue order, so the ratio approximates the prefix cache hit rate of the server for a cache
+    holding the most recent requests.
+    """
+    def __init__(self, window: int = 32) -> None:
+        self.recent = deque(maxlen=window)
+        self.lock = threading.Lock()
+        self.stats = defaultdict(lambda: {"requests": 0, "chars": 0, "shared_chars": 0})
+
+    def record(self, stage: str, text: str) -> int:
+        with self.lock:
+            shared = max((common_prefix_length(text, previous) for previous in self.recent), default=0)
+            self.recent.append(text)
+            self.stats[stage]["requests"] += 1
+            self.stats[stage]["chars"] += len(text)
+            self.stats[stage]["shared_chars"] += shared
+        return shared
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            result = {}
+            for stage, stats in self.stats.items():
+                result[stage] = dict(stats)
+                result[stage]["shared_ratio"] = stats["shared_chars"] / stats["chars"] if stats["chars"] > 0 else 0.0
+            return result
+
+    def format(self) -> str:
+        lines = [f"{'stage':<36}{'requests':>10}{'chars':>14}{'shared ratio':>14}"]
+        total_chars, total_shared = 0, 0
+        for stage, stats in self.get_stats().items():
+            lines.append(f"{stage:<36}{stats['requests']:>10}{stats['chars']:>14}{round(stats['shared_ratio'] * 100, 2):>13}%")
+            total_chars += stats["chars"]
+            total_shared += stats["shared_chars"]
+        lines.append(f"{'total':<36}{'':>10}{total_chars:>14}{round(total_shared / max(total_chars, 1) * 100, 2):>13}%")
+        return "\n".join(lines)
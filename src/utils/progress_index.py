@@ -0,0 +1,119 @@
+import os
+import re
+import json
+import hashlib
+from typing import Any
+
+
+# leading bytes of a result file that are checked to detect that it was rewritten since it was last read
+FINGERPRINT_BYTES = 1024
+ID_PATTERN = re.compile(rb'\{"id": (-?\d+|"(?:[^"\\]|\\.)*")[,}]')
+
+
+def file_fingerprint(file: str, size: int) -> str:
+    with open(file, "rb") as f:
+        return hashlib.sha1(f.read(size)).hexdigest()
+
+
+def read_record_id(line: bytes) -> Any:
+    # result records are dumped with "id" as the first key, so the id is read without decoding the whole record
+    match = ID_PATTERN.match(line)
+    if match is not None:
+        return json.loads(match.group(1))
+    return json.loads(line)["id"]
+
+
+class ProgressIndex:
+    """Read-only mapping from record id to the record of a `*-result.jsonl` file, loaded lazily from byte offsets.
+
+    Only ids and offsets are kept in memory. The index is persisted in a sidecar file (`<result file>.idx`), so a
+    resumed run only scans the lines appended since the index was last saved. The sidecar is reused only if the first
+    bytes of the result file are unchanged and every indexed offset still starts a record of its id, otherwise the
+    file is indexed again. As with the original dict, the last record of a duplicated id wins. A trailing line without
+    newline (torn write) is not indexed.
+    """
+    def __init__(self, result_file: str) -> None:
+        self.result_file = result_file
+        self.index_file = result_file + ".idx"
+        self.offsets = {}
+        self.indexed_size = 0
+
+        if os.path.exists(self.result_file):
+            self._load_index()
+            self._update_index()
+        elif os.path.exists(self.index_file):
+            # the result file was deleted, its index must not be picked up by the file written next
+            os.remove(self.index_file)
+
+    def _load_index(self):
+        if not os.path.exists(self.index_file):
+            return
+        try:
+            with open(self.index_file, "r", encoding="utf-8") as f:
+                index = json.load(f)
+            indexed_size = index["size"]
+            fingerprint = index["fingerprint"]
+            offsets = {record_id: offset for record_id, offset in index["offsets"]}
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+
+        # the index is reused only if the result file still ends a line where indexing stopped, starts with the same
+        # bytes, and has a record of the right id at every indexed offset
+        if indexed_size > os.path.getsize(self.result_file):
+            return
+        if file_fingerprint(self.result_file, min(indexed_size, FINGERPRINT_BYTES)) != fingerprint:
+            return
+        with open(self.result_file, "rb") as f:
+            if indexed_size > 0:
+                f.seek(indexed_size - 1)
+                if f.read(1) != b"\n":
+                    return
+            for record_id, offset in offsets.items():
+                prefix = b'{"id": ' + json.dumps(record_id, ensure_ascii=False).encode("utf-8")
+                f.seek(offset)
+                if f.read(len(prefix) + 1) not in (prefix + b",", prefix + b"}"):
+                    return
+        self.offsets = offsets
+        self.indexed_size = indexed_size
+
+    def _update_index(self):
+        if os.path.getsize(self.result_file) == self.indexed_size:
+            return
+
+        offset = self.indexed_size
+        with open(self.result_file, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                if line.strip():
+                    self.offsets[read_record_id(line)] = offset
+                offset += len(line)
+        self.indexed_size = offset
+
+        tmp_file = self.index_file + ".tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({
+                "size": self.indexed_size,
+                "fingerprint": file_fingerprint(self.result_file, min(self.indexed_size, FINGERPRINT_BYTES)),
+                "offsets": list(self.offsets.items())
+            }, f)
+        os.replace(tmp_file, self.index_file)
+
+    def __contains__(self, record_id: Any) -> bool:
+        return record_id in self.offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __iter__(self):
+        return iter(self.offsets)
+
+    def keys(self):
+        return self.offsets.keys()
+
+    def __getitem__(self, record_id: Any) -> dict:
+        offset = self.offsets[record_id]
+        with open(self.result_file, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
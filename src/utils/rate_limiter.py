@@ -0,0 +1,178 @@
+import math
+import time
+import asyncio
+import threading
+from collections import defaultdict
+
+
+def estimate_prompt_tokens(messages: list, chars_per_token: float = 4.0, image_tokens: int = 765) -> int:
+    """Rough token count of chat messages: text length over `chars_per_token`, and `image_tokens` per image.
+
+    765 tokens is the cost of a 1024x1024 image at high detail for GPT-4o (85 + 170 per 512px tile).
+    """
+    chars = 0
+    images = 0
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            chars += len(content)
+            continue
+        for part in content:
+            if part["type"] == "text":
+                chars += len(part["text"])
+            elif part["type"] == "image_url":
+                images += 1
+    return int(chars / chars_per_token) + images * image_tokens + 4 * len(messages)
+
+
+class RateLimiter:
+    """Requests per minute and tokens per minute budgets of an API key, usable from threads and from coroutines.
+
+    Each budget is a token bucket holding `burst_seconds` of it. A request is scheduled after the requests before it,
+    at the first time every bucket holds its cost (one request and its expected tokens), the buckets are charged at
+    that time and the request sleeps until then. The expected tokens are the estimated prompt tokens scaled by the
+    ratio between the reported and the estimated prompt tokens, plus the mean completion tokens, both tracked per key
+    (the pipeline stage). Once the response arrives, the tokens bucket is corrected with `usage.total_tokens`. A 429
+    empties the buckets for its retry delay, so that the other requests do not run into it too. The reservation of a
+    request the API did not process (cancelled before it was sent, refused connection, 4xx) is refunded.
+    """
+    def __init__(
+        self,
+        requests_per_minute: float = None,
+        tokens_per_minute: float = None,
+        burst_seconds: float = 1.0,
+        smoothing: float = 0.1
+    ) -> None:
+        assert requests_per_minute is not None or tokens_per_minute is not None
+        self.rates = {}
+        self.capacities = {}
+        if requests_per_minute is not None:
+            self.rates["requests"] = requests_per_minute / 60
+            self.capacities["requests"] = max(self.rates["requests"] * burst_seconds, 1.0)
+        if tokens_per_minute is not None:
+            self.rates["tokens"] = tokens_per_minute / 60
+            self.capacities["tokens"] = self.rates["tokens"] * burst_seconds
+        # levels of the buckets at `updated`, the send time of the last request scheduled, which may be in the future
+        self.levels = dict(self.capacities)
+        self.updated = time.monotonic()
+        self.smoothing = smoothing
+        self.prompt_ratio = {}
+        self.completion_tokens = {}
+
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)
+
+    def _refill(self, until: float, costs: dict = None):
+        elapsed = until - self.updated
+        self.updated = until
+        for name, rate in self.rates.items():
+            # a request costing more than the bucket holds waits until the bucket would have held it
+            capacity = max(self.capacities[name], costs[name]) if costs is not None else self.capacities[name]
+            self.levels[name] = min(self.levels[name] + rate * elapsed, capacity)
+
+    def _expected_tokens(self, prompt_tokens: int, key: str) -> int:
+        # before the first response of a stage, the mean estimates of the other stages are the best guess
+        if key in self.prompt_ratio:
+            return math.ceil(prompt_tokens * self.prompt_ratio[key] + self.completion_tokens[key])
+        if len(self.prompt_ratio) > 0:
+            prompt_ratio = sum(self.prompt_ratio.values()) / len(self.prompt_ratio)
+            completion_tokens = sum(self.completion_tokens.values()) / len(self.completion_tokens)
+            return math.ceil(prompt_tokens * prompt_ratio + completion_tokens)
+        return prompt_tokens
+
+    def _reserve(self, prompt_tokens: int, key: str) -> tuple:
+        with self.lock:
+            now = time.monotonic()
+            self._refill(max(now, self.updated))
+            tokens = self._expected_tokens(prompt_tokens, key)
+            costs = {"requests": 1, "tokens": tokens}
+            delay = max(max(costs[name] - self.levels[name], 0) / rate for name, rate in self.rates.items())
+            self._refill(self.updated + delay, costs)
+            for name in self.rates:
+                self.levels[name] -= costs[name]
+            wait = self.updated - now
+            self.counters["requests"] += 1
+            self.counters["reserved_tokens"] += tokens
+            if wait > 0:
+                self.counters["delayed"] += 1
+                self.counters["wait_time"] += wait
+            return tokens, wait
+
+    def acquire(self, prompt_tokens: int = 0, key: str = None) -> int:
+        """Wait for the budget of a request with `prompt_tokens` estimated prompt tokens, return the tokens reserved."""
+        tokens, wait = self._reserve(prompt_tokens, key)
+        if wait > 0:
+            time.sleep(wait)
+        return tokens
+
+    async def aacquire(self, prompt_tokens: int = 0, key: str = None) -> int:
+        tokens, wait = self._reserve(prompt_tokens, key)
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # cancelled before its send time (e.g. a hedge whose primary was answered), the request is never sent
+                self.refund(tokens)
+                raise
+        return tokens
+
+    def refund(self, reserved_tokens: int):
+        """Give back the budget reserved for a request the API did not process: never sent, or rejected outright."""
+        with self.lock:
+            self._refill(max(time.monotonic(), self.updated))
+            for name, cost in (("requests", 1), ("tokens", reserved_tokens)):
+                if name in self.levels:
+                    self.levels[name] = min(self.levels[name] + cost, self.capacities[name])
+            self.counters["refunded"] += 1
+            self.counters["refunded_tokens"] += reserved_tokens
+
+    def record_usage(self, prompt_tokens: int, reserved_tokens: int, usage, key: str = None):
+        """Correct the reservation of a request with the `usage` of its response, and the next estimates with it."""
+        if usage is None:
+            return
+        with self.lock:
+            if "tokens" in self.levels:
+                now = time.monotonic()
+                if usage.total_tokens > reserved_tokens:
+                    self.levels["tokens"] -= usage.total_tokens - reserved_tokens
+                elif self.updated <= now:
+                    # the tokens reserved in excess are given back only if no request is scheduled yet: the bucket of
+                    # the API did not hold them while it was full, so they cannot be spent after the queued requests
+                    self._refill(now)
+                    self.levels["tokens"] = min(self.levels["tokens"] + reserved_tokens - usage.total_tokens, self.capacities["tokens"])
+            self.counters["used_tokens"] += usage.total_tokens
+            ratio = usage.prompt_tokens / max(prompt_tokens, 1)
+            if key not in self.prompt_ratio:
+                self.prompt_ratio[key] = ratio
+                self.completion_tokens[key] = float(usage.completion_tokens)
+            else:
+                self.prompt_ratio[key] += (ratio - self.prompt_ratio[key]) * self.smoothing
+                self.completion_tokens[key] += (usage.completion_tokens - self.completion_tokens[key]) * self.smoothing
+
+    def pause(self, seconds: float):
+        """Hold the requests not sent yet for `seconds`, after the API answered 429."""
+        with self.lock:
+            # the buckets of the API are empty now, nothing is sent before `seconds` have passed
+            self.updated = max(self.updated, time.monotonic() + seconds)
+            for name in self.rates:
+                self.levels[name] = min(self.levels[name], 0.0)
+            self.counters["rate_limited"] += 1
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "requests": int(self.counters["requests"]),
+                "delayed": int(self.counters["delayed"]),
+                "wait_time": self.counters["wait_time"],
+                "rate_limited": int(self.counters["rate_limited"]),
+                "refunded": int(self.counters["refunded"]),
+                "reserved_tokens": int(self.counters["reserved_tokens"]),
+                "refunded_tokens": int(self.counters["refunded_tokens"]),
+                "used_tokens": int(self.counters["used_tokens"])
+            }
+
+    def format(self) -> str:
+        stats = self.get_stats()
+        return (f"{stats['requests']} requests, {stats['delayed']} delayed for {round(stats['wait_time'], 1)}s in total, "
+                f"{stats['rate_limited']} answered 429, {stats['refunded']} refunded; {stats['reserved_tokens']} tokens reserved, "
+                f"{stats['refunded_tokens']} refunded, {stats['used_tokens']} used")
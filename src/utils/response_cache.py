@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import defaultdict
+from src.utils.image_cache import ImageCache
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """Persistent cache of model responses keyed by the hash of everything the response depends on, shared by runs.
+
+    Responses live in a SQLite database in WAL mode, so several processes (e.g. runs with different output directories)
+    can read and write it at the same time. The least recently used responses are deleted once the total size of the
+    stored responses exceeds `max_bytes`. Image contents are hashed once per (path, mtime, size).
+    """
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024, evict_every: int = 256) -> None:
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.evict_every = evict_every
+        self.lock = threading.Lock()
+        # autocommit, every statement is its own transaction
+        self.connection = sqlite3.connect(path, timeout=30.0, isolation_level=None, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, stage TEXT, response TEXT, size INTEGER, accessed REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.image_digests = ImageCache(loader=file_digest, max_bytes=64 * 1024 * 1024)
+        self.puts_since_eviction = 0
+        self.evictions = 0
+        self.stats = defaultdict(lambda: {"hits": 0, "misses": 0})
+
+    def image_digest(self, image: str) -> str:
+        if image is None:
+            return None
+        if image.startswith("data:"):
+            return hashlib.sha256(image.encode("utf-8")).hexdigest()
+        return self.image_digests.get(image)
+
+    def make_key(self, namespace: dict, prompt: str, gt_image: str = None, ref_image: str = None, history=None) -> str:
+        """Key of a request: `namespace` identifies the model and its sampling settings, images in the history
+        (message items of type `image_url`) are replaced by the hash of their content."""
+        if history is not None:
+            history = [
+                {
+                    **message,
+                    "content": [
+                        {"type": "image_url", "image_url": {"url": self.image_digest(item["image_url"]["url"])}}
+                        if item["type"] == "image_url" else item
+                        for item in message["content"]
+                    ] if isinstance(message["content"], list) else message["content"]
+                }
+                for message in history
+            ]
+        payload = {
+            "namespace": namespace,
+            "prompt": prompt,
+            "images": [self.image_digest(gt_image), self.image_digest(ref_image)],
+            "history": history
+        }
+        return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str, stage: str = None) -> str:
+        with self.lock:
+            row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats[stage]["misses"] += 1
+                return None
+            self.connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.stats[stage]["hits"] += 1
+            return row[0]
+
+    def put(self, key: str, response: str, stage: str = None):
+        size = len(response.encode("utf-8"))
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, stage, response, size, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, stage, response, size, time.time())
+            )
+            self.puts_since_eviction += 1
+            if self.puts_since_eviction >= self.evict_every:
+                self._evict()
+
+    def _evict(self):
+        # other processes write to the same database, so the size is measured instead of tracked
+        self.puts_since_eviction = 0
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # evict down to 90% of the budget, so that eviction does not run on every put once the cache is full
+        excess = total - int(self.max_bytes * 0.9)
+        keys = []
+        for key, size in self.connection.execute("SELECT key, size FROM responses ORDER BY accessed"):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", keys)
+        self.evictions += len(keys)
+
+    def evict(self):
+        with self.lock:
+            self._evict()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            result = {}
+            for stage, stats in self.stats.items():
+                total = stats["hits"] + stats["misses"]
+                result[stage] = {**stats, "hit_rate": stats["hits"] / total if total > 0 else 0.0}
+            return result
+
+    def format(self) -> str:
+        lines = []
+        for stage, stats in sorted(self.get_stats().items(), key=lambda item: str(item[0])):
+            lines.append(f"  {stage}: {stats['hits']} hits, {stats['misses']} misses ({round(stats['hit_rate'] * 100, 1)}% hit rate)")
+        return "\n".join(lines)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,133 @@
+import os
+import time
+import atexit
+import threading
+from typing import Dict, List
+
+
+def truncate_torn_line(file: str) -> int:
+    """Drop a trailing line without newline, left by a write interrupted by a crash. Returns the number of bytes removed."""
+    if not os.path.exists(file):
+        return 0
+    size = os.path.getsize(file)
+    end = size
+    with open(file, "rb+") as f:
+        while end > 0:
+            start = max(0, end - 65536)
+            f.seek(start)
+            chunk = f.read(end - start)
+            position = chunk.rfind(b"\n")
+            if position >= 0:
+                end = start + position + 1
+                break
+            end = start
+        if end < size:
+            f.truncate(end)
+    return size - end
+
+
+class ResultWriter:
+    """Append-only writer of `*-result.jsonl` files, keeping one handle per stage for the whole run.
+
+    Lines are buffered per stage and appended with a single `os.write` per stage, so only whole lines reach the files
+    and a crash can at most tear the last line, which is truncated when the writer is created again. Buffers are
+    written at least every `flush_interval` seconds (0 writes on every call) and the files are fsynced at least every
+    `fsync_interval` seconds (None leaves durability to the OS).
+    """
+    def __init__(self, file_mapper: Dict[str, str], flush_interval: float = 0.0, fsync_interval: float = 5.0) -> None:
+        self.file_mapper = file_mapper
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.fds = {}
+        self.buffers = {stage: [] for stage in file_mapper}
+        self.dirty = set()
+        self.last_flush = time.monotonic()
+        self.last_fsync = time.monotonic()
+
+        self.lines_written = 0
+        self.bytes_written = 0
+        self.num_flushes = 0
+        self.num_fsyncs = 0
+        self.write_time = 0.0
+
+        for stage, file in self.file_mapper.items():
+            num_bytes = truncate_torn_line(file)
+            if num_bytes > 0:
+                print(f"[!] truncated a torn line of {num_bytes} bytes at the end of {file}")
+
+        atexit.register(self.close)
+
+    def _get_fd(self, stage: str) -> int:
+        if stage not in self.fds:
+            self.fds[stage] = os.open(self.file_mapper[stage], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        return self.fds[stage]
+
+    def write(self, output_mapper: Dict[str, List[str]]):
+        with self.lock:
+            for stage, lines in output_mapper.items():
+                if len(lines) == 0:
+                    continue
+                assert stage in self.file_mapper
+                self.buffers[stage].extend(lines)
+                self.lines_written += len(lines)
+
+            now = time.monotonic()
+            if now - self.last_flush >= self.flush_interval:
+                self._flush()
+            if self.fsync_interval is not None and now - self.last_fsync >= self.fsync_interval:
+                self._fsync()
+
+    def _flush(self):
+        start = time.perf_counter()
+        for stage, lines in self.buffers.items():
+            if len(lines) == 0:
+                continue
+            data = "".join(lines).encode("utf-8")
+            fd = self._get_fd(stage)
+            view = memoryview(data)
+            while len(view) > 0:
+                view = view[os.write(fd, view):]
+            self.bytes_written += len(data)
+            self.buffers[stage] = []
+            self.dirty.add(stage)
+        self.num_flushes += 1
+        self.last_flush = time.monotonic()
+        self.write_time += time.perf_counter() - start
+
+    def _fsync(self):
+        start = time.perf_counter()
+        for stage in self.dirty:
+            os.fsync(self.fds[stage])
+        self.dirty.clear()
+        self.num_fsyncs += 1
+        self.last_fsync = time.monotonic()
+        self.write_time += time.perf_counter() - start
+
+    def flush(self, fsync: bool = False):
+        with self.lock:
+            self._flush()
+            if fsync:
+                self._fsync()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self._fsync()
+            for fd in self.fds.values():
+                os.close(fd)
+            self.fds = {}
+        # the hook would keep the writer and its buffers alive until the interpreter exits
+        atexit.unregister(self.close)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            return {
+                "lines": self.lines_written,
+                "bytes": self.bytes_written,
+                "flushes": self.num_flushes,
+                "fsyncs": self.num_fsyncs,
+                "write_time": self.write_time,
+                "lines_per_second": self.lines_written / self.write_time if self.write_time > 0 else 0.0,
+                "bytes_per_second": self.bytes_written / self.write_time if self.write_time > 0 else 0.0
+            }
@@ -1,36 +1,108 @@
+import os
+import json
 import argparse
-from src.inference.openai_compatible import OpenAICompatibleInferenceEngine
+from src.inference.openai_compatible import OpenAICompatibleInferenceEngine, AsyncOpenAICompatibleInferenceEngine
 from src.utils.extract_scores import extract_scores_from_result_dir
 from src.utils.calc_correlation import calc_correlation_from_result_dir
+from src.utils.online_correlation import OnlineCorrelation
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--input-file", type=str, default='data/test/t2i-eval-bench.json')
     parser.add_argument("--ref-score-file", type=str, default='data/test/scores.json')
     parser.add_argument("--image-root", type=str, required=True)
-    parser.add_argument("--service-url", type=str, default='http://localhost:65535/v1')
+    parser.add_argument("--service-url", type=str, nargs='+', default=['http://localhost:65535/v1'], help="one or more replicas serving the same model, requests are load balanced across them")
+    parser.add_argument("--api-key", type=str, default=os.environ.get("OPENAI_API_KEY"), help="key of a hosted API, defaults to $OPENAI_API_KEY")
+    parser.add_argument("--requests-per-minute", type=float, default=None, help="requests per minute allowed by the API, requests are paced to stay within it")
+    parser.add_argument("--tokens-per-minute", type=float, default=None, help="prompt and completion tokens per minute allowed by the API")
+    parser.add_argument("--health-check-interval", type=float, default=10.0, help="seconds between health checks of the replicas")
+    parser.add_argument("--request-timeout", type=float, default=None, help="deadline in seconds of every request attempt, failed attempts are retried up to --max-http-retries times")
+    parser.add_argument("--stage-timeout", type=str, nargs='*', default=[], metavar="PATTERN=SECONDS", help="deadlines of the stages matching a pattern, e.g. 'extract=300' '*_eval*=60'")
+    parser.add_argument("--max-http-retries", type=int, default=2)
+    parser.add_argument("--hedge-quantile", type=float, default=None, help="duplicate requests unanswered after this latency quantile of their stage (e.g. 0.95) to another replica, needs several --service-url")
+    parser.add_argument("--max-hedge-ratio", type=float, default=0.1, help="maximum share of the requests that are hedged")
     parser.add_argument("--model-name", type=str, default=None)
     parser.add_argument("--max-retry", type=int, default=0)
+    parser.add_argument("--max-inflight-questions", type=int, default=1)
+    parser.add_argument("--max-inflight-samples", type=int, default=1)
+    parser.add_argument("--max-outstanding-requests", type=int, default=None)
+    parser.add_argument("--async-client", action='store_true', help="drive the pipelines with an asyncio event loop and an async client")
+    parser.add_argument("--adaptive-concurrency", action='store_true', help="adapt the requests in flight to the latency and overloads of the server, within the limits of the flags above")
+    parser.add_argument("--initial-concurrency", type=int, default=4)
+    parser.add_argument("--max-concurrency", type=int, default=256)
+    parser.add_argument("--flush-interval", type=float, default=0.0, help="seconds between writes of buffered result lines, 0 writes after every sample")
+    parser.add_argument("--fsync-interval", type=float, default=5.0, help="seconds between fsyncs of the result files")
+    parser.add_argument("--prefix-stats", action='store_true', help="report the shared prompt prefix ratio of each stage")
+    parser.add_argument("--image-cache-mb", type=int, default=256, help="memory budget of the encoded image cache")
+    parser.add_argument("--response-cache", type=str, default=None, help="sqlite file caching the responses of identical requests across runs")
+    parser.add_argument("--response-cache-mb", type=int, default=1024, help="size budget of the cached responses")
     parser.add_argument("--output-dir", type=str, required=True)
+    parser.add_argument("--bootstrap-resamples", type=int, default=0, help="resamples of the bootstrap confidence intervals of the correlations, 0 disables them")
+    parser.add_argument("--significance-test", type=str, default="bootstrap", choices=["bootstrap", "permutation"], help="paired test of result_score against openai_score")
+    parser.add_argument("--bootstrap-workers", type=int, default=None, help="worker processes of the resampling, defaults to the number of cores")
+    parser.add_argument("--correlation-history", type=str, default=None, help="file the correlation summary of every run is appended to, defaults to correlation-history.jsonl next to --ref-score-file")
+    parser.add_argument("--online-correlation-interval", type=int, default=0, help="samples between reports of the correlation of the samples evaluated so far, 0 disables them")
     args = parser.parse_args()
 
-    engine = OpenAICompatibleInferenceEngine(
+    engine_cls = AsyncOpenAICompatibleInferenceEngine if args.async_client else OpenAICompatibleInferenceEngine
+    engine = engine_cls(
         data_file=args.input_file,
         image_root=args.image_root,
         output_dir=args.output_dir,
         max_retry=args.max_retry,
+        max_inflight_questions=args.max_inflight_questions,
+        max_inflight_samples=args.max_inflight_samples,
+        max_outstanding_requests=args.max_outstanding_requests,
+        flush_interval=args.flush_interval,
+        fsync_interval=args.fsync_interval,
+        track_prefix_stats=args.prefix_stats,
+        response_cache_file=args.response_cache,
+        response_cache_bytes=args.response_cache_mb * 1024 * 1024,
         model_init_kwargs=dict(
+            api_key=args.api_key,
             base_url=args.service_url,
-            model_name=args.model_name
+            model_name=args.model_name,
+            image_cache_bytes=args.image_cache_mb * 1024 * 1024,
+            health_check_interval=args.health_check_interval,
+            max_retries=args.max_http_retries,
+            request_timeout=args.request_timeout,
+            stage_timeouts={pattern: float(seconds) for pattern, seconds in (item.rsplit('=', 1) for item in args.stage_timeout)},
+            hedge_quantile=args.hedge_quantile,
+            max_hedge_ratio=args.max_hedge_ratio,
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute,
+            adaptive_concurrency=args.adaptive_concurrency,
+            initial_concurrency=args.initial_concurrency,
+            max_concurrency=args.max_concurrency
         )
     )
     
+    online_correlation = None
+    if args.online_correlation_interval > 0:
+        with open(args.ref_score_file, "r", encoding="utf-8") as f:
+            online_correlation = OnlineCorrelation(
+                ref_scores=json.load(f),
+                report_interval=args.online_correlation_interval,
+                output_file=os.path.join(args.output_dir, "online-correlation.json")
+            )
+        engine.add_sample_callback(online_correlation)
+    
     engine.inference(
         granularity='coarse',
         multi_stage=True,
         simple_answer_and_eval=True
     )
+    
+    if online_correlation is not None:
+        online_correlation.report()
 
     extract_scores_from_result_dir(result_dir=args.output_dir)
     
-    calc_correlation_from_result_dir(result_dir=args.output_dir, ref_score_file=args.ref_score_file)
+    calc_correlation_from_result_dir(
+        result_dir=args.output_dir,
+        ref_score_file=args.ref_score_file,
+        num_resamples=args.bootstrap_resamples,
+        significance_test=args.significance_test,
+        num_workers=args.bootstrap_workers,
+        history_file=args.correlation_history
+    )
@@ -1,7 +1,10 @@
+import os
+import json
 import argparse
 from src.inference.minicpm_v_offline import MiniCPMVOfflineInferenceEngine
 from src.utils.extract_scores import extract_scores_from_result_dir
 from src.utils.calc_correlation import calc_correlation_from_result_dir
+from src.utils.online_correlation import OnlineCorrelation
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -11,6 +14,21 @@ if __name__ == "__main__":
     parser.add_argument("--model-name-or-path", type=str, default=None)
     parser.add_argument("--max-retry", type=int, default=0)
     parser.add_argument("--output-dir", type=str, required=True)
+    parser.add_argument("--max-batch-size", type=int, default=1, help="maximum number of prompts sent to one vLLM generate call")
+    parser.add_argument("--max-inflight-samples", type=int, default=1, help="maximum number of samples whose prompts are pending at the same time")
+    parser.add_argument("--flush-interval", type=float, default=0.0, help="seconds between writes of buffered result lines, 0 writes after every sample")
+    parser.add_argument("--fsync-interval", type=float, default=5.0, help="seconds between fsyncs of the result files")
+    parser.add_argument("--prefix-ordering", action='store_true', help="issue requests of the same prompt template back to back")
+    parser.add_argument("--prefix-stats", action='store_true', help="report the shared prompt prefix ratio of each stage")
+    parser.add_argument("--image-cache-mb", type=int, default=1024, help="memory budget of the decoded image cache")
+    parser.add_argument("--prefetch-samples", type=int, default=0, help="number of upcoming samples whose images are decoded in background")
+    parser.add_argument("--response-cache", type=str, default=None, help="sqlite file caching the responses of identical requests across runs")
+    parser.add_argument("--response-cache-mb", type=int, default=1024, help="size budget of the cached responses")
+    parser.add_argument("--bootstrap-resamples", type=int, default=0, help="resamples of the bootstrap confidence intervals of the correlations, 0 disables them")
+    parser.add_argument("--significance-test", type=str, default="bootstrap", choices=["bootstrap", "permutation"], help="paired test of result_score against openai_score")
+    parser.add_argument("--bootstrap-workers", type=int, default=None, help="worker processes of the resampling, defaults to the number of cores")
+    parser.add_argument("--correlation-history", type=str, default=None, help="file the correlation summary of every run is appended to, defaults to correlation-history.jsonl next to --ref-score-file")
+    parser.add_argument("--online-correlation-interval", type=int, default=0, help="samples between reports of the correlation of the samples evaluated so far, 0 disables them")
     args = parser.parse_args()
 
     engine = MiniCPMVOfflineInferenceEngine(
@@ -18,17 +36,47 @@ if __name__ == "__main__":
         image_root=args.image_root,
         output_dir=args.output_dir,
         max_retry=args.max_retry,
+        max_inflight_samples=args.max_inflight_samples,
+        max_batch_size=args.max_batch_size,
+        flush_interval=args.flush_interval,
+        fsync_interval=args.fsync_interval,
+        prefix_ordering=args.prefix_ordering,
+        track_prefix_stats=args.prefix_stats,
+        response_cache_file=args.response_cache,
+        response_cache_bytes=args.response_cache_mb * 1024 * 1024,
         model_init_kwargs=dict(
-            model_name_or_path=args.model_name_or_path
+            model_name_or_path=args.model_name_or_path,
+            image_cache_bytes=args.image_cache_mb * 1024 * 1024,
+            prefetch_samples=args.prefetch_samples
         )
     )
     
+    online_correlation = None
+    if args.online_correlation_interval > 0:
+        with open(args.ref_score_file, "r", encoding="utf-8") as f:
+            online_correlation = OnlineCorrelation(
+                ref_scores=json.load(f),
+                report_interval=args.online_correlation_interval,
+                output_file=os.path.join(args.output_dir, "online-correlation.json")
+            )
+        engine.add_sample_callback(online_correlation)
+    
     engine.inference(
         granularity='coarse',
         multi_stage=True,
         simple_answer_and_eval=True
     )
+    
+    if online_correlation is not None:
+        online_correlation.report()
 
     extract_scores_from_result_dir(result_dir=args.output_dir)
     
-    calc_correlation_from_result_dir(result_dir=args.output_dir, ref_score_file=args.ref_score_file)
+    calc_correlation_from_result_dir(
+        result_dir=args.output_dir,
+        ref_score_file=args.ref_score_file,
+        num_resamples=args.bootstrap_resamples,
+        significance_test=args.significance_test,
+        num_workers=args.bootstrap_workers,
+        history_file=args.correlation_history
+    )
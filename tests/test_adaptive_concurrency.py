@@ -0,0 +1,36 @@
+import asyncio
+from src.utils.adaptive_concurrency import AdaptiveConcurrencyLimit
+
+
+def test_cancelled_waiter_passes_on_its_wake_up():
+    async def main():
+        limit = AdaptiveConcurrencyLimit(initial_limit=1, min_limit=1)
+        await limit.aacquire()
+        waiter_b = asyncio.create_task(limit.aacquire())
+        waiter_c = asyncio.create_task(limit.aacquire())
+        await asyncio.sleep(0)
+        assert len(limit.async_waiters) == 2
+
+        # B is woken by the release, then cancelled before it resumes and takes the slot
+        limit.cancel()
+        waiter_b.cancel()
+        await asyncio.wait_for(waiter_c, timeout=1.0)
+        assert waiter_b.cancelled()
+        assert limit.inflight == 1
+        assert len(limit.async_waiters) == 0
+
+    asyncio.run(main())
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def main():
+        limit = AdaptiveConcurrencyLimit(initial_limit=1, min_limit=1)
+        await limit.aacquire()
+        waiter = asyncio.create_task(limit.aacquire())
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert len(limit.async_waiters) == 0
+        assert limit.inflight == 1
+
+    asyncio.run(main())